@@ -3,15 +3,37 @@ from django.utils.html import format_html
 from django.urls import reverse
 from import_export.admin import ImportExportModelAdmin
 from import_export import resources
-from .models import Patient, Hospitalization, Diagnosis
+from .models import (Patient, Hospitalization, Diagnosis, ExportJob, DailyPatientRollup, RollupWatermark,
+                     PhysicianCaseload, CaseNumberSequence)
+
+# Наибольший блок номеров историй болезни, резервируемый при импорте
+IMPORT_CASE_NUMBER_BLOCK = 1000
 
 
 class PatientResource(resources.ModelResource):
     class Meta:
         model = Patient
-        exclude = ('id',)
+        exclude = ('id', 'search_vector')
         import_id_fields = ['case_number']
 
+    def before_import(self, dataset, **kwargs):
+        super().before_import(dataset, **kwargs)
+        # Новым пациентам номера выдаются блоками (hi/lo): одно обращение к счетчику года на блок
+        missing = sum(1 for row in dataset.dict if not str(row.get('case_number') or '').strip())
+        self.case_numbers = CaseNumberSequence.objects.allocator(
+            block_size=min(max(missing, 1), IMPORT_CASE_NUMBER_BLOCK)
+        )
+
+    def before_save_instance(self, instance, row, **kwargs):
+        super().before_save_instance(instance, row, **kwargs)
+        # Пробный импорт без транзакции ничего не сохраняет - номера не тратим
+        if self._is_dry_run(kwargs) and not self._is_using_transactions(kwargs):
+            return
+        if not instance.case_number:
+            instance.case_number = next(self.case_numbers)
+            # Номер из зарезервированного блока: поднимать счетчик при сохранении не нужно
+            instance._case_number_reserved = True
+
 
 class HospitalizationInline(admin.TabularInline):
     model = Hospitalization
@@ -103,16 +125,52 @@ class PatientAdmin(ImportExportModelAdmin):
 
 @admin.register(Hospitalization)
 class HospitalizationAdmin(admin.ModelAdmin):
-    list_display = ['patient', 'admission_date', 'discharge_date', 'diagnosis', 'department']
+    list_display = ['patient', 'admission_date', 'discharge_date', 'diagnosis', 'department', 'is_readmission']
+    list_filter = ['is_readmission']
     search_fields = ['patient__last_name', 'patient__first_name', 'diagnosis']
     ordering = ['-admission_date', '-discharge_date', 'diagnosis', 'department']
 
 
 @admin.register(Diagnosis)
 class DiagnosisAdmin(admin.ModelAdmin):
-    list_display = ['code', 'name', 'description_short']
+    list_display = ['code', 'name', 'level', 'description_short']
+    list_filter = ['level']
     search_fields = ['code', 'name']
     
     def description_short(self, obj):
         return obj.description[:100] + '...' if len(obj.description) > 100 else obj.description
-    description_short.short_description = 'Описание'
\ No newline at end of file
+    description_short.short_description = 'Описание'
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'user', 'export_format', 'status', 'total', 'processed', 'expires_at']
+    list_filter = ['status', 'export_format']
+    readonly_fields = ['id', 'user', 'export_format', 'include_fields', 'filters', 'total', 'processed', 'file',
+                       'error', 'created_at', 'finished_at', 'expires_at']
+
+
+@admin.register(DailyPatientRollup)
+class DailyPatientRollupAdmin(admin.ModelAdmin):
+    list_display = ['day', 'department', 'attending_physician', 'gender', 'mkb_chapter', 'status',
+                    'admissions', 'discharges', 'deaths']
+    list_filter = ['status', 'gender', 'mkb_chapter', 'department']
+    date_hierarchy = 'day'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(RollupWatermark)
+class RollupWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['name', 'value', 'refreshed_at']
+    readonly_fields = ['name', 'value', 'refreshed_at']
+
+
+@admin.register(PhysicianCaseload)
+class PhysicianCaseloadAdmin(admin.ModelAdmin):
+    list_display = ['physician', 'total', 'hospitalized', 'discharged', 'transferred', 'died']
+    readonly_fields = ['physician', 'total', 'hospitalized', 'discharged', 'transferred', 'died']
@@ -0,0 +1,163 @@
+"""Счетчики нагрузки лечащих врачей.
+
+PhysicianCaseload хранит число пациентов врача всего и по статусам,
+PhysicianDischargeDay - выписки по дням за последние RECENT_DAYS дней.
+Счетчики меняются сигналами Patient в той же транзакции, что и пациент
+(Patient.save() и delete() выполняются в atomic), поэтому виджеты врачей
+читают их по первичному ключу вместо GROUP BY по пациентам. Изменения в
+обход save() (QuerySet.update(), bulk_create) исправляет reconcile_caseloads().
+"""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import Patient, PhysicianCaseload, PhysicianDischargeDay
+
+RECENT_DAYS = 30
+# Статус пациента -> поле PhysicianCaseload
+STATUS_FIELDS = {
+    'HOSPITALIZED': 'hospitalized',
+    'DISCHARGED': 'discharged',
+    'TRANSFERRED': 'transferred',
+    'DIED': 'died',
+}
+CASELOAD_FIELDS = ['total', *STATUS_FIELDS.values()]
+
+
+def recent_since():
+    """Первый день, выписки с которого входят в счетчик последних дней"""
+    return timezone.localdate() - timedelta(days=RECENT_DAYS)
+
+
+def _contribution(values):
+    """Вклад пациента в счетчики: (врач, статус, день выписки); None - не учитывается"""
+    if not values or not values.get('attending_physician_id'):
+        return None
+    discharged = values.get('discharge_date')
+    return (
+        values['attending_physician_id'],
+        values.get('status'),
+        timezone.localtime(discharged).date() if discharged else None,
+    )
+
+
+def _increment(model, lookup, fields, delta):
+    """Прибавляет delta к полям строки lookup, создавая строку при первом обращении"""
+    updates = {field: F(field) + delta for field in fields}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **{field: delta for field in fields})
+    except IntegrityError:
+        # Строку только что создала параллельная транзакция
+        model.objects.filter(**lookup).update(**updates)
+
+
+def _apply(contribution, delta):
+    physician_id, status, discharge_day = contribution
+    fields = ['total'] + ([STATUS_FIELDS[status]] if status in STATUS_FIELDS else [])
+    _increment(PhysicianCaseload, {'physician_id': physician_id}, fields, delta)
+    # Старые выписки в счетчик уже не входят - их дни не храним
+    if discharge_day and discharge_day >= recent_since():
+        _increment(PhysicianDischargeDay, {'physician_id': physician_id, 'day': discharge_day}, ['count'], delta)
+
+
+def update_caseloads(previous, current):
+    """Переносит вклад пациента в счетчики.
+
+    previous и current - значения Patient.TRACKED_FIELDS до и после
+    изменения (None - пациента не было или он удален).
+    """
+    old, new = _contribution(previous), _contribution(current)
+    if old == new:
+        return
+    if old:
+        _apply(old, -1)
+    if new:
+        _apply(new, 1)
+
+
+def _recent_discharges(physician_ids):
+    return dict(
+        PhysicianDischargeDay.objects.filter(
+            physician_id__in=physician_ids,
+            day__gte=recent_since(),
+        ).values('physician_id').annotate(total=Sum('count')).values_list('physician_id', 'total')
+    )
+
+
+def get_caseload(physician_id):
+    """Счетчики врача по первичному ключу: всего, по статусам и выписано за RECENT_DAYS дней"""
+    caseload = PhysicianCaseload.objects.filter(pk=physician_id).values(*CASELOAD_FIELDS).first()
+    caseload = caseload or dict.fromkeys(CASELOAD_FIELDS, 0)
+    caseload['recent_discharges'] = _recent_discharges([physician_id]).get(physician_id, 0)
+    return caseload
+
+
+def top_physicians(limit=5):
+    """Врачи с наибольшим числом пациентов и их счетчики"""
+    caseloads = list(
+        PhysicianCaseload.objects.filter(total__gt=0).select_related('physician').order_by('-total')[:limit]
+    )
+    recent = _recent_discharges([caseload.pk for caseload in caseloads])
+    for caseload in caseloads:
+        caseload.recent_discharges = recent.get(caseload.pk, 0)
+    return caseloads
+
+
+def reconcile_caseloads():
+    """Пересчитывает счетчики по пациентам и исправляет расхождения; возвращает число исправленных строк"""
+    since = recent_since()
+    fixed = 0
+    with transaction.atomic():
+        # Блокировка строк: параллельные сохранения пациентов дождутся пересчета
+        # и применят свои приращения уже к исправленным значениям
+        stored = {caseload.pk: caseload for caseload in PhysicianCaseload.objects.select_for_update()}
+        actual = {
+            row.pop('attending_physician'): row
+            for row in Patient.objects.filter(attending_physician__isnull=False).order_by().values(
+                'attending_physician'
+            ).annotate(
+                total=Count('id'),
+                **{field: Count('id', filter=Q(status=status)) for status, field in STATUS_FIELDS.items()},
+            )
+        }
+        for physician_id, counts in actual.items():
+            caseload = stored.pop(physician_id, None)
+            if caseload is None:
+                PhysicianCaseload.objects.create(physician_id=physician_id, **counts)
+                fixed += 1
+            elif any(getattr(caseload, field) != value for field, value in counts.items()):
+                PhysicianCaseload.objects.filter(pk=physician_id).update(**counts)
+                fixed += 1
+        # Врачи, у которых больше нет пациентов (нулевые строки просто убираем)
+        fixed += sum(1 for caseload in stored.values() if any(getattr(caseload, field) for field in CASELOAD_FIELDS))
+        PhysicianCaseload.objects.filter(pk__in=list(stored)).delete()
+
+        days = {}
+        for physician_id, discharged in Patient.objects.filter(
+            attending_physician__isnull=False,
+            discharge_date__date__gte=since,
+        ).values_list('attending_physician', 'discharge_date'):
+            key = (physician_id, timezone.localtime(discharged).date())
+            days[key] = days.get(key, 0) + 1
+        stored_days = {
+            (row.physician_id, row.day): row
+            for row in PhysicianDischargeDay.objects.select_for_update().filter(day__gte=since)
+        }
+        for (physician_id, day), count in days.items():
+            row = stored_days.pop((physician_id, day), None)
+            if row is None:
+                PhysicianDischargeDay.objects.create(physician_id=physician_id, day=day, count=count)
+                fixed += 1
+            elif row.count != count:
+                PhysicianDischargeDay.objects.filter(pk=row.pk).update(count=count)
+                fixed += 1
+        fixed += sum(1 for row in stored_days.values() if row.count)
+        PhysicianDischargeDay.objects.filter(pk__in=[row.pk for row in stored_days.values()]).delete()
+        # Дни за пределами окна больше не нужны
+        PhysicianDischargeDay.objects.filter(day__lt=since).delete()
+    return fixed
@@ -0,0 +1,129 @@
+"""Коды МКБ-10 пациентов и госпитализаций как ссылки на справочник Diagnosis.
+
+Текстовые коды (admission_mkb_code, discharge_mkb_code, Hospitalization.mkb_code)
+остаются как введены, рядом хранится ForeignKey на Diagnosis. Новые записи
+связываются при сохранении (DiagnosisLinkMixin), существующие - пакетами
+командой link_diagnoses: после загрузки справочника ее можно запускать
+повторно, она подхватит коды, которых раньше в справочнике не было.
+
+Частота диагнозов считается соединением по индексированному ключу с
+GROUP BY, без сравнения строк; записи класса или блока МКБ-10 выбираются
+диапазоном по границам дерева справочника (см. patients/mkb.py).
+"""
+from collections import defaultdict
+
+from django.db.models import Count, F, Func, IntegerField, OuterRef, Subquery
+
+from .mkb import normalize_mkb_code
+from .models import Diagnosis, Hospitalization, Patient
+
+LINK_BATCH_SIZE = 2000
+
+# Вид диагноза: (модель, текстовый код, ссылка, дата для периода)
+DIAGNOSIS_KINDS = {
+    'admission': (Patient, 'admission_mkb_code', 'admission_mkb', 'admission_date__date'),
+    'discharge': (Patient, 'discharge_mkb_code', 'discharge_mkb', 'discharge_date__date'),
+    'hospitalization': (Hospitalization, 'mkb_code', 'mkb', 'admission_date'),
+}
+DIAGNOSIS_KIND_CHOICES = [
+    ('admission', 'При поступлении'),
+    ('discharge', 'При выписке'),
+    ('hospitalization', 'Госпитализации'),
+]
+
+
+def _link_batches(model, code_field, link_field, relink):
+    """Заполняет ссылку по пакетам первичных ключей; возвращает (связано, не найдено в справочнике)"""
+    queryset = model.objects.exclude(**{code_field: ''}).order_by('pk')
+    if not relink:
+        queryset = queryset.filter(**{f'{link_field}__isnull': True})
+    linked = missing = 0
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).values_list('pk', code_field)[:LINK_BATCH_SIZE])
+        if not rows:
+            return linked, missing
+        last_pk = rows[-1][0]
+
+        codes = {pk: normalize_mkb_code(code) for pk, code in rows}
+        known = dict(
+            Diagnosis.objects.codes().filter(code__in=set(codes.values())).values_list('code', 'pk')
+        )
+        by_diagnosis = defaultdict(list)
+        for pk, code in codes.items():
+            if code in known:
+                by_diagnosis[known[code]].append(pk)
+            else:
+                missing += 1
+        # Одним UPDATE на диагноз; сигналы и updated_at не затрагиваются
+        for diagnosis_id, pks in by_diagnosis.items():
+            model.objects.filter(pk__in=pks).update(**{link_field: diagnosis_id})
+            linked += len(pks)
+
+
+def link_mkb_codes(relink=False):
+    """Связывает существующие записи со справочником.
+
+    Возвращает {вид: (связано, не найдено в справочнике)}; с relink
+    пересчитываются и уже связанные записи (после правки справочника).
+    """
+    return {
+        kind: _link_batches(model, code_field, link_field, relink)
+        for kind, (model, code_field, link_field, date_field) in DIAGNOSIS_KINDS.items()
+    }
+
+
+def _kind_queryset(kind, date_from=None, date_to=None, queryset=None):
+    model, code_field, link_field, date_field = DIAGNOSIS_KINDS[kind]
+    if queryset is None:
+        queryset = model.objects.all()
+    if date_from:
+        queryset = queryset.filter(**{f'{date_field}__gte': date_from})
+    if date_to:
+        queryset = queryset.filter(**{f'{date_field}__lte': date_to})
+    return queryset
+
+
+def diagnosis_frequency(kind='admission', date_from=None, date_to=None, queryset=None, limit=None, node=None):
+    """Число записей по диагнозам справочника за период.
+
+    queryset - ограничение выборки (например, пациенты, видимые
+    пользователю), node - узел дерева МКБ-10 (класс, блок, рубрика),
+    которым ограничиваются диагнозы. Возвращает (строки с code, name,
+    count, share, число записей с кодом, которого нет в справочнике).
+    """
+    model, code_field, link_field, date_field = DIAGNOSIS_KINDS[kind]
+    queryset = _kind_queryset(kind, date_from, date_to, queryset)
+
+    linked = queryset.filter(**{f'{link_field}__isnull': False})
+    if node is not None:
+        linked = linked.filter(node.subtree_q(link_field))
+    rows = linked.order_by().values(
+        code=F(f'{link_field}__code'), name=F(f'{link_field}__name'),
+    ).annotate(count=Count('id')).order_by('-count', 'code')
+    rows = list(rows[:limit] if limit else rows)
+    total = linked.count() if limit else sum(row['count'] for row in rows)
+    for row in rows:
+        row['share'] = round(row['count'] * 100 / total, 1)
+    unlinked = queryset.filter(**{f'{link_field}__isnull': True}).exclude(**{code_field: ''}).count()
+    return rows, unlinked
+
+
+def group_counts(kind='admission', date_from=None, date_to=None, queryset=None):
+    """Число записей по классам и блокам МКБ-10 одним запросом.
+
+    Для каждого класса и блока - подзапрос COUNT по диапазону lft его
+    поддерева. Возвращает ненулевые [{code, name, level, count}] в
+    порядке дерева (класс, затем его блоки).
+    """
+    model, code_field, link_field, date_field = DIAGNOSIS_KINDS[kind]
+    queryset = _kind_queryset(kind, date_from, date_to, queryset)
+    # COUNT как Func, а не агрегат: без GROUP BY подзапрос возвращает одно число
+    subtree_count = queryset.filter(**{
+        f'{link_field}__lft__gte': OuterRef('lft'),
+        f'{link_field}__lft__lte': OuterRef('rgt'),
+    }).order_by().annotate(count=Func(F('pk'), function='COUNT')).values('count')
+    rows = Diagnosis.objects.groups().order_by('lft').annotate(
+        count=Subquery(subtree_count, output_field=IntegerField()),
+    ).values('code', 'name', 'level', 'count')
+    return [row for row in rows if row['count']]
@@ -0,0 +1,352 @@
+"""Индекс справочника МКБ-10 в памяти процесса для автодополнения диагнозов.
+
+Справочник небольшой и почти не меняется, поэтому автодополнение не ходит
+в БД: каждый процесс при первом обращении строит индекс - отсортированный
+массив кодов (поиск по началу кода бинарным поиском) и префиксное дерево
+слов наименований (буква за буквой до списка диагнозов, в наименовании
+которых есть слово с таким началом).
+
+Если точных совпадений мало, поиск нечеткий: слова наименований и описаний
+сравниваются с запросом по общим триграммам (как pg_trgm), так что
+находятся слова с опечатками. Запрос, набранный в английской раскладке
+("ibpjahtybz"), дополнительно ищется в русской, а в кодах кириллические
+буквы, похожие на латинские (Ф, А, О), заменяются латинскими.
+
+Изменения справочника увеличивают версию в БД (DiagnosisVersion, сигналы
+Diagnosis), и процессы перестраивают индекс при следующем запросе. Версия
+служит и ETag ответов API: браузер повторяет запрос условно и получает 304.
+Версия хранится в БД, а не в кэше: кэш по умолчанию у каждого процесса
+свой, и процессы расходились бы в версии и ETag.
+
+Для поиска в браузере индекс отдает пакет справочника - сжатый JSON
+[[код, наименование], ...] по адресу с хэшем его содержимого, который
+браузер кэширует как неизменяемый (ApiDiagnosisBundleView). Хэш зависит
+только от содержимого, поэтому все процессы дают один адрес и после
+пересоздания БД старый пакет из кэша браузера не подставится; по адресу
+устаревшего пакета - перенаправление на текущий.
+"""
+import gzip
+import hashlib
+import heapq
+import json
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from functools import cached_property
+
+from django.db.models import F
+from django.urls import reverse
+
+from .mkb import fold_mkb_code, normalize_mkb_code
+from .models import Diagnosis, DiagnosisVersion
+
+try:
+    import brotli
+except ImportError:  # сжатие brotli необязательно, gzip есть всегда
+    brotli = None
+
+AUTOCOMPLETE_LIMIT = 10
+# Сжатия пакета справочника в порядке предпочтения
+BUNDLE_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Ключ списка диагнозов в узле дерева (буквы - непустые строки)
+POSTINGS = ''
+WORD_RE = re.compile(r'\w+')
+CODE_RE = re.compile(r'^[A-Z]\d')
+CYRILLIC_RE = re.compile('[а-яё]')
+LATIN_RE = re.compile('[a-z]')
+
+# Клавиши английской раскладки и буквы русской на тех же клавишах
+LATIN_KEYS = "qwertyuiop[]asdfghjkl;'zxcvbnm,./`"
+CYRILLIC_KEYS = 'йцукенгшщзхъфывапролджэячсмитьбю.ё'
+TO_CYRILLIC = str.maketrans(LATIN_KEYS + '{}:"<>?~', CYRILLIC_KEYS + 'хъжэбю,ё')
+TO_LATIN = str.maketrans(CYRILLIC_KEYS, LATIN_KEYS)
+# Латинские буквы, похожие на русские, в словах, набранных вперемешку
+WORD_HOMOGLYPHS = str.maketrans('aceopxyk', 'асеорхук')
+
+# Нечеткий поиск: слова запроса короче не сравниваются по триграммам
+FUZZY_MIN_WORD = 3
+# Доля триграмм слова запроса, которые должны найтись в слове справочника
+FUZZY_THRESHOLD = 0.5
+# Совпадение в описании весит меньше, чем в наименовании
+DESCRIPTION_WEIGHT = 0.8
+
+_index = None
+_lock = threading.Lock()
+
+
+def normalize_words(text):
+    """Слова текста в нижнем регистре, ё -> е"""
+    return WORD_RE.findall((text or '').lower().replace('ё', 'е'))
+
+
+def trigrams(word, complete=True):
+    """Триграммы слова с пробелами по краям, как у pg_trgm.
+
+    Для слова запроса (complete=False) конец не добавляется: слово может
+    быть недописано.
+    """
+    padded = f'  {word} ' if complete else f'  {word}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def query_variants(query):
+    """Варианты текста запроса: как введен и, если он набран латиницей, в русской раскладке"""
+    text = (query or '').lower()
+    variants = [text]
+    if LATIN_RE.search(text) and not CYRILLIC_RE.search(text):
+        variants.append(text.translate(TO_CYRILLIC))
+    return variants
+
+
+def query_codes(query):
+    """Коды, которые мог иметь в виду запрос: как введен, латиницей, из русской раскладки"""
+    codes = [normalize_mkb_code(query)]
+    for code in (fold_mkb_code(query), fold_mkb_code((query or '').lower().translate(TO_LATIN))):
+        if CODE_RE.match(code) and code not in codes:
+            codes.append(code)
+    return [code for code in codes if code]
+
+
+def fuzzy_words(text):
+    """Слова для нечеткого поиска: набранные вперемешку латиницей и кириллицей - кириллицей"""
+    words = []
+    for word in normalize_words(text):
+        if CYRILLIC_RE.search(word) and LATIN_RE.search(word):
+            word = word.translate(WORD_HOMOGLYPHS)
+        if len(word) >= FUZZY_MIN_WORD:
+            words.append(word)
+    return words
+
+
+def get_version():
+    """Текущая версия справочника: один запрос по первичному ключу"""
+    version = DiagnosisVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+    if version is None:
+        version = DiagnosisVersion.objects.get_or_create(pk=1)[0].version
+    return version
+
+
+def bump_version():
+    """Помечает индексы всех процессов устаревшими"""
+    if not DiagnosisVersion.objects.filter(pk=1).update(version=F('version') + 1, bundle_digest=''):
+        DiagnosisVersion.objects.get_or_create(pk=1, defaults={'version': 2})
+
+
+class DiagnosisIndex:
+    """Отсортированные коды и префиксное дерево слов наименований"""
+
+    def __init__(self, version, rows):
+        self.version = version
+        # Ответы API готовятся один раз при построении
+        self.results = []
+        self.codes = []
+        self.trie = {}
+        # Словарь слов наименований и описаний для нечеткого поиска
+        self.words = []
+        self.word_names = []
+        self.word_descriptions = []
+        word_numbers = {}
+        rows = sorted(rows, key=lambda row: normalize_mkb_code(row[0]))
+        for number, (code, name, description) in enumerate(rows):
+            self.results.append({
+                'id': code,
+                'text': f'{code} - {name}',
+                'code': code,
+                'name': name,
+                'description': description[:100] if description else '',
+            })
+            self.codes.append(normalize_mkb_code(code))
+            for word in set(normalize_words(name)):
+                node = self.trie
+                for char in word:
+                    node = node.setdefault(char, {})
+                    postings = node.setdefault(POSTINGS, [])
+                    # Слова одного диагноза с общим началом дают его номер один раз
+                    if not postings or postings[-1] != number:
+                        postings.append(number)
+
+            name_words = set(normalize_words(name))
+            for words, postings in ((name_words, self.word_names),
+                                    (set(normalize_words(description)) - name_words, self.word_descriptions)):
+                for word in words:
+                    if word not in word_numbers:
+                        word_numbers[word] = len(self.words)
+                        self.words.append(word)
+                        self.word_names.append([])
+                        self.word_descriptions.append([])
+                    postings[word_numbers[word]].append(number)
+
+        # Триграмма -> номера слов словаря, в которых она есть
+        self.trigrams = defaultdict(list)
+        self.word_sizes = []
+        for word_number, word in enumerate(self.words):
+            grams = trigrams(word)
+            self.word_sizes.append(len(grams))
+            for gram in grams:
+                self.trigrams[gram].append(word_number)
+        self.trigrams = dict(self.trigrams)
+
+    def _code_prefix(self, prefix):
+        """Номера диагнозов, код которых начинается с prefix (по порядку кодов)"""
+        number = bisect_left(self.codes, prefix)
+        while number < len(self.codes) and self.codes[number].startswith(prefix):
+            yield number
+            number += 1
+
+    def _word_prefix(self, prefix):
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        return node[POSTINGS]
+
+    def _similar_words(self, word):
+        """{номер слова словаря: сходство} для слов, похожих на word.
+
+        Сходство - доля триграмм word, найденных в слове, с небольшой
+        поправкой на длину слова (при равной доле выше короткие слова).
+        """
+        grams = trigrams(word, complete=False)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.trigrams.get(gram, ()))
+        needed = FUZZY_THRESHOLD * len(grams)
+        return {
+            word_number: (count + count / (len(grams) + self.word_sizes[word_number] - count)) / (len(grams) + 1)
+            for word_number, count in shared.items()
+            if count >= needed
+        }
+
+    def _fuzzy(self, words):
+        """{номер диагноза: оценка} для диагнозов, где на каждое слово запроса есть похожее слово"""
+        scores = None
+        for word in words:
+            best = {}
+            for word_number, similarity in self._similar_words(word).items():
+                for postings, weight in ((self.word_names[word_number], 1),
+                                         (self.word_descriptions[word_number], DESCRIPTION_WEIGHT)):
+                    score = similarity * weight
+                    for number in postings:
+                        if best.get(number, 0) < score:
+                            best[number] = score
+            if scores is None:
+                scores = best
+            else:
+                scores = {number: score + best[number] for number, score in scores.items() if number in best}
+            if not scores:
+                break
+        return scores or {}
+
+    def _exact_words(self, words, found, seen, limit):
+        postings = sorted((self._word_prefix(word) for word in words), key=len)
+        others = [set(numbers) for numbers in postings[1:]]
+        for number in postings[0]:
+            if len(found) == limit:
+                break
+            if number not in seen and all(number in numbers for numbers in others):
+                found.append(number)
+                seen.add(number)
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """Диагнозы по запросу, в порядке:
+
+        * код начинается с query (в том числе с исправленными буквами кода);
+        * в наименовании есть слова, начинающиеся с каждого слова query
+          (как введен, затем в русской раскладке);
+        * нечетко: на каждое слово query есть похожее слово в наименовании
+          или описании - по убыванию сходства.
+        """
+        found = []
+        seen = set()
+        for code in query_codes(query):
+            for number in self._code_prefix(code):
+                if len(found) == limit:
+                    break
+                if number not in seen:
+                    found.append(number)
+                    seen.add(number)
+
+        variants = query_variants(query)
+        for text in variants:
+            words = normalize_words(text)
+            if words and len(found) < limit:
+                self._exact_words(words, found, seen, limit)
+
+        if len(found) < limit:
+            scores = {}
+            for text in variants:
+                words = fuzzy_words(text)
+                if words:
+                    for number, score in self._fuzzy(words).items():
+                        if number not in seen and scores.get(number, 0) < score:
+                            scores[number] = score
+            found.extend(heapq.nsmallest(limit - len(found), scores, key=lambda number: (-scores[number], number)))
+        return [self.results[number] for number in found]
+
+    def bundle_payload(self):
+        """JSON пакета для браузера: [[код, наименование], ...] в порядке кодов"""
+        items = [[result['code'], result['name']] for result in self.results]
+        return json.dumps(items, ensure_ascii=False, separators=(',', ':')).encode()
+
+    @cached_property
+    def bundles(self):
+        """Пакет справочника без сжатия ('') и в каждом из BUNDLE_ENCODINGS; готовится один раз"""
+        payload = self.bundle_payload()
+        bundles = {'': payload, 'gzip': gzip.compress(payload, 9, mtime=0)}
+        if brotli is not None:
+            bundles['br'] = brotli.compress(payload, quality=11)
+        return bundles
+
+    @cached_property
+    def bundle_digest(self):
+        """Хэш содержимого пакета - часть его адреса"""
+        return hashlib.sha256(self.bundles['']).hexdigest()[:12]
+
+    def bundle(self, accept_encoding=''):
+        """(содержимое, сжатие) пакета для заголовка Accept-Encoding браузера"""
+        accepted = {item.split(';')[0].strip() for item in accept_encoding.lower().split(',')}
+        for encoding in BUNDLE_ENCODINGS:
+            if encoding in accepted:
+                return self.bundles[encoding], encoding
+        return self.bundles[''], ''
+
+
+def get_index():
+    """Индекс текущей версии справочника; строится при первом обращении и после изменений"""
+    global _index
+    version = get_version()
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                rows = Diagnosis.objects.codes().values_list('code', 'name', 'description')
+                _index = DiagnosisIndex(version, list(rows))
+            index = _index
+    return index
+
+
+def search_diagnoses(query, limit=AUTOCOMPLETE_LIMIT):
+    """Автодополнение диагнозов по началу кода или слов наименования"""
+    return get_index().search(query, limit)
+
+
+def diagnoses_etag(request, *args, **kwargs):
+    """ETag ответа автодополнения: версия справочника (запрос - в URL)"""
+    return f'diagnoses-{get_version()}'
+
+
+def bundle_url():
+    """URL пакета справочника по хэшу содержимого.
+
+    Хэш текущей версии хранится в DiagnosisVersion: форма получает адрес
+    одним запросом, индекс строится, только если пакет этой версии еще
+    никто не собирал.
+    """
+    digest = DiagnosisVersion.objects.filter(pk=1).values_list('bundle_digest', flat=True).first()
+    if not digest:
+        index = get_index()
+        digest = index.bundle_digest
+        DiagnosisVersion.objects.filter(pk=1, version=index.version).update(bundle_digest=digest)
+    return reverse('patients:api_diagnosis_bundle', args=[digest])
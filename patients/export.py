@@ -0,0 +1,370 @@
+"""Экспорт пациентов в файлы.
+
+Значения читаются из БД порциями через ``values_list().iterator()``
+(серверный курсор на PostgreSQL) и обрабатываются по колонкам в pandas,
+поэтому потоковые форматы не держат всю выборку в памяти.
+"""
+import csv
+import io
+import json
+import tempfile
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat, Trim
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+from .models import Patient
+
+# Размер порции при чтении пациентов из БД и обработке в pandas
+EXPORT_CHUNK_SIZE = 5000
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLSX_COLUMN_WIDTH = 20
+
+# Заголовки колонок по группам полей в порядке вывода
+EXPORT_GROUPS = {
+    'basic': [
+        'Номер истории болезни', 'Фамилия', 'Имя', 'Отчество', 'Пол',
+        'Дата рождения', 'Возраст', 'Место рождения', 'Гражданство', 'Адрес',
+        'Телефон',
+    ],
+    'documents': [
+        'Серия паспорта', 'Номер паспорта', 'Кем выдан', 'Дата выдачи', 'ИНН',
+        'Страховой полис',
+    ],
+    'hospitalization': [
+        'Дата поступления', 'Откуда поступил', 'Кем доставлен',
+        'Диагноз направившего учреждения', 'Диагноз при поступлении',
+        'Код МКБ при поступлении', 'Лечащий врач',
+    ],
+    'discharge': [
+        'Дата выписки', 'Диагноз при выписке', 'Код МКБ при выписке',
+        'Исход заболевания', 'Трудоспособность', 'Статус',
+    ],
+    'notes': [
+        'Примечания', 'Дата создания', 'Создал',
+    ],
+}
+
+
+# Поля модели, из которых собираются колонки каждой группы
+EXPORT_FIELDS = {
+    'basic': [
+        'case_number', 'last_name', 'first_name', 'middle_name', 'gender',
+        'birth_date', 'birth_place', 'citizenship', 'address', 'phone',
+    ],
+    'documents': [
+        'passport_series', 'passport_number', 'passport_issued_by',
+        'passport_issue_date', 'inn', 'insurance_policy',
+    ],
+    'hospitalization': [
+        'admission_date', 'admission_from', 'delivered_by', 'referral_diagnosis',
+        'admission_diagnosis', 'admission_mkb_code', 'attending_physician_name',
+    ],
+    'discharge': [
+        'discharge_date', 'discharge_diagnosis', 'discharge_mkb_code',
+        'outcome', 'work_capacity', 'status',
+    ],
+    'notes': [
+        'notes', 'created_at', 'created_by_name',
+    ],
+}
+
+# Имена пользователей, которые собираются в SQL через JOIN
+USER_NAME_FIELDS = {
+    'attending_physician_name': 'attending_physician',
+    'created_by_name': 'created_by',
+}
+
+
+def export_headers(include_fields):
+    """Заголовки колонок для выбранных групп полей"""
+    return [
+        header
+        for group, headers in EXPORT_GROUPS.items()
+        if group in include_fields
+        for header in headers
+    ]
+
+
+def export_filename(extension):
+    return f'patients_export_{timezone.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+
+
+def _choice_labels(field_name):
+    """Словарь код -> подпись для поля с choices"""
+    return {value: str(label) for value, label in Patient._meta.get_field(field_name).flatchoices}
+
+
+def _display(series, field_name):
+    """Подписи choices; неизвестные коды выводятся как есть, как в get_FOO_display"""
+    return series.map(_choice_labels(field_name)).fillna(series)
+
+
+def _text(series):
+    return series.fillna('')
+
+
+def _text_or(series, default):
+    """Текст или default вместо пустого значения (как value or default)"""
+    text = _text(series)
+    return text.where(text != '', default)
+
+
+# Перестановка символов ISO-строки numpy ("ГГГГ-ММ-ДДTЧЧ:ММ") в "ДД.ММ.ГГГГ ЧЧ:ММ"
+_ISO_TO_RU = [8, 9, 4, 5, 6, 7, 0, 1, 2, 3, 10, 11, 12, 13, 14, 15]
+
+
+def _format_dates(values, width):
+    """Форматирует колонку дат без strftime на каждое значение.
+
+    numpy переводит даты в ISO-строки одной операцией, после чего символы
+    переставляются как в массиве; пустые значения становятся пустой строкой.
+    """
+    unit = 'm' if width > 10 else 'D'
+    iso = np.datetime_as_string(values.to_numpy(dtype=f'datetime64[{unit}]'))
+    chars = iso.astype(f'U{width}').view('U1').reshape(len(iso), width)[:, _ISO_TO_RU[:width]].copy()
+    chars[:, [2, 5]] = '.'
+    if width > 10:
+        chars[:, 10] = ' '
+    return pd.Series(
+        np.where(values.isna().to_numpy(), '', chars.view(f'U{width}').ravel()),
+        index=values.index,
+    )
+
+
+def _date(series):
+    return _format_dates(pd.to_datetime(series), 10)
+
+
+def _datetime(series):
+    """Время выводится в UTC, как его возвращает БД (без перевода в локальный пояс)"""
+    return _format_dates(pd.to_datetime(series, utc=True).dt.tz_localize(None), 16)
+
+
+def _optional_display(series, field_name):
+    """Подпись choices или пустая строка, если значение не заполнено"""
+    return _display(series, field_name).where(_text(series) != '', '')
+
+
+def _full_name(relation):
+    """То же, что User.get_full_name(), но на стороне БД; пустая строка, если пользователя нет"""
+    return Trim(Concat(
+        f'{relation}__first_name', Value(' '), f'{relation}__last_name',
+        output_field=CharField(),
+    ))
+
+
+def _age(born, today):
+    before_birthday = (born.dt.month > today.month) | (
+        (born.dt.month == today.month) & (born.dt.day > today.day)
+    )
+    return today.year - born.dt.year - before_birthday.astype(int)
+
+
+def _build_columns(frame, include_fields):
+    """Колонки экспорта по сырым значениям полей"""
+    columns = {}
+
+    if 'basic' in include_fields:
+        birth_date = pd.to_datetime(frame['birth_date'])
+        columns.update({
+            'Номер истории болезни': frame['case_number'],
+            'Фамилия': frame['last_name'],
+            'Имя': frame['first_name'],
+            'Отчество': _text(frame['middle_name']),
+            'Пол': _display(frame['gender'], 'gender'),
+            'Дата рождения': _format_dates(birth_date, 10),
+            'Возраст': _age(birth_date, timezone.now().date()),
+            'Место рождения': _text(frame['birth_place']),
+            'Гражданство': _text_or(frame['citizenship'], 'РФ'),
+            'Адрес': frame['address'],
+            'Телефон': _text(frame['phone']),
+        })
+
+    if 'documents' in include_fields:
+        columns.update({
+            'Серия паспорта': _text(frame['passport_series']),
+            'Номер паспорта': _text(frame['passport_number']),
+            'Кем выдан': _text(frame['passport_issued_by']),
+            'Дата выдачи': _date(frame['passport_issue_date']),
+            'ИНН': _text(frame['inn']),
+            'Страховой полис': _text(frame['insurance_policy']),
+        })
+
+    if 'hospitalization' in include_fields:
+        columns.update({
+            'Дата поступления': _datetime(frame['admission_date']),
+            'Откуда поступил': _text(frame['admission_from']),
+            'Кем доставлен': _text(frame['delivered_by']),
+            'Диагноз направившего учреждения': _text(frame['referral_diagnosis']),
+            'Диагноз при поступлении': frame['admission_diagnosis'],
+            'Код МКБ при поступлении': _text(frame['admission_mkb_code']),
+            'Лечащий врач': frame['attending_physician_name'],
+        })
+
+    if 'discharge' in include_fields:
+        columns.update({
+            'Дата выписки': _datetime(frame['discharge_date']),
+            'Диагноз при выписке': _text(frame['discharge_diagnosis']),
+            'Код МКБ при выписке': _text(frame['discharge_mkb_code']),
+            'Исход заболевания': _optional_display(frame['outcome'], 'outcome'),
+            'Трудоспособность': _optional_display(frame['work_capacity'], 'work_capacity'),
+            'Статус': _display(frame['status'], 'status'),
+        })
+
+    if 'notes' in include_fields:
+        columns.update({
+            'Примечания': _text(frame['notes']),
+            'Дата создания': _datetime(frame['created_at']),
+            'Создал': frame['created_by_name'],
+        })
+
+    return columns
+
+
+def export_fields(include_fields):
+    """Поля модели, которые нужно выбрать из БД для выбранных групп"""
+    return [
+        field
+        for group, fields in EXPORT_FIELDS.items()
+        if group in include_fields
+        for field in fields
+    ]
+
+
+def iter_export_rows(patients, include_fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """Строки экспорта (списки значений в порядке export_headers).
+
+    Из БД читаются только нужные колонки через values_list, имена врача
+    и автора приходят через JOIN, а подписи choices и даты
+    обрабатываются по колонкам для целой порции строк.
+    """
+    headers = export_headers(include_fields)
+    fields = export_fields(include_fields)
+    if not fields:
+        return
+    patients = patients.annotate(**{
+        name: _full_name(relation)
+        for name, relation in USER_NAME_FIELDS.items()
+        if name in fields
+    })
+    records = patients.values_list(*fields).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        frame = pd.DataFrame.from_records(chunk, columns=fields)
+        columns = _build_columns(frame, include_fields)
+        yield from pd.DataFrame(columns, columns=headers).astype(object).values.tolist()
+
+
+def export_rows(patients, include_fields):
+    """Все строки экспорта в виде словарей заголовок -> значение (для JSON)"""
+    headers = export_headers(include_fields)
+    return [dict(zip(headers, row)) for row in iter_export_rows(patients, include_fields)]
+
+
+class Echo:
+    """Псевдо-файл для csv.writer: write() возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(patients, include_fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """CSV (UTF-8 с BOM для Excel) в виде последовательности байтовых блоков"""
+    headers = export_headers(include_fields)
+    if not headers:
+        return
+    writer = csv.writer(Echo())
+    # Заголовок отдаем сразу, не дожидаясь первой порции строк
+    yield ('\ufeff' + writer.writerow(headers)).encode('utf-8')
+    buffer = []
+    for number, row in enumerate(iter_export_rows(patients, include_fields, chunk_size), 1):
+        buffer.append(writer.writerow(row))
+        if number % chunk_size == 0:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def stream_csv(patients, include_fields):
+    """Потоковый ответ с CSV: память не зависит от размера выгрузки"""
+    response = StreamingHttpResponse(
+        iter_csv(patients, include_fields),
+        content_type='text/csv; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export_filename("csv")}"'
+    return response
+
+
+def write_csv(rows, headers, fileobj):
+    """Записывает строки в CSV (UTF-8 с BOM) в бинарный файл"""
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    if headers:
+        writer = csv.writer(text)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+
+def write_json(rows, headers, fileobj):
+    """Записывает строки в JSON-массив объектов, не собирая его целиком в памяти"""
+    text = io.TextIOWrapper(fileobj, encoding='utf-8')
+    text.write('[')
+    number = 0
+    for number, row in enumerate(rows, 1):
+        item = json.dumps(dict(zip(headers, row)), ensure_ascii=False, indent=2)
+        text.write(('\n  ' if number == 1 else ',\n  ') + item.replace('\n', '\n  '))
+    text.write('\n]' if number else ']')
+    text.flush()
+    text.detach()
+
+
+def write_xlsx(rows, headers, fileobj):
+    """Записывает строки (списки значений по headers) в XLSX в режиме write-only.
+
+    Строки добавляются целиком через ``append`` без адресации ячеек,
+    openpyxl сбрасывает их во временный файл, а не держит лист в памяти.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Пациенты')
+    # В write-only режиме ширину колонок задаем до первой строки
+    for col_num in range(1, len(headers) + 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = XLSX_COLUMN_WIDTH
+    if headers:
+        ws.append(headers)
+        for row in rows:
+            ws.append(row)
+    wb.save(fileobj)
+
+
+def stream_xlsx(patients, include_fields):
+    """Ответ с XLSX: файл собирается во временном файле и отдается потоком"""
+    spool = tempfile.TemporaryFile(suffix='.xlsx')
+    write_xlsx(iter_export_rows(patients, include_fields), export_headers(include_fields), spool)
+    spool.seek(0)
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=export_filename('xlsx'),
+        content_type=XLSX_CONTENT_TYPE,
+    )
+
+
+# Запись файла по формату: функция (rows, headers, fileobj)
+EXPORT_WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+    'json': write_json,
+}
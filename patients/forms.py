@@ -2,7 +2,10 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from .models import Patient, Diagnosis
+from django.urls import reverse
+from .diagnosis_index import bundle_url
+from .models import Patient, Diagnosis, ExportJob
+from .search import search_patients
 
 User = get_user_model()
 
@@ -62,6 +65,16 @@ class PatientForm(forms.ModelForm):
         # Убираем поле case_number из формы - оно генерируется автоматически
         if 'case_number' in self.fields:
             del self.fields['case_number']
+        
+        # Автодополнение кодов МКБ-10: по пакету справочника в браузере, при ошибке - через API
+        autocomplete = {
+            'data-autocomplete-url': reverse('patients:api_diagnoses'),
+            'data-autocomplete-bundle': bundle_url(),
+            'autocomplete': 'off',
+        }
+        for name in ('admission_mkb_code', 'discharge_mkb_code'):
+            if name in self.fields:
+                self.fields[name].widget.attrs.update(autocomplete)
     
     def save(self, commit=True):
         """Сохранение формы с указанием создателя"""
@@ -113,22 +126,60 @@ class PatientSearchForm(forms.Form):
             'placeholder': 'По дату'
         })
     )
+    
+    def filter_queryset(self, queryset):
+        """Применяет фильтры формы; при поиске добавляет аннотацию search_rank"""
+        data = self.cleaned_data
+        if data.get('query'):
+            queryset = search_patients(queryset, data['query'])
+        if data.get('status'):
+            queryset = queryset.filter(status=data['status'])
+        if data.get('gender'):
+            queryset = queryset.filter(gender=data['gender'])
+        if data.get('date_from'):
+            queryset = queryset.filter(admission_date__date__gte=data['date_from'])
+        if data.get('date_to'):
+            queryset = queryset.filter(admission_date__date__lte=data['date_to'])
+        return queryset
 
 
-class PatientExportForm(forms.Form):
-    """Форма выбора пациентов для экспорта"""
-    patients = forms.ModelMultipleChoiceField(
-        queryset=Patient.objects.all(),
-        widget=forms.CheckboxSelectMultiple,
-        required=False
-    )
+class PatientSelectionForm(PatientSearchForm):
+    """Выбор пациентов теми же фильтрами, что и в списке, и/или явным списком id"""
+    ids = forms.CharField(required=False, widget=forms.HiddenInput)
+    
+    def clean_ids(self):
+        value = self.cleaned_data['ids'].strip()
+        if not value:
+            return []
+        try:
+            return sorted({int(pk) for pk in value.split(',') if pk.strip()})
+        except ValueError:
+            raise ValidationError('Некорректный список пациентов')
     
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.cleaned_data.get('ids'):
+            queryset = queryset.filter(pk__in=self.cleaned_data['ids'])
+        return queryset
+    
+    @property
+    def filter_spec(self):
+        """Критерии выбора в виде данных формы, чтобы повторить выборку позже"""
+        data = self.cleaned_data
+        return {
+            'query': data.get('query') or '',
+            'status': data.get('status') or '',
+            'gender': data.get('gender') or '',
+            'date_from': data['date_from'].isoformat() if data.get('date_from') else '',
+            'date_to': data['date_to'].isoformat() if data.get('date_to') else '',
+            'ids': ','.join(str(pk) for pk in data.get('ids', [])),
+        }
+
+
+class PatientExportForm(PatientSelectionForm):
+    """Форма экспорта: выборка задается фильтрами, а не флажком на каждого пациента"""
     export_format = forms.ChoiceField(
-        choices=[
-            ('csv', 'CSV'),
-            ('xlsx', 'Excel (XLSX)'),
-            ('json', 'JSON'),
-        ],
+        choices=ExportJob.FORMAT_CHOICES,
         initial='xlsx',
         widget=forms.RadioSelect
     )
@@ -144,4 +195,4 @@ class PatientExportForm(forms.Form):
         initial=['basic', 'documents', 'hospitalization'],
         widget=forms.CheckboxSelectMultiple,
         required=False
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,151 @@
+"""Фоновые задачи экспорта.
+
+Очередью служит таблица ExportJob: задача создается в статусе PENDING,
+а исполнитель забирает ее атомарным UPDATE ... WHERE status = 'PENDING',
+поэтому одну задачу не выполнят дважды ни потоки одного процесса, ни
+разные воркеры gunicorn. Задачи выполняются в пуле потоков текущего
+процесса; задачи, потерянные при перезапуске, подбирает команда
+process_export_jobs.
+"""
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .export import EXPORT_CHUNK_SIZE, EXPORT_WRITERS, export_filename, export_headers, iter_export_rows
+from .forms import PatientSelectionForm
+from .models import ExportJob, Patient
+
+logger = logging.getLogger(__name__)
+
+# Задача без обновлений дольше этого времени считается прерванной
+STALE_JOB_TIMEOUT = timedelta(minutes=30)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Пул потоков экспорта, создается при первой задаче"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EXPORT_JOB_WORKERS,
+                thread_name_prefix='export',
+            )
+        return _executor
+
+
+def enqueue_export(user, filters, export_format, include_fields, total):
+    """Создает задачу экспорта и отправляет ее в пул после коммита.
+
+    filters - данные PatientSelectionForm (см. filter_spec): выборка
+    повторяется одним запросом при выполнении задачи.
+    """
+    job = ExportJob.objects.create(
+        user=user,
+        export_format=export_format,
+        include_fields=list(include_fields),
+        filters=filters,
+        total=total,
+    )
+    transaction.on_commit(lambda: get_executor().submit(run_job, job.pk))
+    return job
+
+
+def claim_job(job_id):
+    """Переводит задачу в RUNNING; False, если ее уже забрал другой исполнитель"""
+    return ExportJob.objects.filter(pk=job_id, status='PENDING').update(
+        status='RUNNING',
+        updated_at=timezone.now(),
+    ) == 1
+
+
+def _track_progress(job_id, rows):
+    """Пропускает строки, периодически сохраняя число обработанных"""
+    number = 0
+    for number, row in enumerate(rows, 1):
+        yield row
+        if number % EXPORT_CHUNK_SIZE == 0:
+            ExportJob.objects.filter(pk=job_id).update(processed=number, updated_at=timezone.now())
+
+
+def run_job(job_id):
+    """Выполняет задачу экспорта, если она еще в очереди"""
+    try:
+        if not claim_job(job_id):
+            return
+        # Заодно убираем устаревшие файлы, чтобы они не копились без cron
+        delete_expired_jobs()
+        job = ExportJob.objects.get(pk=job_id)
+        try:
+            _build_file(job)
+        except Exception as exc:
+            logger.exception('Ошибка фонового экспорта %s', job_id)
+            ExportJob.objects.filter(pk=job_id).update(
+                status='FAILED',
+                error=str(exc),
+                finished_at=timezone.now(),
+                expires_at=timezone.now() + timedelta(hours=settings.EXPORT_JOB_TTL_HOURS),
+            )
+    finally:
+        # У каждого потока пула свое подключение к БД
+        connection.close()
+
+
+def selected_patients(job):
+    """Пациенты задачи: ее критерии в пределах доступного пользователю"""
+    form = PatientSelectionForm(job.filters)
+    if not form.is_valid():
+        raise ValueError('Некорректные критерии выбора пациентов')
+    return form.filter_queryset(Patient.objects.visible_to(job.user))
+
+
+def _build_file(job):
+    patients = selected_patients(job)
+    headers = export_headers(job.include_fields)
+    rows = _track_progress(job.pk, iter_export_rows(patients, job.include_fields))
+
+    with tempfile.TemporaryFile() as spool:
+        EXPORT_WRITERS[job.export_format](rows, headers, spool)
+        spool.seek(0)
+        job.file.save(export_filename(job.export_format), File(spool), save=False)
+
+    now = timezone.now()
+    job.status = 'DONE'
+    job.processed = job.total
+    job.finished_at = now
+    job.expires_at = now + timedelta(hours=settings.EXPORT_JOB_TTL_HOURS)
+    job.save(update_fields=['file', 'status', 'processed', 'finished_at', 'expires_at', 'updated_at'])
+
+
+def fail_stale_jobs():
+    """Помечает ошибкой задачи, которые давно не обновлялись (воркер был остановлен)"""
+    now = timezone.now()
+    return ExportJob.objects.filter(
+        status='RUNNING',
+        updated_at__lt=now - STALE_JOB_TIMEOUT,
+    ).update(
+        status='FAILED',
+        error='Экспорт прерван',
+        finished_at=now,
+        expires_at=now + timedelta(hours=settings.EXPORT_JOB_TTL_HOURS),
+    )
+
+
+def delete_expired_jobs():
+    """Удаляет задачи с истекшим сроком хранения вместе с файлами"""
+    deleted = 0
+    for job in ExportJob.objects.filter(expires_at__lt=timezone.now()).iterator():
+        if job.file:
+            job.file.delete(save=False)
+        job.delete()
+        deleted += 1
+    return deleted
@@ -0,0 +1,98 @@
+import io
+import time
+import tracemalloc
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+from patients.export import EXPORT_GROUPS, export_headers, write_xlsx
+
+
+def legacy_xlsx(data, fileobj):
+    """Прежний способ: обычная книга и адресация каждой ячейки"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Пациенты"
+
+    if data:
+        headers = list(data[0].keys())
+        for col_num, header in enumerate(headers, 1):
+            col_letter = get_column_letter(col_num)
+            ws[f'{col_letter}1'] = header
+            ws.column_dimensions[col_letter].width = 20
+
+        for row_num, row_data in enumerate(data, 2):
+            for col_num, header in enumerate(headers, 1):
+                col_letter = get_column_letter(col_num)
+                ws[f'{col_letter}{row_num}'] = row_data.get(header, '')
+
+    wb.save(fileobj)
+
+
+def synthetic_rows(count, headers):
+    """Строки экспорта (списки значений по headers) без обращения к БД"""
+    for number in range(count):
+        row = {header: f'{header} {number}' for header in headers}
+        row['Возраст'] = number % 90
+        row['Дата рождения'] = date(1950 + number % 60, 1 + number % 12, 1 + number % 28).strftime('%d.%m.%Y')
+        row['Дата поступления'] = datetime(2025, 1 + number % 12, 1 + number % 28, 10, 30).strftime('%d.%m.%Y %H:%M')
+        yield [row[header] for header in headers]
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость и память экспорта в XLSX: прежний способ и write-only'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=100000,
+            help='Количество строк в выгрузке'
+        )
+        parser.add_argument(
+            '--skip-legacy',
+            action='store_true',
+            help='Не запускать прежний способ (он долгий на больших выгрузках)'
+        )
+        parser.add_argument(
+            '--memory',
+            action='store_true',
+            help='Дополнительно измерить пик памяти (отдельный медленный прогон)'
+        )
+
+    def _measure(self, label, func, memory=False):
+        buffer = io.BytesIO()
+        started = time.perf_counter()
+        func(buffer)
+        elapsed = time.perf_counter() - started
+        line = f'{label:<12} {elapsed:8.2f} с   файл {buffer.tell() / 1024 / 1024:6.1f} МБ'
+
+        if memory:
+            # tracemalloc сильно замедляет выполнение, поэтому память меряем отдельным прогоном
+            tracemalloc.start()
+            func(io.BytesIO())
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            line += f'   пик памяти {peak / 1024 / 1024:8.1f} МБ'
+
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        count = options['rows']
+        headers = export_headers(list(EXPORT_GROUPS))
+        self.stdout.write(f'Строк: {count}, колонок: {len(headers)}')
+
+        if not options['skip_legacy']:
+            # Прежний код получал готовый список словарей
+            self._measure(
+                'legacy',
+                lambda f: legacy_xlsx([dict(zip(headers, row)) for row in synthetic_rows(count, headers)], f),
+                options['memory'],
+            )
+        self._measure(
+            'write-only',
+            lambda f: write_xlsx(synthetic_rows(count, headers), headers, f),
+            options['memory'],
+        )
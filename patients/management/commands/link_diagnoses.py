@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from patients.diagnoses import DIAGNOSIS_KIND_CHOICES, link_mkb_codes
+
+
+class Command(BaseCommand):
+    help = 'Связывает текстовые коды МКБ-10 пациентов и госпитализаций со справочником диагнозов (пакетами)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--relink',
+            action='store_true',
+            help='Пересвязать и уже связанные записи (после правки кодов справочника)'
+        )
+
+    def handle(self, *args, **options):
+        results = link_mkb_codes(relink=options['relink'])
+        labels = dict(DIAGNOSIS_KIND_CHOICES)
+        for kind, (linked, missing) in results.items():
+            self.stdout.write(f'{labels[kind]}: связано {linked}, нет в справочнике {missing}')
+        self.stdout.write(self.style.SUCCESS('Коды МКБ-10 связаны со справочником'))
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patients.diagnoses import link_mkb_codes
+from patients.mkb_loader import FORMATS, LOAD_BATCH_SIZE, load_file
+
+
+class Command(BaseCommand):
+    help = 'Загружает полный справочник МКБ-10 из выгрузки классификатора (JSON, JSON Lines, CSV, XML)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу выгрузки')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            help='Формат файла (по умолчанию - по расширению)'
+        )
+        parser.add_argument(
+            '--encoding',
+            default='utf-8-sig',
+            help='Кодировка JSON и CSV (например, cp1251 для выгрузок НСИ)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=LOAD_BATCH_SIZE,
+            help='Кодов в одном пакете записи'
+        )
+        parser.add_argument(
+            '--link',
+            action='store_true',
+            help='После загрузки связать коды пациентов и госпитализаций со справочником'
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            counts = load_file(
+                options['path'],
+                file_format=options['format'],
+                encoding=options['encoding'],
+                batch_size=options['batch_size'],
+            )
+        except (OSError, ValueError) as error:
+            raise CommandError(str(error))
+        self.stdout.write(self.style.SUCCESS(
+            f'Справочник загружен за {time.monotonic() - started:.1f} с: создано {counts["created"]}, '
+            f'обновлено {counts["updated"]}, без изменений {counts["unchanged"]}, пропущено {counts["skipped"]}'
+        ))
+
+        if options['link']:
+            for kind, (linked, missing) in link_mkb_codes().items():
+                self.stdout.write(f'{kind}: связано {linked}, нет в справочнике {missing}')
@@ -1,8 +1,8 @@
 import os
-import json
+
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from patients.models import Diagnosis
+
+from patients.mkb_loader import load_file
 
 
 class Command(BaseCommand):
@@ -23,34 +23,12 @@ class Command(BaseCommand):
             self.stderr.write(f"Файл не найден: {file_path}")
             return
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        created = 0
-        updated = 0
-        
-        with transaction.atomic():
-            for item in data:
-                if item['model'] == 'patients.diagnosis':
-                    code = item['fields']['code']
-                    name = item['fields']['name']
-                    description = item['fields'].get('description', '')
-                    
-                    obj, created_flag = Diagnosis.objects.update_or_create(
-                        code=code,
-                        defaults={
-                            'name': name,
-                            'description': description
-                        }
-                    )
-                    
-                    if created_flag:
-                        created += 1
-                    else:
-                        updated += 1
+        # Потоковый разбор и пакетная запись, см. patients/mkb_loader.py
+        counts = load_file(file_path, file_format='json')
         
         self.stdout.write(
             self.style.SUCCESS(
-                f'✅ Загружено диагнозов: создано {created}, обновлено {updated}'
+                f'✅ Загружено диагнозов: создано {counts["created"]}, обновлено {counts["updated"]}, '
+                f'без изменений {counts["unchanged"]}'
             )
-        )
\ No newline at end of file
+        )
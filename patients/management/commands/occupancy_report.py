@@ -0,0 +1,59 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patients.occupancy import default_period, occupancy_report
+
+
+class Command(BaseCommand):
+    help = 'Отчет о занятости коек и длительности госпитализации за период'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date-from',
+            type=date.fromisoformat,
+            help='Начало периода (ГГГГ-ММ-ДД), по умолчанию год назад'
+        )
+        parser.add_argument(
+            '--date-to',
+            type=date.fromisoformat,
+            help='Конец периода (ГГГГ-ММ-ДД), по умолчанию сегодня'
+        )
+        parser.add_argument(
+            '--census-csv',
+            type=str,
+            help='Сохранить занятость по дням и отделениям в CSV'
+        )
+
+    def handle(self, *args, **options):
+        default_from, default_to = default_period(365)
+        date_from = options['date_from'] or default_from
+        date_to = options['date_to'] or default_to
+        if date_from > date_to:
+            raise CommandError('Начало периода позже конца')
+
+        report = occupancy_report(date_from, date_to)
+        self.stdout.write(f'Период: {date_from:%d.%m.%Y} - {date_to:%d.%m.%Y}')
+
+        self.stdout.write('\nЗанятость коек (средняя / максимум / на конец периода / койко-дни):')
+        for row in report['census_summary']:
+            self.stdout.write(
+                f"  {row['department']:<30} {row['mean']:8.1f} {row['max']:6} {row['current']:6} {row['bed_days']:9}"
+            )
+
+        self.stdout.write('\nДлительность госпитализации, койко-дней (эпизодов / среднее / медиана / p90 / максимум):')
+        for row in report['los_summary']:
+            self.stdout.write(
+                f"  {row['department']:<30} {row['episodes']:6} {row['mean']:8.1f} {row['p50']:8.1f} "
+                f"{row['p90']:8.1f} {row['max']:6}"
+            )
+
+        self.stdout.write('\nРаспределение по длительности:')
+        for label, count in report['los_distribution']:
+            self.stdout.write(f'  {label:<12} {count}')
+
+        if options['census_csv']:
+            report['census'].to_csv(
+                options['census_csv'], index_label='Дата', date_format='%d.%m.%Y', encoding='utf-8-sig'
+            )
+            self.stdout.write(self.style.SUCCESS(f"Занятость по дням сохранена: {options['census_csv']}"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from patients.jobs import delete_expired_jobs, fail_stale_jobs, run_job
+from patients.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи экспорта из очереди и удаляет устаревшие файлы (для cron или после перезапуска)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--cleanup-only',
+            action='store_true',
+            help='Только удалить устаревшие задачи, не выполняя очередь'
+        )
+
+    def handle(self, *args, **options):
+        stale = fail_stale_jobs()
+        deleted = delete_expired_jobs()
+        self.stdout.write(f'Прерванных задач: {stale}, удалено устаревших: {deleted}')
+
+        if options['cleanup_only']:
+            return
+
+        pending = list(ExportJob.objects.filter(status='PENDING').order_by('created_at').values_list('pk', flat=True))
+        for job_id in pending:
+            run_job(job_id)
+        self.stdout.write(self.style.SUCCESS(f'Обработано задач из очереди: {len(pending)}'))
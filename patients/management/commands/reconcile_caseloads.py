@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from patients.caseload import reconcile_caseloads
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики нагрузки врачей по пациентам и исправляет расхождения (для cron)'
+
+    def handle(self, *args, **options):
+        fixed = reconcile_caseloads()
+        self.stdout.write(self.style.SUCCESS(f'Исправлено строк счетчиков: {fixed}'))
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from patients.readmissions import refresh_readmissions
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает повторные госпитализации по всем эпизодам одним запросом (после миграции или смены окна)'
+
+    def handle(self, *args, **options):
+        updated = refresh_readmissions()
+        self.stdout.write(self.style.SUCCESS(
+            f'Окно {settings.READMISSION_WINDOW_DAYS} дн.: обновлено эпизодов {updated}'
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from patients.rollups import refresh_daily_rollups
+
+
+class Command(BaseCommand):
+    help = 'Обновляет витрину DailyPatientRollup по пациентам, измененным с прошлого запуска (для cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Пересобрать витрину целиком (после массовых правок через QuerySet.update())'
+        )
+
+    def handle(self, *args, **options):
+        changed, deleted = refresh_daily_rollups(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Витрина обновлена: изменено пациентов {changed}, удалено {deleted}'
+        ))
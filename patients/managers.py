@@ -0,0 +1,213 @@
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .mkb import rebuild_mkb_tree
+
+
+def _flag(condition):
+    """Булево выражение CASE WHEN condition THEN TRUE ELSE FALSE"""
+    return Case(When(condition, then=Value(True)), default=Value(False), output_field=BooleanField())
+
+
+class PatientQuerySet(models.QuerySet):
+    """QuerySet пациентов с вычислением прав доступа на стороне БД"""
+
+    def visible_to(self, user):
+        """Пациенты, которых пользователь может просматривать: врач - только своих"""
+        if user.is_administrator or user.has_perm('patients.view_all_patients'):
+            return self
+        if user.is_doctor:
+            return self.filter(attending_physician=user)
+        return self
+
+    def with_permissions(self, user):
+        """Аннотирует can_edit, can_delete и can_discharge для пользователя.
+
+        Повторяет Patient.user_can_edit / user_can_delete для сохраненных
+        записей: администратор может все, врач - редактировать и выписывать
+        своих пациентов, остальные роли - ничего.
+        """
+        hospitalized = Q(status='HOSPITALIZED')
+        if user.is_administrator:
+            can_edit = Value(True, output_field=BooleanField())
+            can_discharge = _flag(hospitalized)
+        elif user.is_doctor:
+            own = Q(attending_physician_id=user.pk)
+            can_edit = _flag(own)
+            can_discharge = _flag(own & hospitalized)
+        else:
+            can_edit = Value(False, output_field=BooleanField())
+            can_discharge = Value(False, output_field=BooleanField())
+
+        return self.annotate(
+            can_edit=can_edit,
+            can_delete=Value(user.is_administrator, output_field=BooleanField()),
+            can_discharge=can_discharge,
+        )
+
+
+# Период эпизода для GiST-индекса (миграция 0008): выписка включительно,
+# без выписки - открытый диапазон; выписка раньше поступления не ломает daterange
+STAY_RANGE_SQL = (
+    'daterange({table}.admission_date, CASE WHEN {table}.discharge_date < {table}.admission_date '
+    "THEN {table}.admission_date ELSE {table}.discharge_date END, '[]')"
+)
+
+
+class HospitalizationQuerySet(models.QuerySet):
+    """QuerySet эпизодов госпитализации с выборкой на дату"""
+
+    def active_on(self, day, department=None):
+        """Эпизоды, в которых пациент был в отделении в день day (дни поступления и выписки включаются).
+
+        На PostgreSQL условие записано как daterange @> day и вместе с
+        отделением использует GiST-индекс (department, daterange): поиск
+        логарифмический по числу эпизодов. На остальных СУБД - диапазонные
+        условия по индексу (department, admission_date).
+        """
+        queryset = self if department is None else self.filter(department=department)
+        if connections[self.db].vendor == 'postgresql':
+            table = connections[self.db].ops.quote_name(self.model._meta.db_table)
+            return queryset.filter(RawSQL(
+                f'{STAY_RANGE_SQL.format(table=table)} @> %s::date',
+                [day],
+                output_field=BooleanField(),
+            ))
+        return queryset.filter(
+            Q(admission_date__lte=day),
+            Q(discharge_date__isnull=True) | Q(discharge_date__gte=day),
+        )
+
+
+class DiagnosisQuerySet(models.QuerySet):
+    """QuerySet справочника МКБ-10 с выборкой поддеревьев по границам lft/rgt"""
+
+    def subtree(self, node):
+        """Узел и все его потомки - один диапазон по индексу (lft, rgt)"""
+        return self.filter(node.subtree_q())
+
+    def ancestors(self, node):
+        """Узлы, в поддерево которых входит node (включая его самого), от класса вниз"""
+        return self.filter(lft__lte=node.lft, rgt__gte=node.rgt).order_by('lft')
+
+    def groups(self):
+        """Классы и блоки"""
+        return self.filter(level__in=['CHAPTER', 'BLOCK'])
+
+    def codes(self):
+        """Рубрики и подрубрики - коды, которые ставятся пациентам"""
+        return self.filter(level__in=['CATEGORY', 'SUBCATEGORY'])
+
+    def rebuild_tree(self):
+        """Пересчитывает дерево после изменения справочника; возвращает число узлов"""
+        return rebuild_mkb_tree(self.model)
+
+
+class CaseNumberSequenceManager(models.Manager):
+    """Счетчики номеров историй болезни по годам.
+
+    Номер выдается одним UPDATE ... RETURNING по строке счетчика года:
+    без сортировки истории болезни и без гонок между процессами и узлами.
+    """
+
+    def allocate(self, year, count=1):
+        """Резервирует count номеров за год; возвращает range номеров"""
+        last_value = self._increment(year, count)
+        if last_value is None:
+            self._start_year(year)
+            last_value = self._increment(year, count)
+        return range(last_value - count + 1, last_value + 1)
+
+    def next_case_number(self, year=None):
+        year = year or timezone.now().year
+        return self.model.format_case_number(year, self.allocate(year)[0])
+
+    def advance(self, case_number):
+        """Поднимает счетчик года до номера, заданного явно (импорт, перенос из архива).
+
+        Иначе счетчик позже выдал бы тот же номер. Номера не вида Год-Число
+        счетчик не затрагивают.
+        """
+        year, _, number = (case_number or '').partition('-')
+        if not (year.isdigit() and number.isdigit()):
+            return
+        year, number = int(year), int(number)
+        if not self._raise(year, number):
+            self._start_year(year)
+            self._raise(year, number)
+
+    def allocator(self, block_size=100):
+        """Выдача номеров блоками (hi/lo) для массового импорта (PatientResource в admin.py)"""
+        return CaseNumberAllocator(self, block_size)
+
+    def _increment(self, year, count):
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET last_value = last_value + %s WHERE year = %s RETURNING last_value',
+                [count, year],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _raise(self, year, number):
+        """last_value = max(last_value, number) одним UPDATE; False - счетчика года еще нет"""
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET last_value = CASE WHEN last_value < %s THEN %s ELSE last_value END '
+                'WHERE year = %s',
+                [number, number, year],
+            )
+            return cursor.rowcount > 0
+
+    def _start_year(self, year):
+        """Создает счетчик года, продолжая уже выданные номера"""
+        Patient = self.model._meta.apps.get_model('patients', 'Patient')
+        prefix = f'{year}-'
+        last_value = max(
+            (
+                int(case_number[len(prefix):])
+                for case_number in Patient.objects.filter(case_number__startswith=prefix)
+                .values_list('case_number', flat=True).iterator()
+                if case_number[len(prefix):].isdigit()
+            ),
+            default=0,
+        )
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(year=year, last_value=last_value)
+        except IntegrityError:
+            pass  # Счетчик уже создан параллельным запросом
+
+
+class CaseNumberAllocator:
+    """Номера историй болезни из заранее зарезервированного блока.
+
+    Счетчик в БД увеличивается сразу на block_size, дальше номера выдаются
+    из памяти. Невыданный остаток блока пропадает (в нумерации будут пропуски).
+    """
+
+    def __init__(self, sequences, block_size=100):
+        self.sequences = sequences
+        self.block_size = block_size
+        self._year = None
+        self._numbers = iter(())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        year = timezone.now().year
+        if year != self._year:
+            self._year = year
+            self._numbers = iter(())
+        number = next(self._numbers, None)
+        if number is None:
+            self._numbers = iter(self.sequences.allocate(year, self.block_size))
+            number = next(self._numbers)
+        return self.sequences.model.format_case_number(year, number)
@@ -0,0 +1,144 @@
+# Generated by Django 6.0 on 2026-10-17 01:30
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+FTS_TABLE = 'patients_patient_fts'
+NAME_FIELDS = ['last_name', 'first_name', 'middle_name']
+IDENTITY_FIELDS = ['case_number', 'passport_series', 'passport_number', 'inn', 'phone']
+
+TRIGGER_COLUMNS = ', '.join(NAME_FIELDS + IDENTITY_FIELDS + ['address'])
+FTS_COLUMNS = NAME_FIELDS + IDENTITY_FIELDS + ['address']
+
+# Индексы pg_trgm строятся по UPPER(col::text): именно такое выражение
+# Django генерирует для lookup'а icontains на PostgreSQL.
+TRGM_FIELDS = ['last_name'] + IDENTITY_FIELDS
+
+
+def _concat(prefix, fields):
+    return " || ' ' || ".join(f"coalesce({prefix}{field}, '')" for field in fields)
+
+
+def search_vector_sql(prefix=''):
+    # ФИО - вес A (русская морфология), документы - B, адрес - C
+    return (
+        f"setweight(to_tsvector('russian', {_concat(prefix, NAME_FIELDS)}), 'A') || "
+        f"setweight(to_tsvector('simple', {_concat(prefix, IDENTITY_FIELDS)}), 'B') || "
+        f"setweight(to_tsvector('russian', coalesce({prefix}address, '')), 'C')"
+    )
+
+
+POSTGRES_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f"""
+    CREATE OR REPLACE FUNCTION patients_patient_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := {search_vector_sql('NEW.')};
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE TRIGGER patients_patient_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF {TRIGGER_COLUMNS} ON patients_patient
+    FOR EACH ROW EXECUTE FUNCTION patients_patient_search_vector_update()
+    """,
+    f'UPDATE patients_patient SET search_vector = {search_vector_sql()}',
+    'CREATE INDEX patients_patient_search_vector_gin ON patients_patient USING gin (search_vector)',
+] + [
+    f'CREATE INDEX patients_patient_{field}_trgm ON patients_patient '
+    f'USING gin ((UPPER({field}::text)) gin_trgm_ops)'
+    for field in TRGM_FIELDS
+]
+
+POSTGRES_BACKWARD = [
+    f'DROP INDEX IF EXISTS patients_patient_{field}_trgm' for field in TRGM_FIELDS
+] + [
+    'DROP INDEX IF EXISTS patients_patient_search_vector_gin',
+    'DROP TRIGGER IF EXISTS patients_patient_search_vector_trigger ON patients_patient',
+    'DROP FUNCTION IF EXISTS patients_patient_search_vector_update()',
+]
+
+
+def _fts_values(prefix):
+    return ', '.join(f'{prefix}.{column}' for column in FTS_COLUMNS)
+
+
+SQLITE_FORWARD = [
+    f"""
+    CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        {', '.join(FTS_COLUMNS)},
+        content='patients_patient', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON patients_patient BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)})
+        VALUES (new.id, {_fts_values('new')});
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON patients_patient BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {', '.join(FTS_COLUMNS)})
+        VALUES ('delete', old.id, {_fts_values('old')});
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE ON patients_patient BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {', '.join(FTS_COLUMNS)})
+        VALUES ('delete', old.id, {_fts_values('old')});
+        INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)})
+        VALUES (new.id, {_fts_values('new')});
+    END
+    """,
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_ai',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_ad',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_au',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_FORWARD)
+    elif vendor == 'sqlite':
+        try:
+            _run(schema_editor, SQLITE_FORWARD)
+        except Exception:
+            # SQLite собран без FTS5 - поиск останется на icontains
+            _run(schema_editor, SQLITE_BACKWARD)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_BACKWARD)
+    elif vendor == 'sqlite':
+        _run(schema_editor, SQLITE_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый индекс'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
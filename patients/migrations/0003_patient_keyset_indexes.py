@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-17 01:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_patient_search_vector'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['admission_date', 'id'], name='patients_pa_admissi_154893_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['last_name', 'id'], name='patients_pa_last_na_2e4c8a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['birth_date', 'id'], name='patients_pa_birth_d_f4937c_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-17 05:40
+
+from django.db import migrations, models
+
+
+def ids_to_filters(apps, schema_editor):
+    """Список id из старых задач переносится в критерии выбора"""
+    ExportJob = apps.get_model('patients', 'ExportJob')
+    for job in ExportJob.objects.exclude(patient_ids=[]):
+        job.filters = {'ids': ','.join(str(pk) for pk in job.patient_ids)}
+        job.save(update_fields=['filters'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0004_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='filters',
+            field=models.JSONField(default=dict, verbose_name='Критерии выбора'),
+        ),
+        migrations.RunPython(ids_to_filters, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='patient_ids',
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0 on 2026-10-17 06:00
+
+from django.db import migrations, models
+
+
+def seed_sequences(apps, schema_editor):
+    """Счетчики продолжают уже выданные номера вида ГГГГ-NNNN"""
+    Patient = apps.get_model('patients', 'Patient')
+    CaseNumberSequence = apps.get_model('patients', 'CaseNumberSequence')
+    last_values = {}
+    for case_number in Patient.objects.values_list('case_number', flat=True).iterator():
+        year, _, number = case_number.partition('-')
+        if year.isdigit() and number.isdigit():
+            last_values[int(year)] = max(last_values.get(int(year), 0), int(number))
+    CaseNumberSequence.objects.bulk_create([
+        CaseNumberSequence(year=year, last_value=last_value)
+        for year, last_value in last_values.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0005_exportjob_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseNumberSequence',
+            fields=[
+                ('year', models.PositiveIntegerField(primary_key=True, serialize=False, verbose_name='Год')),
+                ('last_value', models.PositiveIntegerField(default=0, verbose_name='Последний номер')),
+            ],
+            options={
+                'verbose_name': 'Счетчик номеров историй болезни',
+                'verbose_name_plural': 'Счетчики номеров историй болезни',
+            },
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 6.0 on 2026-10-17 07:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0006_case_number_sequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyPatientRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('department', models.CharField(blank=True, max_length=100, verbose_name='Отделение')),
+                ('gender', models.CharField(blank=True, max_length=1, verbose_name='Пол')),
+                ('mkb_chapter', models.CharField(blank=True, max_length=5, verbose_name='Глава МКБ-10')),
+                ('status', models.CharField(max_length=20, verbose_name='Статус')),
+                ('admissions', models.PositiveIntegerField(default=0, verbose_name='Поступления')),
+                ('discharges', models.PositiveIntegerField(default=0, verbose_name='Выписки')),
+                ('deaths', models.PositiveIntegerField(default=0, verbose_name='Смерти')),
+            ],
+            options={
+                'verbose_name': 'Сводка по пациентам за день',
+                'verbose_name_plural': 'Сводки по пациентам за день',
+                'ordering': ['day'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientRollupState',
+            fields=[
+                ('patient_id', models.IntegerField(primary_key=True, serialize=False, verbose_name='ID пациента')),
+                ('admission_day', models.DateField(verbose_name='День поступления')),
+                ('discharge_day', models.DateField(blank=True, null=True, verbose_name='День выписки')),
+                ('died', models.BooleanField(default=False, verbose_name='Умер')),
+                ('department', models.CharField(blank=True, max_length=100, verbose_name='Отделение')),
+                ('attending_physician_id', models.IntegerField(blank=True, null=True, verbose_name='ID лечащего врача')),
+                ('gender', models.CharField(blank=True, max_length=1, verbose_name='Пол')),
+                ('mkb_chapter', models.CharField(blank=True, max_length=5, verbose_name='Глава МКБ-10')),
+                ('status', models.CharField(max_length=20, verbose_name='Статус')),
+            ],
+            options={
+                'verbose_name': 'Вклад пациента в витрину',
+                'verbose_name_plural': 'Вклады пациентов в витрину',
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False, verbose_name='Витрина')),
+                ('value', models.DateTimeField(blank=True, null=True, verbose_name='Обработаны изменения до')),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True, verbose_name='Обновлена')),
+            ],
+            options={
+                'verbose_name': 'Отметка обновления витрины',
+                'verbose_name_plural': 'Отметки обновления витрин',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['updated_at'], name='patients_pa_updated_efb345_idx'),
+        ),
+        migrations.AddField(
+            model_name='dailypatientrollup',
+            name='attending_physician',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Лечащий врач'),
+        ),
+        migrations.AddIndex(
+            model_name='dailypatientrollup',
+            index=models.Index(fields=['day'], name='patients_da_day_c659bf_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-17 08:05
+
+from django.db import migrations, models
+
+# Выражение должно совпадать с STAY_RANGE_SQL в patients/managers.py,
+# иначе планировщик не применит индекс к Hospitalization.objects.active_on()
+STAY_RANGE_SQL = (
+    'daterange(admission_date, CASE WHEN discharge_date < admission_date '
+    "THEN admission_date ELSE discharge_date END, '[]')"
+)
+
+POSTGRES_FORWARD = [
+    # btree_gist - для отделения (varchar) в одном GiST-индексе с диапазоном
+    'CREATE EXTENSION IF NOT EXISTS btree_gist',
+    f'CREATE INDEX patients_hospitalization_stay_gist ON patients_hospitalization '
+    f'USING gist (department, ({STAY_RANGE_SQL}))',
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX IF EXISTS patients_hospitalization_stay_gist',
+]
+
+
+def create_stay_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_FORWARD:
+            schema_editor.execute(statement)
+
+
+def drop_stay_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_BACKWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0007_daily_patient_rollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='hospitalization',
+            index=models.Index(fields=['department', 'admission_date'], name='patients_ho_departm_289236_idx'),
+        ),
+        migrations.RunPython(create_stay_index, drop_stay_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 08:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_hospitalization_stay_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hospitalization',
+            name='days_since_discharge',
+            field=models.IntegerField(blank=True, editable=False, null=True, verbose_name='Дней после предыдущей выписки'),
+        ),
+        migrations.AddField(
+            model_name='hospitalization',
+            name='is_readmission',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Повторная госпитализация'),
+        ),
+    ]
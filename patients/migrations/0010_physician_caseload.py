@@ -0,0 +1,86 @@
+# Generated by Django 6.0 on 2026-10-17 09:20
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.utils import timezone
+
+STATUS_FIELDS = {
+    'HOSPITALIZED': 'hospitalized',
+    'DISCHARGED': 'discharged',
+    'TRANSFERRED': 'transferred',
+    'DIED': 'died',
+}
+
+
+def seed_caseloads(apps, schema_editor):
+    """Начальные счетчики по текущим пациентам (дальше их ведут сигналы)"""
+    Patient = apps.get_model('patients', 'Patient')
+    PhysicianCaseload = apps.get_model('patients', 'PhysicianCaseload')
+    PhysicianDischargeDay = apps.get_model('patients', 'PhysicianDischargeDay')
+    patients = Patient.objects.filter(attending_physician__isnull=False).order_by()
+
+    PhysicianCaseload.objects.bulk_create([
+        PhysicianCaseload(physician_id=row.pop('attending_physician'), **row)
+        for row in patients.values('attending_physician').annotate(
+            total=Count('id'),
+            **{field: Count('id', filter=Q(status=status)) for status, field in STATUS_FIELDS.items()},
+        )
+    ])
+
+    days = {}
+    since = timezone.localdate() - timedelta(days=30)
+    for physician_id, discharged in patients.filter(discharge_date__date__gte=since).values_list(
+        'attending_physician', 'discharge_date'
+    ):
+        key = (physician_id, timezone.localtime(discharged).date())
+        days[key] = days.get(key, 0) + 1
+    PhysicianDischargeDay.objects.bulk_create([
+        PhysicianDischargeDay(physician_id=physician_id, day=day, count=count)
+        for (physician_id, day), count in days.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0009_hospitalization_readmission'),
+        ('users', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhysicianCaseload',
+            fields=[
+                ('physician', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='caseload', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Врач')),
+                ('total', models.IntegerField(default=0, verbose_name='Всего пациентов')),
+                ('hospitalized', models.IntegerField(default=0, verbose_name='Госпитализировано')),
+                ('discharged', models.IntegerField(default=0, verbose_name='Выписано')),
+                ('transferred', models.IntegerField(default=0, verbose_name='Переведено')),
+                ('died', models.IntegerField(default=0, verbose_name='Умерло')),
+            ],
+            options={
+                'verbose_name': 'Нагрузка врача',
+                'verbose_name_plural': 'Нагрузка врачей',
+            },
+        ),
+        migrations.CreateModel(
+            name='PhysicianDischargeDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('count', models.IntegerField(default=0, verbose_name='Выписано')),
+                ('physician', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Врач')),
+            ],
+            options={
+                'verbose_name': 'Выписки врача за день',
+                'verbose_name_plural': 'Выписки врачей по дням',
+                'constraints': [models.UniqueConstraint(fields=('physician', 'day'), name='patients_physician_discharge_day_unique')],
+            },
+        ),
+        migrations.RunPython(seed_caseloads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 6.0 on 2026-10-17 13:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def link_exact_codes(apps, schema_editor):
+    """Ссылки по кодам, совпадающим со справочником; остальные связывает команда link_diagnoses"""
+    Diagnosis = apps.get_model('patients', 'Diagnosis')
+    links = [
+        (apps.get_model('patients', 'Patient'), 'admission_mkb_code', 'admission_mkb'),
+        (apps.get_model('patients', 'Patient'), 'discharge_mkb_code', 'discharge_mkb'),
+        (apps.get_model('patients', 'Hospitalization'), 'mkb_code', 'mkb'),
+    ]
+    for model, code_field, link_field in links:
+        model.objects.exclude(**{code_field: ''}).update(**{
+            link_field: Subquery(Diagnosis.objects.filter(code=OuterRef(code_field)).values('pk')[:1])
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0010_physician_caseload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hospitalization',
+            name='mkb',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='hospitalizations', to='patients.diagnosis', verbose_name='Диагноз МКБ-10'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='admission_mkb',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='admitted_patients', to='patients.diagnosis', verbose_name='Диагноз МКБ-10 при поступлении'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='discharge_mkb',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='discharged_patients', to='patients.diagnosis', verbose_name='Диагноз МКБ-10 при выписке'),
+        ),
+        migrations.RunPython(link_exact_codes, migrations.RunPython.noop),
+    ]
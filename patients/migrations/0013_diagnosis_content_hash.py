@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-17 15:05
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def content_hash(name, description=''):
+    """Копия patients.mkb.content_hash на момент миграции"""
+    return hashlib.md5(f'{name}\x1f{description}'.encode(), usedforsecurity=False).hexdigest()
+
+
+def fill_hashes(apps, schema_editor):
+    Diagnosis = apps.get_model('patients', 'Diagnosis')
+    diagnoses = list(Diagnosis.objects.only('name', 'description'))
+    for diagnosis in diagnoses:
+        diagnosis.content_hash = content_hash(diagnosis.name, diagnosis.description)
+    Diagnosis.objects.bulk_update(diagnoses, ['content_hash'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0012_diagnosis_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosis',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, verbose_name='Хэш содержимого'),
+        ),
+        migrations.RunPython(fill_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-17 16:10
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_orphans(apps, schema_editor):
+    """Вклады пациентов, удаленных до миграции, помечаются для вычитания из витрины"""
+    Patient = apps.get_model('patients', 'Patient')
+    PatientRollupState = apps.get_model('patients', 'PatientRollupState')
+    PatientRollupState.objects.exclude(
+        patient_id__in=Patient.objects.values('pk')
+    ).update(deleted_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0013_diagnosis_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientrollupstate',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Пациент удален'),
+        ),
+        migrations.RunPython(mark_orphans, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0014_rollup_state_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiagnosisVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=1, verbose_name='Версия')),
+                ('changed_at', models.DateTimeField(auto_now=True, verbose_name='Изменен')),
+            ],
+            options={
+                'verbose_name': 'Версия справочника МКБ-10',
+                'verbose_name_plural': 'Версии справочника МКБ-10',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0015_diagnosis_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisversion',
+            name='bundle_digest',
+            field=models.CharField(blank=True, max_length=12, verbose_name='Хэш пакета справочника'),
+        ),
+    ]
@@ -0,0 +1,201 @@
+"""Классы (главы) и блоки МКБ-10 по диапазонам трехзначных рубрик.
+
+Справочник Diagnosis хранится деревом "класс -> блок -> рубрика ->
+подрубрика" в виде вложенных множеств: у каждого узла границы lft и rgt,
+потомки узла - записи с lft между его lft и rgt. Поддерево любого узла
+выбирается одним диапазонным условием по индексу, без сравнения строк
+кодов. Границы пересчитывает rebuild_mkb_tree() после загрузки справочника.
+"""
+import hashlib
+
+from django.db import connections
+
+# (глава, первая рубрика, последняя рубрика, наименование)
+MKB_CHAPTERS = [
+    ('I', 'A00', 'B99', 'Некоторые инфекционные и паразитарные болезни'),
+    ('II', 'C00', 'D48', 'Новообразования'),
+    ('III', 'D50', 'D89', 'Болезни крови, кроветворных органов и отдельные нарушения, вовлекающие иммунный механизм'),
+    ('IV', 'E00', 'E90', 'Болезни эндокринной системы, расстройства питания и нарушения обмена веществ'),
+    ('V', 'F00', 'F99', 'Психические расстройства и расстройства поведения'),
+    ('VI', 'G00', 'G99', 'Болезни нервной системы'),
+    ('VII', 'H00', 'H59', 'Болезни глаза и его придаточного аппарата'),
+    ('VIII', 'H60', 'H95', 'Болезни уха и сосцевидного отростка'),
+    ('IX', 'I00', 'I99', 'Болезни системы кровообращения'),
+    ('X', 'J00', 'J99', 'Болезни органов дыхания'),
+    ('XI', 'K00', 'K93', 'Болезни органов пищеварения'),
+    ('XII', 'L00', 'L99', 'Болезни кожи и подкожной клетчатки'),
+    ('XIII', 'M00', 'M99', 'Болезни костно-мышечной системы и соединительной ткани'),
+    ('XIV', 'N00', 'N99', 'Болезни мочеполовой системы'),
+    ('XV', 'O00', 'O99', 'Беременность, роды и послеродовой период'),
+    ('XVI', 'P00', 'P96', 'Отдельные состояния, возникающие в перинатальном периоде'),
+    ('XVII', 'Q00', 'Q99', 'Врожденные аномалии (пороки развития), деформации и хромосомные нарушения'),
+    ('XVIII', 'R00', 'R99', 'Симптомы, признаки и отклонения от нормы, не классифицированные в других рубриках'),
+    ('XIX', 'S00', 'T98', 'Травмы, отравления и некоторые другие последствия воздействия внешних причин'),
+    ('XX', 'V01', 'Y98', 'Внешние причины заболеваемости и смертности'),
+    ('XXI', 'Z00', 'Z99', 'Факторы, влияющие на состояние здоровья и обращения в учреждения здравоохранения'),
+    ('XXII', 'U00', 'U85', 'Коды для особых целей'),
+]
+# Порядок классов в дереве: I, II, ... XXII (не по алфавиту кодов)
+CHAPTER_ORDER = {chapter: number for number, (chapter, first, last, name) in enumerate(MKB_CHAPTERS)}
+
+# Блоки рубрик (пока только класса V): (первая рубрика, последняя рубрика, наименование)
+MKB_BLOCKS = [
+    ('F00', 'F09', 'Органические, включая симптоматические, психические расстройства'),
+    ('F10', 'F19', 'Психические расстройства и расстройства поведения, связанные с употреблением психоактивных веществ'),
+    ('F20', 'F29', 'Шизофрения, шизотипические и бредовые расстройства'),
+    ('F30', 'F39', 'Расстройства настроения (аффективные расстройства)'),
+    ('F40', 'F48', 'Невротические, связанные со стрессом и соматоформные расстройства'),
+    ('F50', 'F59', 'Поведенческие синдромы, связанные с физиологическими нарушениями и физическими факторами'),
+    ('F60', 'F69', 'Расстройства личности и поведения в зрелом возрасте'),
+    ('F70', 'F79', 'Умственная отсталость'),
+    ('F80', 'F89', 'Нарушения психологического развития'),
+    ('F90', 'F98', 'Эмоциональные расстройства и расстройства поведения, начинающиеся обычно в детском и подростковом возрасте'),
+    ('F99', 'F99', 'Психическое расстройство без дополнительного уточнения'),
+]
+
+# Уровни иерархии справочника Diagnosis
+MKB_LEVELS = [
+    ('CHAPTER', 'Класс'),
+    ('BLOCK', 'Блок'),
+    ('CATEGORY', 'Рубрика'),
+    ('SUBCATEGORY', 'Подрубрика'),
+]
+
+
+def mkb_chapter(code):
+    """Глава МКБ-10 для кода ('F20.0' -> 'V'); пустая строка, если код не распознан"""
+    rubric = (code or '').strip().upper()[:3]
+    if len(rubric) < 3:
+        return ''
+    for chapter, first, last, name in MKB_CHAPTERS:
+        if first <= rubric <= last:
+            return chapter
+    return ''
+
+
+def normalize_mkb_code(code):
+    """Код в виде справочника Diagnosis: ' f20,0 ' -> 'F20.0', 'F42.' -> 'F42'"""
+    code = ''.join((code or '').split()).upper().replace(',', '.')
+    return code.rstrip('.')
+
+
+# Кириллические буквы, которые при вводе кода путают с латинскими: похожие
+# по начертанию и Ф вместо F
+CODE_HOMOGLYPHS = str.maketrans('АВЕКМНОРСТХУФ', 'ABEKMHOPCTXYF')
+
+
+def fold_mkb_code(code):
+    """Код латиницей: 'Ф20.0' -> 'F20.0', 'F2О' -> 'F20' (буква О среди цифр - ноль)"""
+    code = normalize_mkb_code(code).translate(CODE_HOMOGLYPHS)
+    return code[:1] + code[1:].replace('O', '0')
+
+
+def content_hash(name, description=''):
+    """Хэш содержимого записи справочника: по нему загрузчик отличает измененные коды"""
+    return hashlib.md5(f'{name}\x1f{description}'.encode(), usedforsecurity=False).hexdigest()
+
+
+def mkb_block(code):
+    """Блок рубрики ('F20.0' -> 'F20-F29'); пустая строка, если блок не описан"""
+    rubric = normalize_mkb_code(code)[:3]
+    for first, last, name in MKB_BLOCKS:
+        if first <= rubric <= last:
+            return f'{first}-{last}'
+    return ''
+
+
+def mkb_level(code):
+    """Уровень узла по виду кода: класс 'V', блок 'F20-F29', рубрика 'F20', подрубрика 'F20.0'"""
+    if code in CHAPTER_ORDER:
+        return 'CHAPTER'
+    if '-' in code:
+        return 'BLOCK'
+    if '.' in code:
+        return 'SUBCATEGORY'
+    return 'CATEGORY'
+
+
+
+def _parent_code(code, level, codes):
+    """Код родительского узла из codes; None - корень"""
+    if level == 'CHAPTER':
+        return None
+    if level == 'BLOCK':
+        return mkb_chapter(code.split('-')[0]) or None
+    if level == 'SUBCATEGORY':
+        # Ближайший существующий префикс: F20.01 -> F20.0 -> F20
+        prefix = code[:-1].rstrip('.')
+        while len(prefix) > 3:
+            if prefix in codes:
+                return prefix
+            prefix = prefix[:-1].rstrip('.')
+        if prefix in codes:
+            return prefix
+    return mkb_block(code) or mkb_chapter(code) or None
+
+
+def rebuild_mkb_tree(model):
+    """Достраивает классы и блоки и пересчитывает уровни, родителей и границы lft/rgt.
+
+    model - модель справочника (Diagnosis или ее историческая версия в
+    миграции). Возвращает число узлов дерева.
+    """
+    nodes = {node.code: node for node in model.objects.all()}
+    chapter_names = {chapter: name for chapter, first, last, name in MKB_CHAPTERS}
+    block_names = {f'{first}-{last}': name for first, last, name in MKB_BLOCKS}
+    # Только классы и блоки, в которые попадает хотя бы один код справочника
+    groups = {}
+    for code in nodes:
+        if mkb_level(code) in ('CATEGORY', 'SUBCATEGORY'):
+            for group in (mkb_chapter(code), mkb_block(code)):
+                if group and group not in nodes:
+                    groups[group] = model(
+                        code=group, name=chapter_names.get(group) or block_names[group], level=mkb_level(group)
+                    )
+    model.objects.bulk_create(groups.values())
+    if groups:
+        nodes = {node.code: node for node in model.objects.all()}
+
+    tree_fields = ['level', 'parent_id', 'lft', 'rgt']
+    before = {node.pk: [getattr(node, field) for field in tree_fields] for node in nodes.values()}
+    children = {}
+    for code, node in nodes.items():
+        node.level = mkb_level(code)
+        parent = _parent_code(code, node.level, nodes)
+        node.parent_id = nodes[parent].pk if parent in nodes else None
+        children.setdefault(node.parent_id, []).append(node)
+
+    def sort_key(node):
+        return CHAPTER_ORDER.get(node.code, len(CHAPTER_ORDER)), node.code
+
+    # Обход в глубину: lft - при входе в узел, rgt - при выходе
+    counter = 0
+    stack = [(node, False) for node in sorted(children.get(None, []), key=sort_key, reverse=True)]
+    while stack:
+        node, leaving = stack.pop()
+        counter += 1
+        if leaving:
+            node.rgt = counter
+            continue
+        node.lft = counter
+        stack.append((node, True))
+        stack.extend((child, False) for child in sorted(children.get(node.pk, []), key=sort_key, reverse=True))
+
+    # Повторная загрузка того же справочника дерево не меняет - пишем только изменившиеся узлы.
+    # Вставка кода сдвигает границы всех следующих узлов, поэтому UPDATE по ключу через
+    # executemany: bulk_update строит CASE на каждую строку и на полном МКБ-10 в разы медленнее
+    rows = []
+    for node in nodes.values():
+        values = [getattr(node, field) for field in tree_fields]
+        if values != before[node.pk]:
+            rows.append([*values, node.pk])
+    connection = connections[model.objects.db]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'UPDATE {quote(model._meta.db_table)} SET '
+            + ', '.join(f'{quote(field)} = %s' for field in tree_fields)
+            + f' WHERE {quote(model._meta.pk.column)} = %s',
+            rows,
+        )
+    return len(nodes)
@@ -0,0 +1,218 @@
+"""Загрузка справочника МКБ-10 из выгрузок классификатора.
+
+Файл читается потоково - записи разбираются по мере чтения, и в памяти
+не держится весь файл:
+
+* JSON - массив объектов верхнего уровня (в том числе фикстура Django
+  patients.diagnosis) или JSON Lines, по одному объекту в строке;
+* CSV - с заголовком, разделитель (запятая, точка с запятой, табуляция)
+  определяется по началу файла;
+* XML - любой элемент с кодом и наименованием в атрибутах или дочерних
+  элементах (например, выгрузка НСИ с MKB_CODE и MKB_NAME).
+
+Записи пишутся пакетами: один SELECT хэшей существующих кодов пакета и
+один INSERT ... ON CONFLICT (code) DO UPDATE для новых и изменившихся.
+Неизменившиеся коды (совпал хэш наименования и описания) не пишутся.
+Классы и блоки строятся по кодам (rebuild_mkb_tree), поэтому диапазоны
+вида "A00-B99" из выгрузки пропускаются.
+"""
+import csv
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+
+from django.db import transaction
+
+from .diagnosis_index import bump_version
+from .mkb import content_hash, normalize_mkb_code
+from .models import Diagnosis
+
+LOAD_BATCH_SIZE = 1000
+CHUNK_SIZE = 1 << 16
+FORMATS = ('json', 'csv', 'xml')
+
+# Названия полей в выгрузках (без учета регистра)
+CODE_KEYS = ('code', 'mkb_code', 'код', 'код мкб', 'код мкб-10')
+NAME_KEYS = ('name', 'mkb_name', 'наименование', 'название')
+DESCRIPTION_KEYS = ('description', 'описание', 'comment', 'примечание')
+ACTUAL_KEYS = ('actual', 'актуальность')
+NOT_ACTUAL = ('0', 'false', 'нет')
+
+# Между элементами массива JSON верхнего уровня (и строками JSON Lines)
+JSON_SEPARATORS_RE = re.compile(r'[\s,\[]*')
+
+
+def detect_format(path):
+    """Формат по расширению файла"""
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension in ('jsonl', 'ndjson'):
+        return 'json'
+    if extension in FORMATS:
+        return extension
+    raise ValueError(f'Неизвестный формат файла: {path} (укажите json, csv или xml)')
+
+
+def iter_json(stream, chunk_size=CHUNK_SIZE):
+    """Объекты массива верхнего уровня (или JSON Lines) по мере чтения потока"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        position = JSON_SEPARATORS_RE.match(buffer, position).end()
+        if position < len(buffer):
+            if buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError(f'Некорректный JSON около символа {position} остатка файла')
+            else:
+                yield item
+                continue
+        elif eof:
+            return
+        # Объект не дочитан: добавляем следующий фрагмент файла
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_csv(stream):
+    """Строки CSV как словари по заголовку"""
+    sample = stream.read(8192)
+    stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.DictReader(stream, dialect=dialect)
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_xml(stream):
+    """Элементы XML с кодом и наименованием как словари полей"""
+    parents = []
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        fields = {**element.attrib}
+        for child in element:
+            if len(child) == 0:
+                fields[_local_name(child.tag)] = (child.text or '').strip()
+        if _pick(fields, CODE_KEYS) and _pick(fields, NAME_KEYS):
+            yield fields
+            # Разобранные записи не копятся в дереве документа
+            if parents:
+                parents[-1].remove(element)
+
+
+def _pick(fields, keys, default=''):
+    """Значение первого поля из keys; default - если такого поля нет"""
+    for key, value in fields.items():
+        if str(key).strip().lower() in keys:
+            return str(value or '').strip()
+    return default
+
+
+def parse_entry(item):
+    """(код, наименование, описание) из записи выгрузки; None - запись не загружается"""
+    if not isinstance(item, dict):
+        return None
+    if 'fields' in item:
+        # Фикстура Django
+        if item.get('model', 'patients.diagnosis') != 'patients.diagnosis':
+            return None
+        item = item['fields']
+    if _pick(item, ACTUAL_KEYS).lower() in NOT_ACTUAL:
+        return None
+    # Отметки "крестик" и "звездочка" двойного кодирования (A17.0+, G01*) в код не входят
+    code = normalize_mkb_code(_pick(item, CODE_KEYS)).rstrip('+*')
+    name = _pick(item, NAME_KEYS)
+    if not code or not name or '-' in code or len(code) > Diagnosis._meta.get_field('code').max_length:
+        return None
+    # Без колонки описания (None) загруженное ранее описание сохраняется
+    return code, name[:Diagnosis._meta.get_field('name').max_length], _pick(item, DESCRIPTION_KEYS, None)
+
+
+def read_classifier(stream, file_format):
+    """Записи выгрузки: (код, наименование, описание) или None для пропущенных"""
+    items = {'json': iter_json, 'csv': iter_csv, 'xml': iter_xml}[file_format](stream)
+    for item in items:
+        yield parse_entry(item)
+
+
+def _upsert(batch, counts):
+    """Записывает пакет {код: (наименование, описание)}: новые и изменившиеся коды"""
+    existing = {
+        code: (hash_value, description)
+        for code, hash_value, description in Diagnosis.objects.filter(
+            code__in=list(batch)
+        ).values_list('code', 'content_hash', 'description')
+    }
+    rows = []
+    for code, (name, description) in batch.items():
+        stored_hash, stored_description = existing.get(code, (None, ''))
+        if description is None:
+            description = stored_description
+        hash_value = content_hash(name, description)
+        if stored_hash is None:
+            counts['created'] += 1
+        elif stored_hash != hash_value:
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+            continue
+        rows.append(Diagnosis(code=code, name=name, description=description, content_hash=hash_value))
+    Diagnosis.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['code'],
+        update_fields=['name', 'description', 'content_hash'],
+    )
+
+
+def load_diagnoses(entries, batch_size=LOAD_BATCH_SIZE):
+    """Загружает записи из read_classifier() пакетами и перестраивает дерево справочника.
+
+    Возвращает счетчики created, updated, unchanged и skipped.
+    """
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0}
+    with transaction.atomic():
+        batch = {}
+        for entry in entries:
+            if entry is None:
+                counts['skipped'] += 1
+                continue
+            code, name, description = entry
+            batch[code] = (name, description)
+            if len(batch) >= batch_size:
+                _upsert(batch, counts)
+                batch = {}
+        if batch:
+            _upsert(batch, counts)
+        if counts['created']:
+            Diagnosis.objects.rebuild_tree()
+        if counts['created'] or counts['updated']:
+            # bulk_create не вызывает сигналы - индекс автодополнения сбрасываем сами
+            transaction.on_commit(bump_version)
+    return counts
+
+
+def load_file(path, file_format=None, encoding='utf-8-sig', batch_size=LOAD_BATCH_SIZE):
+    """Загружает файл выгрузки; формат по расширению, если не указан"""
+    file_format = file_format or detect_format(path)
+    if file_format == 'xml':
+        # Кодировку XML указывает его заголовок
+        with open(path, 'rb') as stream:
+            return load_diagnoses(read_classifier(stream, file_format), batch_size)
+    with open(path, encoding=encoding, newline='') as stream:
+        return load_diagnoses(read_classifier(stream, file_format), batch_size)
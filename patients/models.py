@@ -1,16 +1,73 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
+from django.core.files.storage import FileSystemStorage
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from django.utils import timezone
 from django.conf import settings
+import os
 import uuid
 
+from .managers import CaseNumberSequenceManager, DiagnosisQuerySet, HospitalizationQuerySet, PatientQuerySet
+from .mkb import MKB_LEVELS, content_hash, normalize_mkb_code
+
 User = get_user_model()
 
-class Patient(models.Model):
+class CaseNumberSequence(models.Model):
+    """Последний выданный номер истории болезни за год"""
+    year = models.PositiveIntegerField('Год', primary_key=True)
+    last_value = models.PositiveIntegerField('Последний номер', default=0)
+
+    objects = CaseNumberSequenceManager()
+
+    class Meta:
+        verbose_name = 'Счетчик номеров историй болезни'
+        verbose_name_plural = 'Счетчики номеров историй болезни'
+
+    def __str__(self):
+        return f'{self.year}: {self.last_value}'
+
+    @staticmethod
+    def format_case_number(year, number):
+        return f'{year}-{number:04d}'
+
+
+class DiagnosisLinkMixin:
+    """Ссылки на справочник Diagnosis по текстовым кодам МКБ-10.
+
+    Текстовый код хранится как введен (в том числе устаревший, которого нет
+    в справочнике), ссылка заполняется при сохранении по нормализованному
+    коду; существующие записи связывает команда link_diagnoses.
+    """
+    # Текстовое поле кода -> ForeignKey на Diagnosis
+    MKB_LINKS = {}
+
+    def link_diagnoses(self, update_fields=None):
+        """Обновляет ссылки по кодам; возвращает update_fields с полями ссылок"""
+        for code_field, link_field in self.MKB_LINKS.items():
+            if update_fields is not None and code_field not in update_fields:
+                continue
+            code = normalize_mkb_code(getattr(self, code_field))
+            diagnosis_id = (
+                Diagnosis.objects.codes().filter(code=code).values_list('pk', flat=True).first() if code else None
+            )
+            setattr(self, f'{link_field}_id', diagnosis_id)
+            if update_fields is not None:
+                update_fields = {*update_fields, link_field}
+        return update_fields
+
+    def save(self, *args, update_fields=None, **kwargs):
+        update_fields = self.link_diagnoses(update_fields)
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+
+class Patient(DiagnosisLinkMixin, models.Model):
     """Модель пациента по форме №003/у"""
 
+    objects = PatientQuerySet.as_manager()
+
     @property
     def full_name(self):
         """Полное ФИО пациента"""
@@ -113,6 +170,15 @@ class Patient(models.Model):
     
     # 17. Код по МКБ-10 при поступлении
     admission_mkb_code = models.CharField('Код МКБ-10 при поступлении', max_length=20, blank=True)
+    admission_mkb = models.ForeignKey(
+        'Diagnosis',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='admitted_patients',
+        verbose_name='Диагноз МКБ-10 при поступлении'
+    )
     
     # === РАЗДЕЛ 3: ДАННЫЕ О ЛЕЧЕНИИ ===
     # 18. Лечащий врач
@@ -133,6 +199,15 @@ class Patient(models.Model):
     
     # 21. Код по МКБ-10 при выписке
     discharge_mkb_code = models.CharField('Код МКБ-10 при выписке', max_length=20, blank=True)
+    discharge_mkb = models.ForeignKey(
+        'Diagnosis',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='discharged_patients',
+        verbose_name='Диагноз МКБ-10 при выписке'
+    )
     
     # 22. Исход заболевания
     OUTCOME_CHOICES = [
@@ -205,6 +280,9 @@ class Patient(models.Model):
         related_name='created_patients',
         verbose_name='Кем создана запись'
     )
+    # Поисковый вектор (ФИО, документы, адрес) поддерживается триггером в БД,
+    # см. patients/search.py и миграцию 0002
+    search_vector = SearchVectorField('Поисковый индекс', null=True, editable=False)
     
     class Meta:
         verbose_name = 'Пациент'
@@ -215,6 +293,12 @@ class Patient(models.Model):
             models.Index(fields=['admission_date']),
             models.Index(fields=['status']),
             models.Index(fields=['case_number']),
+            # Ключи keyset-пагинации списка: (поле сортировки, id)
+            models.Index(fields=['admission_date', 'id']),
+            models.Index(fields=['last_name', 'id']),
+            models.Index(fields=['birth_date', 'id']),
+            # Выборка изменений для обновления витрин (refresh_rollups)
+            models.Index(fields=['updated_at']),
         ]
         permissions = [
             ('view_all_patients', 'Может просматривать всех пациентов'),
@@ -229,21 +313,38 @@ class Patient(models.Model):
             ('view_statistics', 'Может просматривать статистику'),
         ]
 
+    # Поля, прежние значения которых нужны сигналам (см. patients/signals.py):
+    # кэш статистики периодов и счетчики нагрузки врачей
+    TRACKED_FIELDS = ('admission_date', 'discharge_date', 'attending_physician_id', 'status')
+    MKB_LINKS = {'admission_mkb_code': 'admission_mkb', 'discharge_mkb_code': 'discharge_mkb'}
+
     def __str__(self):
         return f'{self.last_name} {self.first_name} {self.middle_name} (ИБ: {self.case_number})'
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Прежние значения отслеживаемых полей - для сравнения при сохранении
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values)
+            if name in cls.TRACKED_FIELDS
+        }
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.case_number:
-            # Генерируем номер истории болезни: Год-ПорядковыйНомер
-            year = timezone.now().year
-            last_case = Patient.objects.filter(case_number__startswith=f'{year}-').order_by('case_number').last()
-            if last_case:
-                last_num = int(last_case.case_number.split('-')[1])
-                new_num = last_num + 1
-            else:
-                new_num = 1
-            self.case_number = f'{year}-{new_num:04d}'
-        super().save(*args, **kwargs)
+            # Генерируем номер истории болезни: Год-ПорядковыйНомер (счетчик года в БД)
+            self.case_number = CaseNumberSequence.objects.next_case_number()
+        elif self._state.adding and not getattr(self, '_case_number_reserved', False):
+            # Номер задан явно (импорт): счетчик продолжит нумерацию после него
+            CaseNumberSequence.objects.advance(self.case_number)
+        # Счетчики врачей (сигналы) меняются в той же транзакции, что и пациент
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
 
     def user_can_view(self, user):
         """Проверяет, может ли пользователь просматривать этого пациента"""
@@ -270,7 +371,7 @@ class Patient(models.Model):
         return user.is_administrator
 
 
-class Hospitalization(models.Model):
+class Hospitalization(DiagnosisLinkMixin, models.Model):
     """Модель для учета повторных госпитализаций"""
     patient = models.ForeignKey(
         Patient,
@@ -282,6 +383,15 @@ class Hospitalization(models.Model):
     discharge_date = models.DateField('Дата выписки', null=True, blank=True)
     diagnosis = models.TextField('Диагноз')
     mkb_code = models.CharField('Код МКБ-10', max_length=20, blank=True)
+    mkb = models.ForeignKey(
+        'Diagnosis',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='hospitalizations',
+        verbose_name='Диагноз МКБ-10'
+    )
     department = models.CharField('Отделение', max_length=100)
     attending_physician = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -292,26 +402,277 @@ class Hospitalization(models.Model):
     )
     outcome = models.CharField('Исход', max_length=50, blank=True)
     notes = models.TextField('Примечания', blank=True)
+    # Заполняются пересчетом повторных госпитализаций (patients/readmissions.py)
+    days_since_discharge = models.IntegerField(
+        'Дней после предыдущей выписки', null=True, blank=True, editable=False
+    )
+    is_readmission = models.BooleanField('Повторная госпитализация', default=False, editable=False)
+    
+    objects = HospitalizationQuerySet.as_manager()
+    
+    MKB_LINKS = {'mkb_code': 'mkb'}
     
     class Meta:
         verbose_name = 'Госпитализация'
         verbose_name_plural = 'Госпитализации'
         ordering = ['-admission_date']
+        indexes = [
+            # Выборка на дату вне PostgreSQL (там - GiST-индекс из миграции 0008)
+            models.Index(fields=['department', 'admission_date']),
+        ]
     
     def __str__(self):
         return f'{self.patient} - {self.admission_date}'
 
 
 class Diagnosis(models.Model):
-    """Справочник диагнозов МКБ-10"""
+    """Справочник диагнозов МКБ-10 (дерево вложенных множеств, см. patients/mkb.py)"""
     code = models.CharField('Код МКБ-10', max_length=10, unique=True)
     name = models.CharField('Наименование диагноза', max_length=500)
     description = models.TextField('Описание', blank=True)
+    level = models.CharField('Уровень', max_length=20, choices=MKB_LEVELS, default='CATEGORY', editable=False)
+    parent = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='children',
+        verbose_name='Родительский узел'
+    )
+    # Границы вложенного множества: потомки - узлы с lft в [lft, rgt]
+    lft = models.PositiveIntegerField('Левая граница', null=True, editable=False)
+    rgt = models.PositiveIntegerField('Правая граница', null=True, editable=False)
+    # Хэш наименования и описания: загрузчик справочника пропускает неизменившиеся коды
+    content_hash = models.CharField('Хэш содержимого', max_length=32, blank=True, editable=False)
+    
+    objects = DiagnosisQuerySet.as_manager()
     
     class Meta:
         verbose_name = 'Диагноз МКБ-10'
         verbose_name_plural = 'Диагнозы МКБ-10'
         ordering = ['code']
+        indexes = [
+            models.Index(fields=['lft', 'rgt']),
+            models.Index(fields=['level', 'lft']),
+        ]
+    
+    def __str__(self):
+        return f'{self.code} - {self.name[:50]}'
     
+    def save(self, *args, update_fields=None, **kwargs):
+        self.content_hash = content_hash(self.name, self.description)
+        if update_fields is not None:
+            update_fields = {*update_fields, 'content_hash'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+    
+    def subtree_q(self, relation=None):
+        """Условие "узел или его потомок" диапазоном по lft.
+
+        relation - путь к Diagnosis от фильтруемой модели, например
+        'admission_mkb' для Patient; без него - условие для самого справочника.
+        """
+        prefix = f'{relation}__' if relation else ''
+        return Q(**{f'{prefix}lft__gte': self.lft, f'{prefix}lft__lte': self.rgt})
+
+
+class DiagnosisVersion(models.Model):
+    """Версия справочника МКБ-10 для индексов автодополнения (patients/diagnosis_index.py).
+
+    Одна строка; номер увеличивается при каждом изменении справочника, и
+    все процессы сверяют с ним свой индекс и ETag ответов API.
+    """
+    version = models.PositiveIntegerField('Версия', default=1)
+    # Хэш содержимого пакета для браузера; пусто - пакет этой версии еще не собирался
+    bundle_digest = models.CharField('Хэш пакета справочника', max_length=12, blank=True)
+    changed_at = models.DateTimeField('Изменен', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Версия справочника МКБ-10'
+        verbose_name_plural = 'Версии справочника МКБ-10'
+
+    def __str__(self):
+        return str(self.version)
+
+def export_storage():
+    """Хранилище файлов экспорта: отдельный каталог, не раздаваемый как media"""
+    return FileSystemStorage(location=settings.EXPORT_ROOT)
+
+
+class ExportJob(models.Model):
+    """Фоновая задача экспорта пациентов"""
+    STATUS_CHOICES = [
+        ('PENDING', 'В очереди'),
+        ('RUNNING', 'Выполняется'),
+        ('DONE', 'Готово'),
+        ('FAILED', 'Ошибка'),
+    ]
+    FORMAT_CHOICES = [
+        ('csv', 'CSV'),
+        ('xlsx', 'Excel (XLSX)'),
+        ('json', 'JSON'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='export_jobs',
+        verbose_name='Пользователь'
+    )
+    status = models.CharField('Статус', max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    export_format = models.CharField('Формат', max_length=10, choices=FORMAT_CHOICES)
+    include_fields = models.JSONField('Включаемые данные', default=list)
+    filters = models.JSONField('Критерии выбора', default=dict)
+    total = models.PositiveIntegerField('Всего строк', default=0)
+    processed = models.PositiveIntegerField('Обработано строк', default=0)
+    file = models.FileField('Файл', upload_to='%Y/%m/', storage=export_storage, blank=True)
+    error = models.TextField('Ошибка', blank=True)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    updated_at = models.DateTimeField('Обновлена', auto_now=True)
+    finished_at = models.DateTimeField('Завершена', null=True, blank=True)
+    expires_at = models.DateTimeField('Удалить после', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Задача экспорта'
+        verbose_name_plural = 'Задачи экспорта'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['expires_at']),
+        ]
+
     def __str__(self):
-        return f'{self.code} - {self.name[:50]}'
\ No newline at end of file
+        return f'{self.get_export_format_display()} от {self.created_at:%d.%m.%Y %H:%M} ({self.get_status_display()})'
+
+    @property
+    def is_finished(self):
+        return self.status in ('DONE', 'FAILED')
+
+    @property
+    def progress(self):
+        """Процент выполнения"""
+        if self.status == 'DONE':
+            return 100
+        if not self.total:
+            return 0
+        return min(100, self.processed * 100 // self.total)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.file.name) if self.file else ''
+
+
+class DailyPatientRollup(models.Model):
+    """Витрина: поступления, выписки и смерти за день в разрезе измерений.
+
+    Поддерживается командой refresh_rollups (см. patients/rollups.py);
+    уникальность набора измерений обеспечивает она же.
+    """
+    day = models.DateField('День')
+    department = models.CharField('Отделение', max_length=100, blank=True)
+    # Без ограничения внешнего ключа: витрина не должна мешать удалению пользователей
+    attending_physician = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='Лечащий врач'
+    )
+    gender = models.CharField('Пол', max_length=1, blank=True)
+    mkb_chapter = models.CharField('Глава МКБ-10', max_length=5, blank=True)
+    status = models.CharField('Статус', max_length=20)
+    admissions = models.PositiveIntegerField('Поступления', default=0)
+    discharges = models.PositiveIntegerField('Выписки', default=0)
+    deaths = models.PositiveIntegerField('Смерти', default=0)
+
+    class Meta:
+        verbose_name = 'Сводка по пациентам за день'
+        verbose_name_plural = 'Сводки по пациентам за день'
+        ordering = ['day']
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f'{self.day:%d.%m.%Y}: +{self.admissions} / -{self.discharges}'
+
+
+class PatientRollupState(models.Model):
+    """Вклад пациента в витрину на момент последнего обновления.
+
+    Нужен, чтобы при изменении или удалении пациента вычесть прежний вклад.
+    """
+    patient_id = models.IntegerField('ID пациента', primary_key=True)
+    admission_day = models.DateField('День поступления')
+    discharge_day = models.DateField('День выписки', null=True, blank=True)
+    died = models.BooleanField('Умер', default=False)
+    department = models.CharField('Отделение', max_length=100, blank=True)
+    attending_physician_id = models.IntegerField('ID лечащего врача', null=True, blank=True)
+    gender = models.CharField('Пол', max_length=1, blank=True)
+    mkb_chapter = models.CharField('Глава МКБ-10', max_length=5, blank=True)
+    status = models.CharField('Статус', max_length=20)
+    # Пациент удален, вклад еще не вычтен из витрины (ставит сигнал удаления пациента)
+    deleted_at = models.DateTimeField('Пациент удален', null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Вклад пациента в витрину'
+        verbose_name_plural = 'Вклады пациентов в витрину'
+
+
+class RollupWatermark(models.Model):
+    """Отметка последнего обновления витрины (по Patient.updated_at)"""
+    name = models.CharField('Витрина', max_length=50, primary_key=True)
+    value = models.DateTimeField('Обработаны изменения до', null=True, blank=True)
+    refreshed_at = models.DateTimeField('Обновлена', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Отметка обновления витрины'
+        verbose_name_plural = 'Отметки обновления витрин'
+
+    def __str__(self):
+        return self.name
+
+
+class PhysicianCaseload(models.Model):
+    """Число пациентов лечащего врача всего и по статусам (см. patients/caseload.py)"""
+    physician = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='caseload',
+        verbose_name='Врач'
+    )
+    total = models.IntegerField('Всего пациентов', default=0)
+    hospitalized = models.IntegerField('Госпитализировано', default=0)
+    discharged = models.IntegerField('Выписано', default=0)
+    transferred = models.IntegerField('Переведено', default=0)
+    died = models.IntegerField('Умерло', default=0)
+
+    class Meta:
+        verbose_name = 'Нагрузка врача'
+        verbose_name_plural = 'Нагрузка врачей'
+
+    def __str__(self):
+        return f'{self.physician}: {self.total}'
+
+
+class PhysicianDischargeDay(models.Model):
+    """Выписки пациентов врача за день - для счетчика выписок за последние дни"""
+    physician = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Врач'
+    )
+    day = models.DateField('День')
+    count = models.IntegerField('Выписано', default=0)
+
+    class Meta:
+        verbose_name = 'Выписки врача за день'
+        verbose_name_plural = 'Выписки врачей по дням'
+        constraints = [
+            models.UniqueConstraint(fields=['physician', 'day'], name='patients_physician_discharge_day_unique'),
+        ]
@@ -0,0 +1,159 @@
+"""Длительность госпитализации и занятость коек.
+
+Эпизоды лечения загружаются двумя запросами (история Hospitalization и
+текущий эпизод Patient) и дальше обрабатываются массивами pandas/NumPy.
+Занятость отделения на день - число поступлений по этот день включительно
+минус число выписок по этот день включительно; оба числа для всех дней
+периода сразу дает searchsorted по отсортированным датам событий, без
+запроса или цикла на каждый день.
+"""
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Hospitalization, Patient
+
+EPISODE_COLUMNS = ['patient_id', 'department', 'start', 'end']
+NO_DEPARTMENT = 'Без отделения'
+TOTAL_LABEL = 'Всего'
+LOS_PERCENTILES = [25, 50, 75, 90, 95]
+# Группы длительности в койко-днях: (0, 7], (7, 14], ...
+LOS_BINS = [0, 7, 14, 30, 60, 90, 180, 365, np.inf]
+LOS_BIN_LABELS = ['до 7', '8-14', '15-30', '31-60', '61-90', '91-180', '181-365', 'более 365']
+# Более длинные периоды показываются помесячными средними
+DAILY_CENSUS_MAX_DAYS = 62
+
+
+def default_period(days=90):
+    """Последние days дней по сегодня включительно"""
+    today = timezone.localdate()
+    return today - timedelta(days=days - 1), today
+
+
+def _local_days(values):
+    """Aware datetime -> дни (datetime64) в часовом поясе проекта"""
+    moments = pd.to_datetime(values, utc=True)
+    return moments.dt.tz_convert(settings.TIME_ZONE).dt.tz_localize(None).dt.normalize()
+
+
+def load_episodes(date_from=None, date_to=None):
+    """Эпизоды, пересекающие период: patient_id, department, start, end (NaT - не выписан)"""
+    history = Hospitalization.objects.all()
+    # Без даты выписки текущий эпизод открыт только у госпитализированных
+    current = Patient.objects.filter(Q(discharge_date__isnull=False) | Q(status='HOSPITALIZED'))
+    if date_to:
+        history = history.filter(admission_date__lte=date_to)
+        current = current.filter(admission_date__date__lte=date_to)
+    if date_from:
+        history = history.filter(Q(discharge_date__isnull=True) | Q(discharge_date__gte=date_from))
+        current = current.filter(Q(discharge_date__isnull=True) | Q(discharge_date__date__gte=date_from))
+
+    history = pd.DataFrame(
+        list(history.values_list('patient_id', 'department', 'admission_date', 'discharge_date')),
+        columns=EPISODE_COLUMNS,
+    )
+    history['start'] = pd.to_datetime(history['start'])
+    history['end'] = pd.to_datetime(history['end'])
+    current = pd.DataFrame(
+        list(current.values_list('pk', 'attending_physician__department', 'admission_date', 'discharge_date')),
+        columns=EPISODE_COLUMNS,
+    )
+    current['start'] = _local_days(current['start'])
+    current['end'] = _local_days(current['end'])
+
+    episodes = pd.concat([history, current], ignore_index=True)
+    # Текущий эпизод часто записан и в историю - оставляем запись истории (в ней отделение)
+    episodes = episodes.drop_duplicates(['patient_id', 'start'], keep='first')
+    episodes = episodes[~(episodes['end'] < episodes['start'])]
+    episodes['department'] = episodes['department'].fillna('').replace('', NO_DEPARTMENT)
+    return episodes.reset_index(drop=True)
+
+
+def daily_census(episodes, date_from, date_to):
+    """Занятые койки на конец каждого дня периода: DataFrame дни x отделения.
+
+    Пациент занимает койку со дня поступления по день до выписки.
+    """
+    days = pd.date_range(date_from, date_to, freq='D')
+    census = {}
+    for department, group in episodes.groupby('department', sort=True):
+        starts = np.sort(group['start'].to_numpy())
+        ends = np.sort(group['end'].dropna().to_numpy())
+        census[department] = (
+            np.searchsorted(starts, days.values, side='right')
+            - np.searchsorted(ends, days.values, side='right')
+        )
+    return pd.DataFrame(census, index=days)
+
+
+def census_summary(census):
+    """По отделениям и всего: средняя и максимальная занятость, на последний день, койко-дни"""
+    if census.empty:
+        return []
+    columns = [*census.items(), (TOTAL_LABEL, census.sum(axis=1))]
+    return [
+        {
+            'department': department,
+            'mean': round(float(values.mean()), 1),
+            'max': int(values.max()),
+            'current': int(values.iloc[-1]),
+            'bed_days': int(values.sum()),
+        }
+        for department, values in columns
+    ]
+
+
+def length_of_stay(episodes, date_from=None, date_to=None):
+    """Законченные эпизоды с выпиской в периоде и их длительность los в койко-днях.
+
+    Выписка в день поступления считается одним койко-днем.
+    """
+    finished = episodes.dropna(subset=['end'])
+    if date_from:
+        finished = finished[finished['end'] >= pd.Timestamp(date_from)]
+    if date_to:
+        finished = finished[finished['end'] <= pd.Timestamp(date_to)]
+    return finished.assign(los=(finished['end'] - finished['start']).dt.days.clip(lower=1))
+
+
+def _describe(values):
+    values = values.to_numpy()
+    row = {'episodes': len(values), 'mean': round(float(values.mean()), 1), 'max': int(values.max())}
+    for percentile, value in zip(LOS_PERCENTILES, np.percentile(values, LOS_PERCENTILES)):
+        row[f'p{percentile}'] = round(float(value), 1)
+    return row
+
+
+def los_summary(stays):
+    """По отделениям и всего: число эпизодов, средняя длительность, перцентили, максимум"""
+    if stays.empty:
+        return []
+    rows = [
+        {'department': department, **_describe(group['los'])}
+        for department, group in stays.groupby('department', sort=True)
+    ]
+    rows.append({'department': TOTAL_LABEL, **_describe(stays['los'])})
+    return rows
+
+
+def los_distribution(stays):
+    """Число эпизодов по группам длительности: [(группа, количество), ...]"""
+    counts = pd.cut(stays['los'], LOS_BINS, labels=LOS_BIN_LABELS).value_counts(sort=False)
+    return [(label, int(count)) for label, count in counts.items()]
+
+
+def occupancy_report(date_from, date_to):
+    """Занятость коек и длительность госпитализации за период"""
+    episodes = load_episodes(date_from, date_to)
+    census = daily_census(episodes, date_from, date_to)
+    stays = length_of_stay(episodes, date_from, date_to)
+    return {
+        'census': census,
+        'census_summary': census_summary(census),
+        'los_summary': los_summary(stays),
+        'los_distribution': los_distribution(stays),
+    }
@@ -0,0 +1,154 @@
+"""Keyset (курсорная) пагинация списков.
+
+Вместо OFFSET страница выбирается условием "после последней показанной
+записи" по полю сортировки и ``id`` как стабильному tiebreaker'у, поэтому
+стоимость запроса не зависит от номера страницы. Курсоры подписываются
+и передаются в URL как непрозрачная строка.
+"""
+import json
+
+from django.core import signing
+from django.db import connection
+from django.db.models import Q
+
+CURSOR_SALT = 'patients.pagination.cursor'
+
+# При оценке меньше этого числа строк выполняем точный COUNT(*)
+EXACT_COUNT_THRESHOLD = 10000
+
+
+class InvalidCursor(Exception):
+    """Курсор поврежден или относится к другой сортировке"""
+
+
+def estimate_count(queryset, threshold=EXACT_COUNT_THRESHOLD):
+    """Возвращает (количество, оценочное ли оно).
+
+    На PostgreSQL берем оценку планировщика из EXPLAIN; точный подсчет
+    выполняется только для небольших выборок и на других СУБД.
+    """
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= threshold:
+            return estimate, True
+    return queryset.count(), False
+
+
+class KeysetPage:
+    """Страница keyset-пагинации"""
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Пагинатор по ключу ``(поле сортировки, id)``.
+
+    ``ordering`` - имя поля модели, с префиксом '-' для убывания.
+    ``count`` - заранее известное количество строк (например, из кэша).
+    """
+
+    def __init__(self, queryset, ordering, per_page, count=None):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.per_page = int(per_page)
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+        # Для уникального поля порядок уже полный, tiebreaker не нужен
+        self.use_tiebreaker = not (self.field.unique or self.field.primary_key)
+        self._count = count
+        self.count_is_estimated = False
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count, self.count_is_estimated = estimate_count(self.queryset)
+        return self._count
+
+    def _order_by(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        fields = [f'{prefix}{self.field_name}']
+        if self.use_tiebreaker:
+            fields.append(f'{prefix}pk')
+        return fields
+
+    def _after(self, value, pk, reverse=False):
+        """Условие "строго после (value, pk)" в выбранном направлении"""
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        condition = Q(**{f'{self.field_name}__{lookup}': value})
+        if self.use_tiebreaker:
+            condition |= Q(**{self.field_name: value, f'pk__{lookup}': pk})
+        return condition
+
+    def encode_cursor(self, obj, direction):
+        value = self.field.value_to_string(obj)
+        return signing.dumps(
+            {'o': self.ordering, 'v': value, 'pk': obj.pk, 'd': direction},
+            salt=CURSOR_SALT,
+            compress=True,
+        )
+
+    def decode_cursor(self, cursor):
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            raise InvalidCursor(cursor)
+        if data.get('o') != self.ordering or data.get('d') not in ('next', 'prev'):
+            raise InvalidCursor(cursor)
+        return self.field.to_python(data['v']), data['pk'], data['d']
+
+    def page(self, cursor=None):
+        """Возвращает страницу после/до курсора (первую, если курсора нет)"""
+        direction = 'next'
+        queryset = self.queryset
+        if cursor:
+            value, pk, direction = self.decode_cursor(cursor)
+            queryset = queryset.filter(self._after(value, pk, reverse=direction == 'prev'))
+
+        reverse = direction == 'prev'
+        rows = list(queryset.order_by(*self._order_by(reverse))[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+
+        if not rows:
+            return KeysetPage(rows, self)
+
+        if reverse:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        return KeysetPage(
+            rows,
+            self,
+            next_cursor=self.encode_cursor(rows[-1], 'next') if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], 'prev') if has_previous else None,
+        )
@@ -0,0 +1,130 @@
+"""Повторные госпитализации.
+
+Для каждого эпизода Hospitalization хранится число дней от выписки из
+предыдущего эпизода того же пациента (LAG по эпизодам, упорядоченным по
+дате поступления) и флаг повторной госпитализации: поступление не позже
+READMISSION_WINDOW_DAYS дней после выписки. Поступление в день выписки
+считается переводом, а не повторной госпитализацией.
+
+Пересчет - один UPDATE ... FROM с оконной функцией в подзапросе: на всю
+таблицу (первичное заполнение, смена окна) или на одного пациента (сигналы
+Hospitalization). Перезаписываются только изменившиеся строки. На СУБД без
+такого UPDATE (не PostgreSQL и не SQLite) то же считается в Python.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q
+
+from .models import Hospitalization
+
+# Разность дат в днях и сравнение с учетом NULL для поддерживаемых СУБД
+DAYS_BETWEEN_SQL = {
+    'postgresql': '{later} - {earlier}',
+    'sqlite': 'CAST(julianday({later}) - julianday({earlier}) AS INTEGER)',
+}
+DISTINCT_SQL = {
+    'postgresql': 'IS DISTINCT FROM',
+    'sqlite': 'IS NOT',
+}
+
+REFRESH_SQL = """
+UPDATE {table} AS episode
+SET days_since_discharge = gaps.days,
+    is_readmission = CASE WHEN gaps.days BETWEEN 1 AND %s THEN TRUE ELSE FALSE END
+FROM (
+    SELECT id, {days} AS days
+    FROM (
+        SELECT id, admission_date,
+               LAG(discharge_date) OVER (
+                   PARTITION BY patient_id ORDER BY admission_date, id
+               ) AS previous_discharge
+        FROM {table}
+        {where}
+    ) AS ordered
+) AS gaps
+WHERE episode.id = gaps.id
+  AND (episode.days_since_discharge {distinct} gaps.days
+       OR episode.is_readmission {distinct} (CASE WHEN gaps.days BETWEEN 1 AND %s THEN TRUE ELSE FALSE END))
+"""
+
+PYTHON_BATCH_SIZE = 1000
+
+REPORT_GROUPS = {
+    'department': ['department'],
+    'physician': ['attending_physician', 'attending_physician__last_name', 'attending_physician__first_name'],
+}
+
+
+def refresh_readmissions(patient_id=None, window_days=None):
+    """Пересчитывает дни от предыдущей выписки и флаг; возвращает число измененных эпизодов"""
+    vendor = connection.vendor
+    if window_days is None:
+        window_days = settings.READMISSION_WINDOW_DAYS
+    if vendor not in DAYS_BETWEEN_SQL:
+        return _refresh_in_python(patient_id, window_days)
+
+    sql = REFRESH_SQL.format(
+        table=connection.ops.quote_name(Hospitalization._meta.db_table),
+        days=DAYS_BETWEEN_SQL[vendor].format(later='admission_date', earlier='previous_discharge'),
+        distinct=DISTINCT_SQL[vendor],
+        where='WHERE patient_id = %s' if patient_id is not None else '',
+    )
+    params = [window_days] + ([patient_id] if patient_id is not None else []) + [window_days]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def _refresh_in_python(patient_id, window_days):
+    """Тот же пересчет обходом эпизодов по пациентам и bulk_update изменившихся"""
+    queryset = Hospitalization.objects.all()
+    if patient_id is not None:
+        queryset = queryset.filter(patient_id=patient_id)
+    episodes = queryset.order_by('patient_id', 'admission_date', 'id').only(
+        'patient_id', 'admission_date', 'discharge_date', 'days_since_discharge', 'is_readmission',
+    )
+    changed = []
+    updated = 0
+    previous = None
+    for episode in episodes.iterator(chunk_size=PYTHON_BATCH_SIZE):
+        days = None
+        if previous is not None and previous.patient_id == episode.patient_id and previous.discharge_date:
+            days = (episode.admission_date - previous.discharge_date).days
+        is_readmission = days is not None and 1 <= days <= window_days
+        if (episode.days_since_discharge, episode.is_readmission) != (days, is_readmission):
+            episode.days_since_discharge = days
+            episode.is_readmission = is_readmission
+            changed.append(episode)
+        if len(changed) >= PYTHON_BATCH_SIZE:
+            updated += Hospitalization.objects.bulk_update(changed, ['days_since_discharge', 'is_readmission'])
+            changed = []
+        previous = episode
+    if changed:
+        updated += Hospitalization.objects.bulk_update(changed, ['days_since_discharge', 'is_readmission'])
+    return updated
+
+
+def readmission_condition(window_days=None):
+    """Условие повторной госпитализации: сохраненный флаг или произвольное окно"""
+    if window_days is None:
+        return Q(is_readmission=True)
+    return Q(days_since_discharge__gte=1, days_since_discharge__lte=window_days)
+
+
+def readmission_rates(by='department', date_from=None, date_to=None, window_days=None):
+    """Эпизоды, повторные поступления и их доля (%) по отделениям или врачам за период поступления"""
+    queryset = Hospitalization.objects.all()
+    if date_from:
+        queryset = queryset.filter(admission_date__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(admission_date__lte=date_to)
+
+    rows = list(
+        queryset.order_by().values(*REPORT_GROUPS[by]).annotate(
+            episodes=Count('id'),
+            readmissions=Count('id', filter=readmission_condition(window_days)),
+        ).order_by('-readmissions', *REPORT_GROUPS[by])
+    )
+    for row in rows:
+        row['rate'] = round(row['readmissions'] * 100 / row['episodes'], 1)
+    return rows
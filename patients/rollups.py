@@ -0,0 +1,258 @@
+"""Витрина DailyPatientRollup: инкрементальное обновление и сводные запросы.
+
+Каждый пациент дает в витрину поступление в день поступления и выписку
+(и смерть, если умер) в день выписки - в строку со своими измерениями:
+отделение лечащего врача, врач, пол, глава МКБ-10 диагноза при
+поступлении и текущий статус. Прежний вклад пациента хранится в
+PatientRollupState, поэтому обновление обрабатывает только пациентов,
+измененных после отметки (Patient.updated_at), и удаленных: из витрины
+вычитается старый вклад и добавляется новый. Удаление пациента помечает
+его вклад (deleted_at), и обновление вычитает только помеченные вклады.
+
+Изменения, не затрагивающие updated_at и сигналы (QuerySet.update(),
+удаление SQL-запросом, смена отделения у врача), подхватывает полная
+пересборка: refresh_rollups --full.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import ExtractYear, TruncMonth
+from django.utils import timezone
+
+from .mkb import mkb_chapter
+from .models import DailyPatientRollup, Patient, PatientRollupState, RollupWatermark
+
+ROLLUP_NAME = 'daily_patient'
+REFRESH_CHUNK_SIZE = 2000
+# Запас на транзакции, зафиксированные позже своего updated_at; повторная обработка безвредна
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Поля Patient, из которых складывается вклад в витрину
+PATIENT_FIELDS = (
+    'pk', 'admission_date', 'discharge_date', 'status', 'outcome', 'gender',
+    'admission_mkb_code', 'attending_physician_id', 'attending_physician__department',
+)
+# Вклад пациента: дни событий, признак смерти и измерения строки витрины
+SNAPSHOT_FIELDS = (
+    'admission_day', 'discharge_day', 'died',
+    'department', 'attending_physician_id', 'gender', 'mkb_chapter', 'status',
+)
+ROLLUP_KEY_FIELDS = ('day', 'department', 'attending_physician_id', 'gender', 'mkb_chapter', 'status')
+MEASURES = ('admissions', 'discharges', 'deaths')
+
+# Измерения сводных запросов: поле витрины или выражение над ним
+PIVOT_DIMENSIONS = {
+    'day': 'day',
+    'month': TruncMonth('day'),
+    'year': ExtractYear('day'),
+    'department': 'department',
+    'attending_physician': 'attending_physician',
+    'gender': 'gender',
+    'mkb_chapter': 'mkb_chapter',
+    'status': 'status',
+}
+# Измерения, по которым можно отфильтровать сводку на равенство
+PIVOT_FILTERS = ('department', 'attending_physician', 'gender', 'mkb_chapter', 'status')
+
+
+def _snapshot(row):
+    """Вклад пациента по строке values_list(*PATIENT_FIELDS)"""
+    pk, admitted, discharged, status, outcome, gender, mkb_code, physician_id, department = row
+    return (
+        timezone.localtime(admitted).date(),
+        timezone.localtime(discharged).date() if discharged else None,
+        status == 'DIED' or outcome == 'DEATH',
+        department or '',
+        physician_id,
+        gender,
+        mkb_chapter(mkb_code),
+        status,
+    )
+
+
+def _add_contribution(deltas, snapshot, sign):
+    """Добавляет (sign=1) или вычитает (sign=-1) вклад пациента в изменения витрины"""
+    admission_day, discharge_day, died, *dimensions = snapshot
+    deltas[(admission_day, *dimensions)][0] += sign
+    if discharge_day is not None:
+        counts = deltas[(discharge_day, *dimensions)]
+        counts[1] += sign
+        if died:
+            counts[2] += sign
+
+
+def _collect_changed(patients, deltas):
+    """Пересчитывает вклад пациентов из patients; возвращает число изменившихся"""
+    processed = 0
+    last_pk = 0
+    rows_queryset = patients.order_by('pk').values_list(*PATIENT_FIELDS)
+    while True:
+        rows = list(rows_queryset.filter(pk__gt=last_pk)[:REFRESH_CHUNK_SIZE])
+        if not rows:
+            return processed
+        last_pk = rows[-1][0]
+
+        states = {
+            patient_id: tuple(snapshot)
+            for patient_id, *snapshot in PatientRollupState.objects.filter(
+                patient_id__in=[row[0] for row in rows]
+            ).values_list('patient_id', *SNAPSHOT_FIELDS)
+        }
+        created, updated = [], []
+        for row in rows:
+            snapshot = _snapshot(row)
+            previous = states.get(row[0])
+            if previous == snapshot:
+                continue
+            if previous is not None:
+                _add_contribution(deltas, previous, -1)
+            _add_contribution(deltas, snapshot, 1)
+            state = PatientRollupState(row[0], *snapshot)
+            (created if previous is None else updated).append(state)
+            processed += 1
+
+        PatientRollupState.objects.bulk_create(created)
+        PatientRollupState.objects.bulk_update(updated, SNAPSHOT_FIELDS, batch_size=500)
+
+
+def mark_deleted(patient_id):
+    """Помечает вклад удаленного пациента: следующее обновление вычтет его из витрины"""
+    PatientRollupState.objects.filter(patient_id=patient_id).update(deleted_at=timezone.now())
+
+
+def _collect_deleted(deltas):
+    """Вычитает вклад пациентов, помеченных удаленными; возвращает их число"""
+    deleted = list(
+        PatientRollupState.objects.filter(deleted_at__isnull=False).values_list('patient_id', *SNAPSHOT_FIELDS)
+    )
+    for patient_id, *snapshot in deleted:
+        _add_contribution(deltas, tuple(snapshot), -1)
+    ids = [row[0] for row in deleted]
+    for start in range(0, len(ids), REFRESH_CHUNK_SIZE):
+        PatientRollupState.objects.filter(patient_id__in=ids[start:start + REFRESH_CHUNK_SIZE]).delete()
+    return len(deleted)
+
+
+def _write_deltas(deltas):
+    """Применяет накопленные изменения к строкам витрины"""
+    deltas = {key: counts for key, counts in deltas.items() if any(counts)}
+    days = sorted({key[0] for key in deltas})
+    existing = {}
+    for start in range(0, len(days), REFRESH_CHUNK_SIZE):
+        for row in DailyPatientRollup.objects.filter(day__in=days[start:start + REFRESH_CHUNK_SIZE]):
+            existing[tuple(getattr(row, field) for field in ROLLUP_KEY_FIELDS)] = row
+
+    created, updated, emptied = [], [], []
+    for key, counts in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = DailyPatientRollup(**dict(zip(ROLLUP_KEY_FIELDS, key)))
+            created.append(row)
+        elif any(getattr(row, measure) + delta for measure, delta in zip(MEASURES, counts)):
+            updated.append(row)
+        else:
+            emptied.append(row.pk)
+        for measure, delta in zip(MEASURES, counts):
+            setattr(row, measure, getattr(row, measure) + delta)
+
+    DailyPatientRollup.objects.bulk_create(created, batch_size=500)
+    DailyPatientRollup.objects.bulk_update(updated, MEASURES, batch_size=500)
+    for start in range(0, len(emptied), REFRESH_CHUNK_SIZE):
+        DailyPatientRollup.objects.filter(pk__in=emptied[start:start + REFRESH_CHUNK_SIZE]).delete()
+
+
+def refresh_daily_rollups(full=False):
+    """Обновляет витрину по изменениям после отметки (или целиком при full).
+
+    Возвращает (число измененных пациентов, число удаленных).
+    """
+    with transaction.atomic():
+        # Блокировка отметки не дает двум обновлениям идти одновременно
+        watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=ROLLUP_NAME)
+        started = timezone.now()
+        if full:
+            DailyPatientRollup.objects.all().delete()
+            PatientRollupState.objects.all().delete()
+        if full or watermark.value is None:
+            patients = Patient.objects.all()
+        else:
+            patients = Patient.objects.filter(updated_at__gte=watermark.value - WATERMARK_OVERLAP)
+
+        deltas = defaultdict(lambda: [0, 0, 0])
+        changed = _collect_changed(patients, deltas)
+        deleted = _collect_deleted(deltas)
+        _write_deltas(deltas)
+
+        watermark.value = started
+        watermark.refreshed_at = timezone.now()
+        watermark.save()
+    return changed, deleted
+
+
+def _sort_key(row, dimensions):
+    # Итоги (None) идут после своей группы, как в GROUP BY ROLLUP
+    return tuple((row[name] is None, row[name] if row[name] is not None else '') for name in dimensions)
+
+
+def pivot(dimensions, date_from=None, date_to=None, filters=None, rollup=False):
+    """Сводка витрины: GROUP BY по любому набору измерений из PIVOT_DIMENSIONS.
+
+    Возвращает список словарей с измерениями и суммами admissions,
+    discharges, deaths. С rollup=True добавляются промежуточные итоги по
+    каждому префиксу списка измерений и общий итог (свернутые измерения -
+    None, subtotal=True), как в GROUP BY ROLLUP.
+    """
+    unknown = [name for name in dimensions if name not in PIVOT_DIMENSIONS]
+    if unknown:
+        raise ValueError(f'Неизвестные измерения: {", ".join(unknown)}')
+    unknown = [name for name in (filters or {}) if name not in PIVOT_FILTERS]
+    if unknown:
+        raise ValueError(f'Недопустимые фильтры: {", ".join(unknown)}')
+
+    queryset = DailyPatientRollup.objects.all()
+    if date_from:
+        queryset = queryset.filter(day__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(day__lte=date_to)
+    if filters:
+        queryset = queryset.filter(**filters)
+
+    fields = [name for name in dimensions if isinstance(PIVOT_DIMENSIONS[name], str)]
+    expressions = {
+        name: PIVOT_DIMENSIONS[name] for name in dimensions
+        if not isinstance(PIVOT_DIMENSIONS[name], str)
+    }
+    sums = {f'sum_{measure}': Sum(measure) for measure in MEASURES}
+    if dimensions:
+        grouped = queryset.values(*fields, **expressions).annotate(**sums).order_by()
+    else:
+        grouped = [queryset.aggregate(**sums)]
+    rows = [
+        {
+            **{name: item[name] for name in dimensions},
+            **{measure: item[f'sum_{measure}'] or 0 for measure in MEASURES},
+        }
+        for item in grouped
+    ]
+
+    if rollup and dimensions:
+        # Измерение может быть None и в обычной строке (нет врача), поэтому итоги помечены subtotal
+        details = rows
+        for row in details:
+            row['subtotal'] = False
+        rows = list(details)
+        for level in range(len(dimensions)):
+            kept = dimensions[:level]
+            totals = defaultdict(lambda: [0, 0, 0])
+            for row in details:
+                counts = totals[tuple(row[name] for name in kept)]
+                for number, measure in enumerate(MEASURES):
+                    counts[number] += row[measure]
+            rolled = [None] * (len(dimensions) - level)
+            rows.extend(
+                {**dict(zip(dimensions, (*key, *rolled))), **dict(zip(MEASURES, counts)), 'subtotal': True}
+                for key, counts in totals.items()
+            )
+    return sorted(rows, key=lambda row: _sort_key(row, dimensions))
@@ -0,0 +1,99 @@
+"""Полнотекстовый поиск пациентов.
+
+На PostgreSQL используется колонка ``search_vector`` (tsvector с русской
+морфологией, поддерживается триггером из миграции 0002) и GIN-индексы
+pg_trgm по идентификационным полям. На SQLite - виртуальная таблица FTS5.
+На остальных СУБД остается поиск через ``icontains``.
+"""
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+SEARCH_CONFIG = 'russian'
+FTS_TABLE = 'patients_patient_fts'
+
+# Поля, по которым ищем подстроку (номера документов, телефоны)
+IDENTITY_FIELDS = [
+    'case_number',
+    'passport_series',
+    'passport_number',
+    'inn',
+    'phone',
+]
+
+NAME_FIELDS = ['last_name', 'first_name', 'middle_name']
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    """Разбивает строку поиска на нормализованные токены"""
+    return [token.lower() for token in TOKEN_RE.findall(query or '')]
+
+
+def _legacy_filter(query):
+    q = Q(address__icontains=query)
+    for field in NAME_FIELDS + IDENTITY_FIELDS:
+        q |= Q(**{f'{field}__icontains': query})
+    return q
+
+
+def _identity_filter(query):
+    q = Q()
+    for field in IDENTITY_FIELDS:
+        q |= Q(**{f'{field}__icontains': query})
+    return q
+
+
+def _sqlite_fts_available():
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def search_patients(queryset, query):
+    """Фильтрует queryset пациентов по строке поиска.
+
+    Возвращает queryset с аннотацией ``search_rank`` (чем больше, тем
+    релевантнее), по которой можно сортировать результаты.
+    """
+    query = (query or '').strip()
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    if connection.vendor == 'postgresql':
+        # Префиксный поиск по каждому слову: "Иван Пет" -> иван:* & пет:*
+        ts_query = SearchQuery(
+            ' & '.join(f'{token}:*' for token in tokens),
+            config=SEARCH_CONFIG,
+            search_type='raw',
+        )
+        return queryset.filter(
+            Q(search_vector=ts_query) | _identity_filter(query)
+        ).annotate(
+            search_rank=SearchRank(F('search_vector'), ts_query)
+        )
+
+    if connection.vendor == 'sqlite' and _sqlite_fts_available():
+        match = ' '.join('"%s"*' % token.replace('"', '') for token in tokens)
+        fts_ids = RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            (match,),
+        )
+        # bm25() возвращает меньшие значения для более релевантных строк
+        rank = RawSQL(
+            f'SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = "patients_patient"."id"',
+            (match,),
+            output_field=FloatField(),
+        )
+        return queryset.filter(
+            Q(id__in=fts_ids) | _identity_filter(query)
+        ).annotate(search_rank=Coalesce(rank, Value(0.0)))
+
+    return queryset.filter(_legacy_filter(query)).annotate(
+        search_rank=Value(0.0, output_field=FloatField())
+    )
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from .caseload import update_caseloads
+from .diagnosis_index import bump_version
+from .models import Diagnosis, Hospitalization, Patient
+from .readmissions import refresh_readmissions
+from .rollups import mark_deleted
+from .stats import bump_generation, invalidate_periods
+
+
+def _tracked_values(instance):
+    # Отложенные поля не читаем (после удаления их уже не загрузить) - их значения дает pre_save/pre_delete
+    loaded = getattr(instance, '_loaded_values', {})
+    return {
+        name: instance.__dict__[name] if name in instance.__dict__ else loaded.get(name)
+        for name in Patient.TRACKED_FIELDS
+    }
+
+
+@receiver(pre_save, sender=Patient)
+@receiver(pre_delete, sender=Patient)
+def load_deferred_values(sender, instance, **kwargs):
+    """Прежние значения отслеживаемых полей, не загруженных вместе с объектом (.only(), .defer())"""
+    if instance._state.adding or instance.pk is None:
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    missing = [name for name in Patient.TRACKED_FIELDS if name not in loaded]
+    if missing:
+        loaded.update(Patient.objects.filter(pk=instance.pk).values(*missing).first() or {})
+        instance._loaded_values = loaded
+
+
+@receiver(post_save, sender=Patient)
+def patient_saved(sender, instance, created, **kwargs):
+    current = _tracked_values(instance)
+    # Объект, созданный не из БД, сравнить не с чем: считаем, что поля не менялись
+    previous = None if created else {**current, **getattr(instance, '_loaded_values', {})}
+    patient_changed(previous, current)
+    # Следующее сохранение этого же объекта сравнивается с текущими значениями
+    instance._loaded_values = current
+
+
+@receiver(post_delete, sender=Patient)
+def patient_deleted(sender, instance, **kwargs):
+    current = _tracked_values(instance)
+    patient_changed({**current, **getattr(instance, '_loaded_values', {})}, None)
+    # Вклад в витрину вычтет следующее обновление refresh_rollups
+    mark_deleted(instance.pk)
+
+
+def patient_changed(previous, current):
+    """Сбросить кэш статистики и обновить счетчики врачей.
+
+    previous и current - значения Patient.TRACKED_FIELDS до и после
+    изменения (None - пациента не было или он удален).
+    """
+    transaction.on_commit(bump_generation)
+
+    # Периоды и врачи и до изменения, и после: пациента могли перенести или передать
+    states = [values for values in (previous, current) if values]
+    admission_dates = {values['admission_date'] for values in states}
+    discharge_dates = {values['discharge_date'] for values in states}
+    physicians = {values['attending_physician_id'] for values in states}
+    scopes = {'all'} | {f'doctor:{pk}' for pk in physicians if pk}
+    transaction.on_commit(lambda: invalidate_periods(admission_dates, discharge_dates, scopes))
+
+    # Счетчики - сразу, в транзакции сохранения пациента
+    update_caseloads(previous, current)
+
+
+@receiver(post_save, sender=Hospitalization)
+@receiver(post_delete, sender=Hospitalization)
+def refresh_patient_readmissions(sender, instance, **kwargs):
+    """Пересчитать повторные госпитализации пациента: эпизод мог встать между другими"""
+    patient_id = instance.patient_id
+    transaction.on_commit(lambda: refresh_readmissions(patient_id=patient_id))
+
+
+@receiver(post_save, sender=Diagnosis)
+@receiver(post_delete, sender=Diagnosis)
+def diagnosis_changed(sender, instance, **kwargs):
+    """Индексы автодополнения в процессах перестраиваются по новой версии справочника"""
+    transaction.on_commit(bump_version)
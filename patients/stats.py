@@ -0,0 +1,359 @@
+"""Агрегированная статистика по пациентам с кэшированием.
+
+Кэш сбрасывается сигналами Patient (см. patients/signals.py): каждое
+сохранение или удаление увеличивает "поколение" статистики, которое
+входит в ключи кэша, поэтому старые значения просто перестают читаться.
+Статистика закончившихся периодов от поколения не зависит: ее ключи
+сбрасываются только при изменении пациентов этих периодов.
+"""
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .caseload import STATUS_FIELDS, get_caseload, top_physicians
+from .diagnoses import group_counts
+from .models import Patient
+
+GENERATION_KEY = 'patients:stats:generation'
+STATUS_COUNTS_TIMEOUT = 300
+# Дашборд сбрасывается сигналами; короткий TTL - страховка (например, смена ФИО врача)
+DASHBOARD_TIMEOUT = 60
+# Закрытые периоды сбрасываются сигналами; TTL - страховка (например, переименование диагноза)
+PERIOD_STATISTICS_TIMEOUT = 60 * 60 * 24
+
+
+def get_generation():
+    """Текущее поколение статистики пациентов"""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def bump_generation():
+    """Инвалидирует всю закэшированную статистику пациентов"""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 2, None)
+
+
+def get_scope(user):
+    """Область видимости пациентов: все или только свои (для врача)"""
+    if user.is_administrator or user.has_perm('patients.view_all_patients'):
+        return 'all'
+    if user.is_doctor:
+        return f'doctor:{user.pk}'
+    return 'all'
+
+
+def scope_queryset(scope):
+    """Queryset пациентов для области видимости из get_scope()"""
+    if scope.startswith('doctor:'):
+        return Patient.objects.filter(attending_physician_id=int(scope.split(':', 1)[1]))
+    return Patient.objects.all()
+
+
+def cache_key(name, scope):
+    return f'patients:stats:{get_generation()}:{name}:{scope}'
+
+
+def get_status_counts(user):
+    """Количество пациентов по каждому статусу одним запросом"""
+    scope = get_scope(user)
+    if scope.startswith('doctor:'):
+        # Свои пациенты врача - из счетчиков по первичному ключу
+        caseload = get_caseload(user.pk)
+        return {
+            status_code: caseload[STATUS_FIELDS[status_code]]
+            for status_code, status_name in Patient.STATUS_CHOICES
+        }
+    key = cache_key('status_counts', scope)
+    counts = cache.get(key)
+    if counts is None:
+        counts = scope_queryset(scope).aggregate(**{
+            status_code: Count('id', filter=Q(status=status_code))
+            for status_code, status_name in Patient.STATUS_CHOICES
+        })
+        cache.set(key, counts, STATUS_COUNTS_TIMEOUT)
+    return counts
+
+
+# Возрастные группы дашборда: (подпись, от, до) в полных годах включительно
+AGE_GROUPS = [
+    ('До 18 лет', None, 17),
+    ('18-30 лет', 18, 30),
+    ('31-50 лет', 31, 50),
+    ('51-70 лет', 51, 70),
+    ('Старше 70 лет', 71, None),
+]
+
+
+MONTH_NAMES = [
+    'Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+    'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь',
+]
+
+
+def years_ago(today, years):
+    """Та же дата years лет назад (29 февраля -> 28 февраля)"""
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        return today.replace(year=today.year - years, day=28)
+
+
+def age_between(today, min_age=None, max_age=None):
+    """Условие на birth_date: полных лет от min_age до max_age включительно"""
+    condition = Q()
+    if min_age is not None:
+        # Исполнилось min_age лет - родился не позже этой даты
+        condition &= Q(birth_date__lte=years_ago(today, min_age))
+    if max_age is not None:
+        # Еще не исполнилось max_age + 1 лет
+        condition &= Q(birth_date__gt=years_ago(today, max_age + 1))
+    return condition
+
+
+def get_dashboard_counts(queryset=None):
+    """Все счетчики дашборда одним агрегирующим запросом.
+
+    Возвращает total, hospitalized, discharged, recent_admissions,
+    recent_discharges, gender_stats (как values('gender').annotate(count))
+    и age_groups (подпись -> количество).
+    """
+    if queryset is None:
+        queryset = Patient.objects.all()
+    now = timezone.now()
+    # Как в Patient.age, чтобы границы групп совпадали с возрастом в карточке
+    today = now.date()
+    thirty_days_ago = now - timedelta(days=30)
+
+    aggregates = {
+        'total': Count('id'),
+        'hospitalized': Count('id', filter=Q(status='HOSPITALIZED')),
+        'discharged': Count('id', filter=Q(status='DISCHARGED')),
+        'recent_admissions': Count('id', filter=Q(admission_date__gte=thirty_days_ago)),
+        'recent_discharges': Count('id', filter=Q(discharge_date__gte=thirty_days_ago)),
+    }
+    for number, (code, label) in enumerate(Patient.Gender.choices):
+        aggregates[f'gender_{number}'] = Count('id', filter=Q(gender=code))
+    for number, (label, min_age, max_age) in enumerate(AGE_GROUPS):
+        aggregates[f'age_{number}'] = Count('id', filter=age_between(today, min_age, max_age))
+
+    row = queryset.aggregate(**aggregates)
+    return {
+        'total': row['total'],
+        'hospitalized': row['hospitalized'],
+        'discharged': row['discharged'],
+        'recent_admissions': row['recent_admissions'],
+        'recent_discharges': row['recent_discharges'],
+        'gender_stats': [
+            {'gender': code, 'count': row[f'gender_{number}']}
+            for number, (code, label) in enumerate(Patient.Gender.choices)
+            if row[f'gender_{number}']
+        ],
+        'age_groups': {
+            label: row[f'age_{number}']
+            for number, (label, min_age, max_age) in enumerate(AGE_GROUPS)
+        },
+    }
+
+
+def get_dashboard_data(user):
+    """Счетчики и последние поступления для дашборда в области видимости пользователя"""
+    scope = get_scope(user)
+    key = cache_key('dashboard', scope)
+    data = cache.get(key)
+    if data is None:
+        queryset = scope_queryset(scope)
+        data = get_dashboard_counts(queryset)
+        # В кэш кладем только поля, которые выводит дашборд
+        data['recent_patients'] = list(
+            queryset.only(
+                'case_number', 'last_name', 'first_name', 'middle_name',
+                'birth_date', 'admission_date', 'status',
+            ).order_by('-admission_date')[:10]
+        )
+        cache.set(key, data, DASHBOARD_TIMEOUT)
+    return data
+
+
+def get_doctor_stats():
+    """Врачи с наибольшим числом пациентов (для администраторов и аналитиков)"""
+    key = cache_key('doctor_stats', 'all')
+    stats = cache.get(key)
+    if stats is None:
+        stats = [
+            {
+                'attending_physician': caseload.physician_id,
+                'attending_physician__last_name': caseload.physician.last_name,
+                'attending_physician__first_name': caseload.physician.first_name,
+                'patient_count': caseload.total,
+                'hospitalized_count': caseload.hospitalized,
+                'recent_discharges': caseload.recent_discharges,
+            }
+            for caseload in top_physicians(5)
+        ]
+        cache.set(key, stats, DASHBOARD_TIMEOUT)
+    return stats
+
+
+def get_doctor_caseload(user):
+    """Счетчики своих пациентов врача для дашборда"""
+    key = cache_key('caseload', f'doctor:{user.pk}')
+    caseload = cache.get(key)
+    if caseload is None:
+        caseload = get_caseload(user.pk)
+        cache.set(key, caseload, DASHBOARD_TIMEOUT)
+    return caseload
+
+
+def _count_by_month(queryset, field):
+    """Количество записей по месяцам поля field: {номер месяца: количество}"""
+    rows = queryset.annotate(
+        month=TruncMonth(field)
+    ).order_by().values('month').annotate(count=Count('id')).values_list('month', 'count')
+    return {month.month: count for month, count in rows}
+
+
+def period_bounds(year, month=None):
+    """Первый и последний день года или месяца года"""
+    if month:
+        first = date(year, month, 1)
+        last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        return first, last
+    return date(year, 1, 1), date(year, 12, 31)
+
+
+def is_period_closed(year, month=None):
+    """Период уже закончился: его данные меняют только поздние исправления"""
+    return period_bounds(year, month)[1] < timezone.localdate()
+
+
+def period_cache_key(name, scope, year, month=None):
+    # Без поколения: закрытые периоды сбрасываются точечно, см. invalidate_periods()
+    return f'patients:stats:period:{name}:{scope}:{year}:{month or 0}'
+
+
+def _cached_period(key, closed, compute):
+    """Результат закрытого периода берется из кэша, открытого - считается заново"""
+    if not closed:
+        return compute()
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, PERIOD_STATISTICS_TIMEOUT)
+    return result
+
+
+def _period_summary(scope, year, month=None):
+    """Поступившие за период: статусы, возрастные группы, топ диагнозов"""
+    period = scope_queryset(scope).filter(admission_date__year=year)
+    if month:
+        period = period.filter(admission_date__month=month)
+
+    aggregates = {'total': Count('id')}
+    for code, label in Patient.STATUS_CHOICES:
+        aggregates[code] = Count('id', filter=Q(status=code))
+    # Возраст на конец периода: для закрытого периода результат не "стареет"
+    reference = min(timezone.now().date(), period_bounds(year, month)[1])
+    for number, (label, min_age, max_age) in enumerate(AGE_GROUPS):
+        aggregates[f'age_{number}'] = Count('id', filter=age_between(reference, min_age, max_age))
+    row = period.aggregate(**aggregates)
+
+    # Соединение со справочником по ключу admission_mkb вместо сравнения строк кодов
+    top_diagnoses = list(
+        period.filter(admission_mkb__isnull=False).order_by().values(
+            code=F('admission_mkb__code'), name=F('admission_mkb__name'),
+        ).annotate(patient_count=Count('id')).order_by('-patient_count', 'code')[:10]
+    )
+
+    return {
+        'total': row['total'],
+        'status_counts': {code: row[code] for code, label in Patient.STATUS_CHOICES},
+        'age_stats': {
+            label: row[f'age_{number}']
+            for number, (label, min_age, max_age) in enumerate(AGE_GROUPS)
+        },
+        'top_diagnoses': top_diagnoses,
+    }
+
+
+def _mkb_groups(scope, year, month=None):
+    """Поступившие за период по классам и блокам МКБ-10"""
+    period = scope_queryset(scope).filter(admission_date__year=year)
+    if month:
+        period = period.filter(admission_date__month=month)
+    return group_counts('admission', queryset=period)
+
+
+def _monthly_stats(scope, year):
+    """Поступления и выписки по месяцам года"""
+    queryset = scope_queryset(scope)
+    admissions = _count_by_month(queryset.filter(admission_date__year=year), 'admission_date')
+    discharges = _count_by_month(queryset.filter(discharge_date__year=year), 'discharge_date')
+    return [
+        {
+            'month': number,
+            'name': name,
+            'admissions': admissions.get(number, 0),
+            'discharges': discharges.get(number, 0),
+        }
+        for number, name in enumerate(MONTH_NAMES, 1)
+    ]
+
+
+def get_period_statistics(scope, year, month=None):
+    """Статистика за год или месяц года в области видимости scope.
+
+    Несколько запросов независимо от объема данных: статусы и возрастные
+    группы - одним агрегатом, поступления и выписки по месяцам - GROUP BY
+    по TruncMonth, топ диагнозов - GROUP BY по ссылке на справочник, классы
+    и блоки МКБ-10 - подзапросом по диапазону дерева. Закрытые периоды
+    кэшируются до изменения пациента, попадающего в период; таблица по
+    месяцам кэшируется отдельно, когда закончился весь год.
+    """
+    stats = _cached_period(
+        period_cache_key('summary', scope, year, month),
+        is_period_closed(year, month),
+        lambda: _period_summary(scope, year, month),
+    )
+    monthly_stats = _cached_period(
+        period_cache_key('monthly', scope, year),
+        is_period_closed(year),
+        lambda: _monthly_stats(scope, year),
+    )
+    mkb_groups = _cached_period(
+        period_cache_key('mkb_groups', scope, year, month),
+        is_period_closed(year, month),
+        lambda: _mkb_groups(scope, year, month),
+    )
+    return {**stats, 'monthly_stats': monthly_stats, 'mkb_groups': mkb_groups}
+
+
+def invalidate_periods(admission_dates, discharge_dates, scopes):
+    """Сбрасывает кэш периодов, которых касаются указанные даты.
+
+    Дата поступления входит в сводку своего месяца и года и в таблицу по
+    месяцам, дата выписки - только в таблицу по месяцам.
+    """
+    keys = []
+    for value in admission_dates:
+        if value is None:
+            continue
+        local = timezone.localtime(value)
+        for scope in scopes:
+            for name in ('summary', 'mkb_groups'):
+                keys.append(period_cache_key(name, scope, local.year))
+                keys.append(period_cache_key(name, scope, local.year, local.month))
+    for value in [*admission_dates, *discharge_dates]:
+        if value is None:
+            continue
+        for scope in scopes:
+            keys.append(period_cache_key('monthly', scope, timezone.localtime(value).year))
+    cache.delete_many(keys)
@@ -1,3 +1,1713 @@
-from django.test import TestCase
+import csv
+from datetime import date, datetime, timedelta
+import io
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core import signing
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
+import tablib
+
+from . import diagnosis_index, jobs
+from .admin import PatientResource
+from .caseload import CASELOAD_FIELDS, get_caseload, reconcile_caseloads
+from .diagnoses import diagnosis_frequency, group_counts, link_mkb_codes
+from .diagnosis_index import DiagnosisIndex, bump_version, bundle_url, get_version, query_codes, query_variants, search_diagnoses
+from .export import EXPORT_GROUPS, export_headers, export_rows, iter_csv, iter_export_rows, stream_xlsx
+from .forms import PatientForm, PatientSelectionForm
+from .mkb import fold_mkb_code, normalize_mkb_code
+from .mkb_loader import iter_json, load_diagnoses, load_file, parse_entry, read_classifier
+from .models import CaseNumberSequence, Diagnosis, DiagnosisVersion, ExportJob, Hospitalization, Patient, PatientRollupState
+from .occupancy import NO_DEPARTMENT, TOTAL_LABEL, daily_census, length_of_stay, load_episodes, los_distribution, los_summary, occupancy_report
+from .pagination import CURSOR_SALT, InvalidCursor, KeysetPaginator
+from .readmissions import readmission_rates, refresh_readmissions
+from .rollups import pivot, refresh_daily_rollups
+from .search import search_patients
+from .stats import AGE_GROUPS, get_dashboard_counts, get_dashboard_data, get_doctor_caseload, get_doctor_stats, get_period_statistics, get_status_counts, is_period_closed, period_bounds, years_ago
+from users.models import User
+
+
+def make_user(username, role='DOCTOR', **kwargs):
+    return User.objects.create_user(username, email=f'{username}@example.com', password='x', role=role, **kwargs)
+
+
+def make_patient(number=0, **kwargs):
+    """Пациент с заполненными обязательными полями"""
+    values = {
+        'last_name': f'Пациентов{number}',
+        'first_name': 'Иван',
+        'gender': 'M',
+        'birth_date': date(1980, 1, 1),
+        'address': 'г. Москва',
+        'admission_diagnosis': 'Диагноз',
+        'admission_date': timezone.make_aware(datetime(2025, 3, 1, 10, 0)),
+    }
+    values.update(kwargs)
+    patient = Patient(**values)
+    patient.save()
+    return patient
+
+
+class PatientSearchTests(TestCase):
+    """Поиск пациентов по ФИО, документам и адресу"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_user('admin', role='ADMIN')
+        cls.petrov = make_patient(0, last_name='Петров', first_name='Иван', middle_name='Сергеевич',
+                                  inn='770123456789', phone='+79161234567')
+        cls.petrova = make_patient(1, last_name='Петрова', first_name='Анна', address='г. Тула, ул. Ленина')
+        cls.sidorov = make_patient(2, last_name='Сидоров', first_name='Петр')
+
+    def found(self, query):
+        return set(search_patients(Patient.objects.all(), query).values_list('last_name', flat=True))
+
+    def test_word_prefixes_in_any_order(self):
+        self.assertEqual(self.found('петр'), {'Петров', 'Петрова', 'Сидоров'})
+        self.assertEqual(self.found('Иван Петр'), {'Петров'})
+        self.assertEqual(self.found('сидоров петр'), {'Сидоров'})
+        self.assertEqual(self.found('ленина'), {'Петрова'})
+        self.assertEqual(self.found('Кузнецов'), set())
+
+    def test_identity_fields_match_substring(self):
+        self.assertEqual(self.found('23456'), {'Петров'})
+        self.assertEqual(self.found(self.sidorov.case_number), {'Сидоров'})
+
+    def test_empty_query_keeps_all_rows(self):
+        queryset = search_patients(Patient.objects.all(), '  ')
+        self.assertEqual(queryset.count(), 3)
+        self.assertEqual({patient.search_rank for patient in queryset}, {0.0})
+
+    def test_index_follows_updates_and_deletes(self):
+        self.petrova.last_name = 'Кузнецова'
+        self.petrova.save()
+        self.assertEqual(self.found('петр'), {'Петров', 'Сидоров'})
+        self.assertEqual(self.found('кузнецова'), {'Кузнецова'})
+        self.sidorov.delete()
+        self.assertEqual(self.found('петр'), {'Петров'})
+
+    def test_list_view_orders_by_rank(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('patients:patient_list'), {'query': 'петр'})
+        self.assertEqual(response.status_code, 200)
+        ranks = [patient.search_rank for patient in response.context['page_obj']]
+        self.assertEqual(len(ranks), 3)
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+
+class KeysetPaginationTests(TestCase):
+    """Keyset-пагинация списка пациентов и подписанные курсоры"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_user('admin', role='ADMIN')
+        start = timezone.make_aware(datetime(2025, 1, 1, 9, 0))
+        # По три пациента на дату: порядок внутри даты задает id
+        cls.patients = [
+            make_patient(number, admission_date=start + timedelta(days=number // 3))
+            for number in range(11)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, paginator):
+        pages = []
+        page = paginator.page()
+        pages.append(page)
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            pages.append(page)
+        return pages
+
+    def test_pages_cover_all_rows_once_in_order(self):
+        for ordering in ('-admission_date', 'admission_date', 'last_name'):
+            with self.subTest(ordering=ordering):
+                queryset = Patient.objects.all()
+                paginator = KeysetPaginator(queryset, ordering, per_page=4)
+                pages = self.walk(paginator)
+                seen = [patient.pk for page in pages for patient in page]
+                expected = list(queryset.order_by(ordering, ('-' if ordering.startswith('-') else '') + 'pk')
+                                .values_list('pk', flat=True))
+                self.assertEqual(seen, expected)
+                self.assertEqual([len(page) for page in pages], [4, 4, 3])
+                self.assertFalse(pages[0].has_previous())
+
+    def test_previous_cursor_returns_previous_page(self):
+        paginator = KeysetPaginator(Patient.objects.all(), '-admission_date', per_page=4)
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        third = paginator.page(second.next_cursor)
+        back = paginator.page(third.previous_cursor)
+        self.assertEqual([p.pk for p in back], [p.pk for p in second])
+        self.assertTrue(back.has_next())
+        self.assertTrue(back.has_previous())
+        self.assertEqual([p.pk for p in paginator.page(back.previous_cursor)], [p.pk for p in first])
+
+    def test_tampered_cursor_is_rejected(self):
+        paginator = KeysetPaginator(Patient.objects.all(), '-admission_date', per_page=4)
+        cursor = paginator.page().next_cursor
+        with self.assertRaises(InvalidCursor):
+            paginator.page(cursor[:-2] + ('A' if cursor[-2] != 'A' else 'B') + cursor[-1])
+        forged = signing.dumps({'o': '-admission_date', 'v': '2025-01-01', 'pk': 1, 'd': 'next'}, salt='other')
+        with self.assertRaises(InvalidCursor):
+            paginator.page(forged)
+
+    def test_cursor_of_other_ordering_is_rejected(self):
+        cursor = KeysetPaginator(Patient.objects.all(), 'last_name', per_page=4).page().next_cursor
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(Patient.objects.all(), '-admission_date', per_page=4).page(cursor)
+        bad_direction = signing.dumps(
+            {'o': 'last_name', 'v': 'Пациентов1', 'pk': 1, 'd': 'sideways'}, salt=CURSOR_SALT, compress=True
+        )
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(Patient.objects.all(), 'last_name', per_page=4).page(bad_direction)
+
+    def test_list_view_follows_cursor_and_ignores_invalid_one(self):
+        self.client.force_login(self.admin)
+        url = reverse('patients:patient_list')
+        response = self.client.get(url)
+        self.assertTrue(response.context['keyset'])
+        first_page = [patient.pk for patient in response.context['page_obj']]
+        self.assertEqual(len(first_page), 11)
+
+        response = self.client.get(url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([patient.pk for patient in response.context['page_obj']], first_page)
+
+        # Старые ссылки ?page=N обслуживает обычный пагинатор
+        response = self.client.get(url, {'page': 1})
+        self.assertFalse(response.context['keyset'])
+
+
+class StatusCountsTests(TestCase):
+    """Счетчики по статусам: один запрос на область видимости и сброс кэша"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_user('admin', role='ADMIN')
+        cls.doctor = make_user('doctor')
+        make_patient(0, attending_physician=cls.doctor)
+        make_patient(1, attending_physician=cls.doctor, status='DISCHARGED')
+        make_patient(2, status='DIED')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_per_scope(self):
+        self.assertEqual(get_status_counts(self.admin),
+                         {'HOSPITALIZED': 1, 'DISCHARGED': 1, 'TRANSFERRED': 0, 'DIED': 1})
+        self.assertEqual(get_status_counts(self.doctor),
+                         {'HOSPITALIZED': 1, 'DISCHARGED': 1, 'TRANSFERRED': 0, 'DIED': 0})
+
+    def test_cached_until_patient_changes(self):
+        with self.assertNumQueries(1):
+            get_status_counts(self.admin)
+        with self.assertNumQueries(0):
+            get_status_counts(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_patient(3, status='TRANSFERRED')
+        self.assertEqual(get_status_counts(self.admin)['TRANSFERRED'], 1)
+
+
+class RowPermissionTests(TestCase):
+    """Права на строки списка, вычисленные в SQL, совпадают с методами модели"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [make_user(role.lower(), role=role)
+                     for role in ('ADMIN', 'DOCTOR', 'NURSE', 'REGISTRAR', 'ANALYST')]
+        cls.doctor = cls.users[1]
+        other = make_user('other_doctor')
+        for number, (physician, status) in enumerate([
+            (cls.doctor, 'HOSPITALIZED'), (cls.doctor, 'DISCHARGED'),
+            (other, 'HOSPITALIZED'), (None, 'HOSPITALIZED'), (None, 'DIED'),
+        ]):
+            make_patient(number, attending_physician=physician, status=status)
+
+    def test_annotations_match_model_methods(self):
+        for user in self.users:
+            for patient in Patient.objects.with_permissions(user):
+                with self.subTest(role=user.role, patient=patient.last_name):
+                    can_edit = patient.user_can_edit(user)
+                    self.assertEqual(patient.can_edit, can_edit)
+                    self.assertEqual(patient.can_delete, patient.user_can_delete(user))
+                    self.assertEqual(patient.can_discharge, can_edit and patient.status == 'HOSPITALIZED')
+
+    def test_list_view_reads_flags_from_rows(self):
+        cache.clear()
+        self.client.force_login(self.doctor)
+        response = self.client.get(reverse('patients:patient_list'))
+        rows = {patient.status: patient for patient in response.context['patients_with_perms']}
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(rows['HOSPITALIZED'].can_discharge)
+        self.assertFalse(rows['DISCHARGED'].can_discharge)
+        self.assertFalse(rows['HOSPITALIZED'].can_delete)
+
+
+class CsvExportTests(TestCase):
+    """Потоковый CSV-экспорт"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.patients = [make_patient(number, attending_physician=cls.doctor) for number in range(5)]
+        cls.stranger = make_patient(5)
+
+    def read(self, content):
+        return list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+
+    def test_header_first_then_chunks(self):
+        chunks = list(iter_csv(Patient.objects.order_by('pk'), ['basic', 'notes'], chunk_size=2))
+        # Заголовок, затем порции по 2, 2, 2 строки из 6
+        self.assertEqual(len(chunks), 4)
+        self.assertTrue(chunks[0].startswith('\ufeff'.encode('utf-8')))
+        self.assertEqual(self.read(chunks[0]), [export_headers(['basic', 'notes'])])
+        rows = self.read(b''.join(chunks))
+        self.assertEqual(len(rows), 7)
+        # BOM только в начале файла
+        self.assertEqual(b''.join(chunks).count('\ufeff'.encode('utf-8')), 1)
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [patient.case_number for patient in self.patients + [self.stranger]])
+        self.assertEqual(rows[1][1:4], ['Пациентов0', 'Иван', ''])
+
+    def test_no_field_groups_gives_empty_file(self):
+        self.assertEqual(list(iter_csv(Patient.objects.all(), [])), [])
+
+    def test_view_streams_csv_of_own_patients(self):
+        self.client.force_login(self.doctor)
+        url = reverse('patients:patient_export')
+        data = {'export_format': 'csv', 'include_fields': ['basic']}
+        response = self.client.post(url, data)
+        self.assertTrue(response.streaming)
+        self.assertEqual(len(self.read(b''.join(response.streaming_content))), 6)
+
+        response = self.client.post(url, dict(data, ids=f'{self.stranger.pk}'))
+        self.assertFalse(response.streaming)
+        self.assertNotIn('Content-Disposition', response)
+
+
+class XlsxExportTests(TestCase):
+    """XLSX-экспорт в режиме write-only"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(3):
+            make_patient(number, middle_name='Петрович' if number else '')
+
+    def test_sheet_contains_headers_and_rows(self):
+        fields = ['basic', 'hospitalization']
+        response = stream_xlsx(Patient.objects.order_by('pk'), fields)
+        self.assertTrue(response['Content-Disposition'].startswith('attachment; filename="patients_export_'))
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)), read_only=True)
+        sheet = workbook['Пациенты']
+        rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+        self.assertEqual(rows[0], export_headers(fields))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual([row[1] for row in rows[1:]], ['Пациентов0', 'Пациентов1', 'Пациентов2'])
+        self.assertEqual(rows[2][3], 'Петрович')
+        admitted = Patient.objects.order_by('pk').first().admission_date
+        self.assertEqual(rows[1][rows[0].index('Дата поступления')], admitted.strftime('%d.%m.%Y %H:%M'))
+
+    def test_empty_selection_writes_header_only(self):
+        response = stream_xlsx(Patient.objects.none(), ['documents'])
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)), read_only=True)
+        self.assertEqual([list(row) for row in workbook.active.iter_rows(values_only=True)],
+                         [export_headers(['documents'])])
+
+
+def legacy_export_row(patient, include_fields):
+    """Прежний построитель строки экспорта по объекту пациента (эталон для сравнения)"""
+    def date_text(value, pattern):
+        return value.strftime(pattern) if value else ''
+
+    def user_name(user):
+        return user.get_full_name() if user else ''
+
+    row = {}
+    if 'basic' in include_fields:
+        row.update({
+            'Номер истории болезни': patient.case_number,
+            'Фамилия': patient.last_name,
+            'Имя': patient.first_name,
+            'Отчество': patient.middle_name or '',
+            'Пол': patient.get_gender_display(),
+            'Дата рождения': date_text(patient.birth_date, '%d.%m.%Y'),
+            'Возраст': patient.age,
+            'Место рождения': patient.birth_place or '',
+            'Гражданство': patient.citizenship or 'РФ',
+            'Адрес': patient.address,
+            'Телефон': patient.phone or '',
+        })
+    if 'documents' in include_fields:
+        row.update({
+            'Серия паспорта': patient.passport_series or '',
+            'Номер паспорта': patient.passport_number or '',
+            'Кем выдан': patient.passport_issued_by or '',
+            'Дата выдачи': date_text(patient.passport_issue_date, '%d.%m.%Y'),
+            'ИНН': patient.inn or '',
+            'Страховой полис': patient.insurance_policy or '',
+        })
+    if 'hospitalization' in include_fields:
+        row.update({
+            'Дата поступления': date_text(patient.admission_date, '%d.%m.%Y %H:%M'),
+            'Откуда поступил': patient.admission_from or '',
+            'Кем доставлен': patient.delivered_by or '',
+            'Диагноз направившего учреждения': patient.referral_diagnosis or '',
+            'Диагноз при поступлении': patient.admission_diagnosis,
+            'Код МКБ при поступлении': patient.admission_mkb_code or '',
+            'Лечащий врач': user_name(patient.attending_physician),
+        })
+    if 'discharge' in include_fields:
+        row.update({
+            'Дата выписки': date_text(patient.discharge_date, '%d.%m.%Y %H:%M'),
+            'Диагноз при выписке': patient.discharge_diagnosis or '',
+            'Код МКБ при выписке': patient.discharge_mkb_code or '',
+            'Исход заболевания': patient.get_outcome_display() if patient.outcome else '',
+            'Трудоспособность': patient.get_work_capacity_display() if patient.work_capacity else '',
+            'Статус': patient.get_status_display(),
+        })
+    if 'notes' in include_fields:
+        row.update({
+            'Примечания': patient.notes or '',
+            'Дата создания': date_text(patient.created_at, '%d.%m.%Y %H:%M'),
+            'Создал': user_name(patient.created_by),
+        })
+    return row
+
+
+class ColumnExportTests(TestCase):
+    """Построение строк экспорта по колонкам совпадает с прежним построителем"""
+
+    @classmethod
+    def setUpTestData(cls):
+        doctor = make_user('doctor', first_name='Анна', last_name='Врачева')
+        registrar = make_user('registrar', role='REGISTRAR')
+        make_patient(0, attending_physician=doctor, created_by=registrar, citizenship='',
+                     birth_date=date(1990, 12, 31), passport_issue_date=date(2010, 1, 5))
+        make_patient(1, middle_name='Петрович', gender='F', citizenship='Казахстан', birth_place='г. Тула',
+                     status='DISCHARGED', discharge_date=timezone.make_aware(datetime(2025, 3, 20, 23, 30)),
+                     outcome='IMPROVEMENT', work_capacity='DISABLED', discharge_mkb_code='F20.0',
+                     notes='Примечание', created_by=doctor)
+        make_patient(2, birth_date=date(2000, 2, 29), inn='770123456789', phone='+79161234567')
+
+    def test_rows_match_legacy_builder(self):
+        fields = list(EXPORT_GROUPS)
+        patients = Patient.objects.order_by('pk')
+        expected = [legacy_export_row(patient, fields) for patient in patients]
+        self.assertEqual(export_rows(patients, fields), expected)
+        self.assertEqual([list(row) for row in expected], [export_headers(fields)] * 3)
+
+    def test_each_group_on_its_own(self):
+        patients = Patient.objects.order_by('pk')
+        for group in EXPORT_GROUPS:
+            with self.subTest(group=group):
+                self.assertEqual(export_rows(patients, [group]),
+                                 [legacy_export_row(patient, [group]) for patient in patients])
+
+    def test_rows_come_in_chunks_without_related_queries(self):
+        patients = Patient.objects.order_by('pk')
+        with self.assertNumQueries(1):
+            rows = list(iter_export_rows(patients, list(EXPORT_GROUPS), chunk_size=2))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(list(iter_export_rows(patients, [])), [])
+
+    def test_empty_citizenship_becomes_rf_and_others_kept(self):
+        patients = Patient.objects.order_by('pk')
+        self.assertEqual([row['Гражданство'] for row in export_rows(patients, ['basic'])],
+                         ['РФ', 'Казахстан', 'РФ'])
+        self.assertEqual([row['Гражданство'] for row in export_rows(patients, ['basic'])],
+                         [legacy_export_row(patient, ['basic'])['Гражданство'] for patient in patients])
+
+
+class ExportJobTests(TestCase):
+    """Фоновый экспорт: очередь, прогресс, ошибки и срок хранения файлов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.other = make_user('other')
+        for number in range(3):
+            make_patient(number, attending_physician=cls.doctor)
+        make_patient(3, attending_physician=cls.other)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = FileSystemStorage(location=directory.name)
+        for patcher in (mock.patch.object(ExportJob._meta.get_field('file'), 'storage', storage),
+                        # Задача закрывает подключение своего потока; в тесте поток один
+                        mock.patch.object(jobs, 'connection')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def status(self, job, user=None):
+        self.client.force_login(user or self.doctor)
+        return self.client.get(reverse('patients:api_export_job', args=[job.pk]))
+
+    def test_job_builds_file_for_owner(self):
+        job = self.create_job()
+        self.assertEqual((job.status, job.total), ('PENDING', 3))
+        jobs.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.progress), ('DONE', 3, 100))
+        self.assertIsNotNone(job.expires_at)
+        with job.file.open('rb') as handle:
+            self.assertEqual(len(handle.read().decode('utf-8-sig').splitlines()), 4)
+
+        data = self.status(job).json()
+        self.assertEqual(data['status'], 'DONE')
+        response = self.client.get(data['download_url'])
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        # Чужая задача не видна ни в API, ни для скачивания
+        self.assertEqual(self.status(job, self.other).status_code, 404)
+        self.assertEqual(self.client.get(data['download_url']).status_code, 404)
+
+    def test_job_runs_once(self):
+        job = self.create_job()
+        jobs.run_job(job.pk)
+        finished = ExportJob.objects.get(pk=job.pk).finished_at
+        self.assertFalse(jobs.claim_job(job.pk))
+        jobs.run_job(job.pk)
+        self.assertEqual(ExportJob.objects.get(pk=job.pk).finished_at, finished)
+
+    def test_progress_is_saved_per_chunk(self):
+        job = self.create_job()
+        with mock.patch.object(jobs, 'EXPORT_CHUNK_SIZE', 2):
+            rows = jobs._track_progress(job.pk, iter(range(3)))
+            self.assertEqual(list(rows), [0, 1, 2])
+        job.refresh_from_db()
+        self.assertEqual((job.processed, job.progress), (2, 66))
+
+    def test_failure_is_reported(self):
+        job = self.create_job()
+
+        def broken_writer(rows, headers, fileobj):
+            raise OSError('Нет места на диске')
+
+        with mock.patch.dict(jobs.EXPORT_WRITERS, {'csv': broken_writer}), self.assertLogs('patients.jobs'):
+            jobs.run_job(job.pk)
+        data = self.status(job).json()
+        self.assertEqual((data['status'], data['error'], data['download_url']),
+                         ('FAILED', 'Нет места на диске', None))
+        self.assertFalse(ExportJob.objects.get(pk=job.pk).file)
+
+    def test_stale_and_expired_jobs(self):
+        job = self.create_job()
+        ExportJob.objects.filter(pk=job.pk).update(status='RUNNING')
+        self.assertEqual(jobs.fail_stale_jobs(), 0)
+        ExportJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.fail_stale_jobs(), 1)
+        self.assertEqual(ExportJob.objects.get(pk=job.pk).error, 'Экспорт прерван')
+
+        done = self.create_job()
+        jobs.run_job(done.pk)
+        done.refresh_from_db()
+        storage, name = done.file.storage, done.file.name
+        self.assertTrue(storage.exists(name))
+        ExportJob.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(jobs.delete_expired_jobs(), 2)
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(ExportJob.objects.exists())
+
+    def create_job(self, export_format='csv', filters=None):
+        with self.captureOnCommitCallbacks() as callbacks:
+            job = jobs.enqueue_export(self.doctor, filters or {}, export_format, ['basic'], total=3)
+        # Задача уходит в пул только после коммита
+        self.assertEqual(len(callbacks), 1)
+        return job
+
+    def test_job_selects_patients_visible_to_owner(self):
+        stranger = Patient.objects.get(attending_physician=self.other)
+        own = Patient.objects.filter(attending_physician=self.doctor).order_by('pk')[0]
+        job = self.create_job(filters={'ids': f'{own.pk},{stranger.pk}'})
+        self.assertEqual(list(jobs.selected_patients(job)), [own])
+        job.filters = {'date_from': 'вчера'}
+        with self.assertRaises(ValueError):
+            jobs.selected_patients(job)
+
+    @override_settings(EXPORT_SYNC_MAX_ROWS=2)
+    def test_large_export_is_queued(self):
+        self.client.force_login(self.doctor)
+        data = {'export_format': 'json', 'include_fields': ['basic'], 'status': 'HOSPITALIZED'}
+        with mock.patch.object(jobs, 'get_executor') as executor, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('patients:patient_export'), data)
+        job = ExportJob.objects.get()
+        self.assertRedirects(response, reverse('patients:export_job_detail', args=[job.pk]))
+        executor.return_value.submit.assert_called_once_with(jobs.run_job, job.pk)
+        self.assertEqual((job.user, job.total, job.export_format), (self.doctor, 3, 'json'))
+        self.assertEqual(job.filters['status'], 'HOSPITALIZED')
+
+        # Небольшая выгрузка отдается сразу
+        ids = ','.join(str(pk) for pk in Patient.objects.filter(attending_physician=self.doctor)
+                       .values_list('pk', flat=True)[:2])
+        response = self.client.post(reverse('patients:patient_export'), dict(data, ids=ids))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+
+class PatientSelectionTests(TestCase):
+    """Выбор пациентов для экспорта по критериям списка"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.nurse = make_user('nurse', role='NURSE')
+        cls.own = make_patient(0, last_name='Петров', attending_physician=cls.doctor)
+        cls.discharged = make_patient(1, attending_physician=cls.doctor, status='DISCHARGED', gender='F',
+                                      admission_date=timezone.make_aware(datetime(2025, 1, 10, 12, 0)))
+        cls.stranger = make_patient(2, last_name='Петрова')
+
+    def select(self, data, user):
+        form = PatientSelectionForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        return form, set(form.filter_queryset(Patient.objects.visible_to(user)))
+
+    def test_visible_to_by_role(self):
+        self.assertEqual(set(Patient.objects.visible_to(self.doctor)), {self.own, self.discharged})
+        self.assertEqual(Patient.objects.visible_to(self.nurse).count(), 3)
+
+    def test_filters_and_ids(self):
+        self.assertEqual(self.select({'query': 'петров'}, self.nurse)[1], {self.own, self.stranger})
+        self.assertEqual(self.select({'query': 'петров'}, self.doctor)[1], {self.own})
+        self.assertEqual(self.select({'status': 'DISCHARGED', 'gender': 'F'}, self.nurse)[1], {self.discharged})
+        self.assertEqual(self.select({'date_to': '2025-02-01'}, self.nurse)[1], {self.discharged})
+        ids = f' {self.stranger.pk}, {self.own.pk},'
+        self.assertEqual(self.select({'ids': ids}, self.nurse)[1], {self.own, self.stranger})
+        self.assertFalse(PatientSelectionForm({'ids': '1,два'}).is_valid())
+
+    def test_filter_spec_repeats_selection(self):
+        form, selected = self.select({'query': 'Петров', 'date_from': '2025-02-01', 'ids': f'{self.own.pk}'},
+                                     self.nurse)
+        self.assertEqual(form.filter_spec, {'query': 'Петров', 'status': '', 'gender': '', 'date_from': '2025-02-01',
+                                            'date_to': '', 'ids': f'{self.own.pk}'})
+        self.assertEqual(self.select(form.filter_spec, self.nurse)[1], selected)
+
+    def test_export_page_counts_selection(self):
+        self.client.force_login(self.doctor)
+        response = self.client.get(reverse('patients:patient_export'), {'status': 'HOSPITALIZED'})
+        self.assertEqual((response.context['total_patients'], response.context['selected_patients']), (2, 1))
+        self.assertEqual(response.context['form'].initial['status'], 'HOSPITALIZED')
+
+
+class CaseNumberTests(TestCase):
+    """Номера историй болезни из счетчика года"""
+
+    def setUp(self):
+        self.year = timezone.now().year
+
+    def counter(self):
+        return CaseNumberSequence.objects.get(year=self.year).last_value
+
+    def test_numbers_are_sequential_per_year(self):
+        numbers = [make_patient(number).case_number for number in range(3)]
+        self.assertEqual(numbers, [f'{self.year}-0001', f'{self.year}-0002', f'{self.year}-0003'])
+        self.assertEqual(self.counter(), 3)
+
+    def test_counter_continues_existing_numbers(self):
+        make_patient(0, case_number=f'{self.year}-0041')
+        make_patient(1, case_number=f'{self.year}-garbage')
+        # Счетчика года нет (номера перенесены до его появления)
+        CaseNumberSequence.objects.all().delete()
+        self.assertEqual(make_patient(2).case_number, f'{self.year}-0042')
+
+    def test_explicit_number_advances_counter(self):
+        self.assertEqual(make_patient(0).case_number, f'{self.year}-0001')
+        make_patient(1, case_number=f'{self.year}-0007')
+        self.assertEqual(self.counter(), 7)
+        self.assertEqual(make_patient(2).case_number, f'{self.year}-0008')
+        # Номер меньше выданных счетчик назад не отводит
+        make_patient(3, case_number=f'{self.year}-0005')
+        make_patient(4, case_number=f'{self.year}-архив')
+        self.assertEqual(make_patient(5).case_number, f'{self.year}-0009')
+        # Счетчик другого года создается сразу с явным номером
+        make_patient(6, case_number='2019-0120')
+        self.assertEqual(CaseNumberSequence.objects.get(year=2019).last_value, 120)
+
+    def test_numbers_past_9999_keep_counting(self):
+        CaseNumberSequence.objects.create(year=self.year, last_value=9999)
+        self.assertEqual(make_patient(0).case_number, f'{self.year}-10000')
+        self.assertEqual(make_patient(1).case_number, f'{self.year}-10001')
+
+    def test_allocate_reserves_a_range(self):
+        first = CaseNumberSequence.objects.allocate(self.year, 5)
+        second = CaseNumberSequence.objects.allocate(self.year, 2)
+        self.assertEqual(list(first), [1, 2, 3, 4, 5])
+        self.assertEqual(list(second), [6, 7])
+
+    def test_allocator_hits_counter_once_per_block(self):
+        CaseNumberSequence.objects.create(year=self.year)
+        allocator = CaseNumberSequence.objects.allocator(block_size=3)
+        numbers = [next(allocator) for _ in range(3)]
+        self.assertEqual(self.counter(), 3)
+        with self.assertNumQueries(1):
+            numbers.append(next(allocator))
+        with self.assertNumQueries(0):
+            numbers.append(next(allocator))
+        self.assertEqual(numbers, [f'{self.year}-{number:04d}' for number in range(1, 6)])
+        self.assertEqual(self.counter(), 6)
+
+    def test_import_numbers_new_rows_from_one_block(self):
+        dataset = tablib.Dataset(headers=['case_number', 'last_name', 'first_name', 'gender', 'birth_date',
+                                          'address', 'admission_diagnosis', 'admission_date'])
+        for number in range(3):
+            dataset.append(['', f'Импортов{number}', 'Иван', 'M', '1980-01-01', 'г. Москва', 'Диагноз',
+                            '2025-03-01 10:00'])
+        dataset.append([f'{self.year}-0500', 'Сномеров', 'Иван', 'M', '1980-01-01', 'г. Москва', 'Диагноз',
+                        '2025-03-01 10:00'])
+
+        result = PatientResource().import_data(dataset, dry_run=True, use_transactions=True)
+        self.assertFalse(result.has_errors())
+        self.assertFalse(Patient.objects.exists())
+
+        result = PatientResource().import_data(dataset, dry_run=False, use_transactions=True)
+        self.assertFalse(result.has_errors())
+        numbers = sorted(Patient.objects.values_list('case_number', flat=True))
+        self.assertEqual(numbers, [f'{self.year}-0001', f'{self.year}-0002', f'{self.year}-0003',
+                                   f'{self.year}-0500'])
+        # Блок - по числу строк без номера, явный номер поднял счетчик
+        self.assertEqual(self.counter(), 500)
+        self.assertEqual(make_patient(5).case_number, f'{self.year}-0501')
+
+
+class DashboardCountsTests(TestCase):
+    """Счетчики дашборда одним запросом с точными границами возраста"""
+
+    def test_years_ago_handles_leap_day(self):
+        self.assertEqual(years_ago(date(2024, 2, 29), 1), date(2023, 2, 28))
+        self.assertEqual(years_ago(date(2024, 2, 29), 4), date(2020, 2, 29))
+
+    def test_counts_in_one_query(self):
+        now = timezone.now()
+        today = now.date()
+        make_patient(0, birth_date=years_ago(today, 18), admission_date=now - timedelta(days=3))
+        make_patient(1, birth_date=years_ago(today, 18) + timedelta(days=1), gender='F')
+        make_patient(2, birth_date=years_ago(today, 71), status='DISCHARGED', discharge_date=now - timedelta(days=1))
+        make_patient(3, birth_date=years_ago(today, 71) + timedelta(days=1), status='DISCHARGED',
+                     discharge_date=now - timedelta(days=40))
+        make_patient(4, birth_date=years_ago(today, 31) + timedelta(days=1), status='DIED')
+
+        with self.assertNumQueries(1):
+            counts = get_dashboard_counts()
+        self.assertEqual(
+            {key: counts[key] for key in ('total', 'hospitalized', 'discharged', 'recent_admissions',
+                                          'recent_discharges')},
+            {'total': 5, 'hospitalized': 2, 'discharged': 2, 'recent_admissions': 1, 'recent_discharges': 1},
+        )
+        self.assertEqual(counts['gender_stats'], [{'gender': 'M', 'count': 4}, {'gender': 'F', 'count': 1}])
+        self.assertEqual(list(counts['age_groups'].values()), [1, 2, 0, 1, 1])
+
+        # Границы групп совпадают с возрастом в карточке пациента
+        expected = dict.fromkeys(counts['age_groups'], 0)
+        for patient in Patient.objects.all():
+            for label, min_age, max_age in AGE_GROUPS:
+                if (min_age is None or patient.age >= min_age) and (max_age is None or patient.age <= max_age):
+                    expected[label] += 1
+        self.assertEqual(counts['age_groups'], expected)
+
+    def test_counts_of_queryset(self):
+        doctor = make_user('doctor')
+        make_patient(0, attending_physician=doctor)
+        make_patient(1)
+        self.assertEqual(get_dashboard_counts(Patient.objects.filter(attending_physician=doctor))['total'], 1)
+
+
+class DashboardCacheTests(TestCase):
+    """Кэш дашборда по области видимости"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_user('admin', role='ADMIN')
+        cls.doctor = make_user('doctor', first_name='Анна', last_name='Врачева')
+        for number in range(3):
+            make_patient(number, attending_physician=cls.doctor)
+        make_patient(3, status='DISCHARGED')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_data_per_scope(self):
+        self.assertEqual(get_dashboard_data(self.admin)['total'], 4)
+        data = get_dashboard_data(self.doctor)
+        self.assertEqual((data['total'], data['discharged']), (3, 0))
+        self.assertEqual(len(data['recent_patients']), 3)
+
+    def test_cached_until_patient_changes(self):
+        # Счетчики и последние поступления
+        with self.assertNumQueries(2):
+            get_dashboard_data(self.admin)
+        with self.assertNumQueries(0):
+            data = get_dashboard_data(self.admin)
+        self.assertEqual(get_doctor_stats()[0]['patient_count'], 3)
+        # В кэше только выводимые поля последних поступлений
+        self.assertIn('attending_physician_id', data['recent_patients'][0].get_deferred_fields())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_patient(4, attending_physician=self.doctor)
+        self.assertEqual(get_dashboard_data(self.admin)['total'], 5)
+        self.assertEqual(get_doctor_stats()[0]['patient_count'], 4)
+
+    def test_view_shows_doctor_own_patients(self):
+        self.client.force_login(self.doctor)
+        response = self.client.get(reverse('patients:dashboard'))
+        self.assertEqual(response.context['total_patients'], 3)
+        self.assertNotIn('doctor_stats', response.context)
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('patients:dashboard'))
+        self.assertEqual(response.context['total_patients'], 4)
+        self.assertEqual(response.context['doctor_stats'][0]['attending_physician__last_name'], 'Врачева')
+
+    def test_doctor_widgets_cached_until_patient_changes(self):
+        self.assertEqual(get_doctor_stats()[0]['patient_count'], 3)
+        self.assertEqual(get_doctor_caseload(self.doctor)['total'], 3)
+        with self.assertNumQueries(0):
+            get_doctor_stats()
+            get_doctor_caseload(self.doctor)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_patient(4, attending_physician=self.doctor)
+        self.assertEqual(get_doctor_stats()[0]['patient_count'], 4)
+        self.assertEqual(get_doctor_caseload(self.doctor)['total'], 4)
+
+    def test_warm_dashboard_does_not_query_patients(self):
+        url = reverse('patients:dashboard')
+        # Сессия, пользователь и сохранение сессии (SAVEPOINT, UPDATE, RELEASE); врачу - еще права
+        for user, queries in ((self.admin, 5), (self.doctor, 7)):
+            self.client.force_login(user)
+            self.client.get(url)
+            with self.assertNumQueries(queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['my_caseload']['total'], 3)
+
+
+def moment(year, month, day, hour=12):
+    return timezone.make_aware(datetime(year, month, day, hour, 0))
+
+
+class PeriodStatisticsTests(TestCase):
+    """Статистика за год и месяц на сгруппированных запросах"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        Diagnosis.objects.create(code='F20.0', name='Параноидная шизофрения')
+        make_patient(0, admission_date=moment(2025, 1, 10), admission_mkb_code='F20.0', attending_physician=cls.doctor)
+        make_patient(1, admission_date=moment(2025, 1, 20), admission_mkb_code='F20.0',
+                     status='DISCHARGED', discharge_date=moment(2025, 2, 5))
+        make_patient(2, admission_date=moment(2025, 3, 15), admission_mkb_code='F32', status='DIED',
+                     birth_date=date(2015, 6, 1))
+        make_patient(3, admission_date=moment(2024, 12, 25), status='DISCHARGED', discharge_date=moment(2025, 1, 5))
+        Diagnosis.objects.rebuild_tree()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_year(self):
+        # Названия диагнозов приходят соединением, классы и блоки МКБ-10 - одним запросом
+        with self.assertNumQueries(5):
+            stats = get_period_statistics('all', 2025)
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['status_counts'], {'HOSPITALIZED': 1, 'DISCHARGED': 1, 'TRANSFERRED': 0, 'DIED': 1})
+        self.assertEqual(stats['age_stats']['До 18 лет'], 1)
+        monthly = {row['month']: (row['admissions'], row['discharges']) for row in stats['monthly_stats']}
+        self.assertEqual(len(monthly), 12)
+        # Выписка в январе пациента, поступившего в декабре, тоже считается
+        self.assertEqual((monthly[1], monthly[2], monthly[3], monthly[4]), ((2, 1), (0, 1), (1, 0), (0, 0)))
+        self.assertEqual(stats['top_diagnoses'], [
+            {'code': 'F20.0', 'name': 'Параноидная шизофрения', 'patient_count': 2},
+        ])
+        self.assertEqual([(row['code'], row['count']) for row in stats['mkb_groups']], [('V', 2), ('F20-F29', 2)])
+
+    def test_month_and_scope(self):
+        stats = get_period_statistics('all', 2025, 3)
+        self.assertEqual((stats['total'], stats['status_counts']['DIED']), (1, 1))
+        # Помесячная разбивка всегда за весь год
+        self.assertEqual(stats['monthly_stats'][0]['admissions'], 2)
+        stats = get_period_statistics(f'doctor:{self.doctor.pk}', 2025)
+        self.assertEqual((stats['total'], stats['monthly_stats'][1]['discharges']), (1, 0))
+
+    def test_view_ignores_bad_period(self):
+        self.client.force_login(make_user('analyst', role='ANALYST'))
+        response = self.client.get(reverse('patients:statistics'), {'year': '2025', 'month': '13'})
+        self.assertEqual((response.context['year'], response.context['month']), (2025, None))
+        self.assertEqual(response.context['total_patients'], 3)
+        response = self.client.get(reverse('patients:statistics'), {'year': 'abc', 'month': '1'})
+        self.assertEqual((response.context['year'], response.context['month']), (timezone.now().year, 1))
+
+
+class PeriodCacheTests(TestCase):
+    """Кэш закрытых периодов и точечный сброс по датам пациента"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.january = make_patient(0, admission_date=moment(2025, 1, 10), attending_physician=cls.doctor)
+        cls.old = make_patient(1, admission_date=moment(2023, 5, 10), status='DISCHARGED',
+                               discharge_date=moment(2023, 6, 1))
+
+    def setUp(self):
+        cache.clear()
+
+    def save(self, patient, **changes):
+        for name, value in changes.items():
+            setattr(patient, name, value)
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.save()
+
+    def test_period_bounds(self):
+        self.assertEqual(period_bounds(2024, 2), (date(2024, 2, 1), date(2024, 2, 29)))
+        self.assertEqual(period_bounds(2025, 12), (date(2025, 12, 1), date(2025, 12, 31)))
+        self.assertEqual(period_bounds(2025), (date(2025, 1, 1), date(2025, 12, 31)))
+        self.assertTrue(is_period_closed(2025, 1))
+        self.assertFalse(is_period_closed(timezone.localdate().year))
+
+    def test_closed_period_survives_unrelated_changes(self):
+        get_period_statistics('all', 2025, 1)
+        self.save(self.old, notes='Исправление')
+        make_patient(2, admission_date=moment(2025, 6, 1))
+        with self.assertNumQueries(0):
+            stats = get_period_statistics('all', 2025, 1)
+        self.assertEqual(stats['total'], 1)
+
+    def test_changes_in_period_evict_it(self):
+        scope = f'doctor:{self.doctor.pk}'
+        for args in ((2025,), (2025, 1), (2025, 3)):
+            get_period_statistics('all', *args)
+            get_period_statistics(scope, *args)
+        # Перенос поступления с января на март: сбрасываются оба месяца и год
+        self.save(self.january, admission_date=moment(2025, 3, 5))
+        self.assertEqual(get_period_statistics('all', 2025, 1)['total'], 0)
+        self.assertEqual(get_period_statistics(scope, 2025, 3)['total'], 1)
+        self.assertEqual(get_period_statistics('all', 2025)['monthly_stats'][2]['admissions'], 1)
+
+        # Передача другому врачу сбрасывает области обоих
+        other = make_user('other')
+        self.save(self.january, attending_physician=other)
+        self.assertEqual(get_period_statistics(scope, 2025, 3)['total'], 0)
+        self.assertEqual(get_period_statistics(f'doctor:{other.pk}', 2025, 3)['total'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.january.delete()
+        self.assertEqual(get_period_statistics('all', 2025)['total'], 0)
+
+    def test_open_period_is_not_cached(self):
+        year = timezone.localdate().year
+        make_patient(2, admission_date=timezone.now())
+        self.assertEqual(get_period_statistics('all', year)['total'], 1)
+        Patient.objects.filter(admission_date__year=year).update(status='DIED')
+        self.assertEqual(get_period_statistics('all', year)['status_counts']['DIED'], 1)
+
+    def test_age_is_taken_at_period_end(self):
+        make_patient(2, admission_date=moment(2023, 5, 20), birth_date=date(2005, 12, 31))
+        # 31 декабря 2023 года исполнилось 18
+        self.assertEqual(get_period_statistics('all', 2023)['age_stats']['18-30 лет'], 1)
+        self.assertEqual(get_period_statistics('all', 2023, 5)['age_stats']['До 18 лет'], 1)
+
+
+class DailyRollupTests(TestCase):
+    """Витрина DailyPatientRollup: инкрементальное обновление по отметке и сводки"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor', department='Отделение 1')
+        cls.hospitalized = make_patient(0, admission_date=moment(2025, 1, 10), admission_mkb_code='F20.0',
+                                        attending_physician=cls.doctor)
+        cls.discharged = make_patient(1, admission_date=moment(2025, 1, 10), admission_mkb_code='F32', gender='F',
+                                      status='DISCHARGED', discharge_date=moment(2025, 1, 20))
+        cls.died = make_patient(2, admission_date=moment(2025, 1, 15), admission_mkb_code='A00',
+                                attending_physician=cls.doctor, status='DIED', discharge_date=moment(2025, 1, 25))
+
+    def totals(self, *dimensions, **kwargs):
+        return {
+            tuple(row[name] for name in dimensions): (row['admissions'], row['discharges'], row['deaths'])
+            for row in pivot(list(dimensions), **kwargs)
+        }
+
+    def test_refresh_builds_rollup(self):
+        self.assertEqual(refresh_daily_rollups(), (3, 0))
+        self.assertEqual(self.totals('day'), {
+            (date(2025, 1, 10),): (2, 0, 0),
+            (date(2025, 1, 15),): (1, 0, 0),
+            (date(2025, 1, 20),): (0, 1, 0),
+            (date(2025, 1, 25),): (0, 1, 1),
+        })
+        self.assertEqual(self.totals('department'), {('Отделение 1',): (2, 1, 1), ('',): (1, 1, 0)})
+        # Пациенты внутри запаса отметки пересматриваются, но не меняют витрину
+        self.assertEqual(refresh_daily_rollups(), (0, 0))
+
+    def test_changed_and_deleted_patients_move_contribution(self):
+        refresh_daily_rollups()
+        self.discharged.discharge_date = moment(2025, 1, 22)
+        self.discharged.save()
+        self.assertEqual(refresh_daily_rollups(), (1, 0))
+        days = self.totals('day')
+        self.assertNotIn((date(2025, 1, 20),), days)
+        self.assertEqual(days[(date(2025, 1, 22),)], (0, 1, 0))
+
+        self.died.delete()
+        self.assertEqual(refresh_daily_rollups(), (0, 1))
+        self.assertEqual(self.totals(), {(): (2, 1, 0)})
+        self.assertEqual(refresh_daily_rollups(), (0, 0))
+
+    def test_rows_older_than_watermark_wait_for_full_rebuild(self):
+        refresh_daily_rollups()
+        # QuerySet.update() в обход save(): updated_at остается в прошлом
+        Patient.objects.filter(pk=self.hospitalized.pk).update(
+            status='TRANSFERRED', updated_at=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(refresh_daily_rollups(), (0, 0))
+        self.assertNotIn(('TRANSFERRED',), self.totals('status'))
+        self.assertEqual(refresh_daily_rollups(full=True), (3, 0))
+        self.assertEqual(self.totals('status')[('TRANSFERRED',)], (1, 0, 0))
+
+    def test_pivot_rollup_and_filters(self):
+        refresh_daily_rollups()
+        rows = pivot(['mkb_chapter', 'gender'], rollup=True)
+        subtotals = {(row['mkb_chapter'], row['gender']): row['admissions'] for row in rows if row['subtotal']}
+        self.assertEqual(subtotals, {('I', None): 1, ('V', None): 2, (None, None): 3})
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(self.totals('month', filters={'attending_physician': self.doctor.pk}),
+                         {(date(2025, 1, 1),): (2, 1, 1)})
+        self.assertEqual(self.totals(date_from=date(2025, 1, 16)), {(): (0, 2, 1)})
+        with self.assertRaises(ValueError):
+            pivot(['ward'])
+        with self.assertRaises(ValueError):
+            pivot(['day'], filters={'day': '2025-01-10'})
+
+    def test_api_limits_doctor_to_own_patients(self):
+        refresh_daily_rollups()
+        url = reverse('patients:api_rollup_pivot')
+        self.client.force_login(self.doctor)
+        response = self.client.get(url, {'dimensions': 'mkb_chapter', 'attending_physician': '999'})
+        self.assertEqual({row['mkb_chapter']: row['admissions'] for row in response.json()['results']},
+                         {'I': 1, 'V': 1})
+        self.client.force_login(make_user('analyst', role='ANALYST'))
+        response = self.client.get(url, {'dimensions': 'year', 'rollup': '1'})
+        self.assertEqual([row['admissions'] for row in response.json()['results']], [3, 3])
+        self.assertEqual(self.client.get(url, {'dimensions': 'ward'}).status_code, 400)
+
+    def test_deletion_is_consumed_from_tombstones(self):
+        refresh_daily_rollups()
+        pk = self.died.pk
+        self.died.delete()
+        self.assertIsNotNone(PatientRollupState.objects.get(pk=pk).deleted_at)
+        # Обновление вычитает только помеченные вклады, не сверяя все вклады с пациентами
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM patients_patient WHERE id = %s', [self.discharged.pk])
+        self.assertEqual(refresh_daily_rollups(), (0, 1))
+        self.assertFalse(PatientRollupState.objects.filter(pk=pk).exists())
+        self.assertEqual(self.totals(), {(): (2, 1, 0)})
+        # Удаление SQL-запросом подхватывает полная пересборка
+        self.assertEqual(refresh_daily_rollups(full=True), (1, 0))
+        self.assertEqual(self.totals(), {(): (1, 0, 0)})
+
+
+class OccupancyTests(TestCase):
+    """Занятость коек и длительность госпитализации на массивах"""
+
+    @classmethod
+    def setUpTestData(cls):
+        neurologist = make_user('neurologist', department='Неврология')
+        first = make_patient(0, status='DISCHARGED', admission_date=moment(2025, 1, 1, 9),
+                             discharge_date=moment(2025, 1, 5, 9))
+        # Текущий эпизод пациента записан и в историю - учитывается один раз
+        Hospitalization.objects.create(patient=first, admission_date=date(2025, 1, 1),
+                                       discharge_date=date(2025, 1, 5), department='Психиатрия', diagnosis='Д')
+        second = make_patient(1, admission_date=moment(2025, 1, 3))
+        Hospitalization.objects.create(patient=second, admission_date=date(2025, 1, 3),
+                                       department='Психиатрия', diagnosis='Д')
+        make_patient(2, status='DISCHARGED', attending_physician=neurologist,
+                     admission_date=moment(2025, 1, 2, 10), discharge_date=moment(2025, 1, 4, 15))
+        make_patient(3, admission_date=moment(2025, 1, 4))
+        # Выписан без даты выписки - эпизод не открыт; выписан до периода - не попадает
+        make_patient(4, status='DISCHARGED', admission_date=moment(2025, 1, 2))
+        make_patient(5, status='DISCHARGED', admission_date=moment(2024, 12, 1), discharge_date=moment(2024, 12, 10))
+
+    def test_daily_census(self):
+        episodes = load_episodes(date(2025, 1, 1), date(2025, 1, 6))
+        self.assertEqual(len(episodes), 4)
+        census = daily_census(episodes, date(2025, 1, 1), date(2025, 1, 6))
+        self.assertEqual(list(census.columns), [NO_DEPARTMENT, 'Неврология', 'Психиатрия'])
+        self.assertEqual(census['Психиатрия'].tolist(), [1, 1, 2, 2, 1, 1])
+        self.assertEqual(census['Неврология'].tolist(), [0, 1, 1, 0, 0, 0])
+        self.assertEqual(census[NO_DEPARTMENT].tolist(), [0, 0, 0, 1, 1, 1])
+
+        # То же, что подсчет по каждому дню в цикле
+        for day, row in census.iterrows():
+            for department, value in row.items():
+                group = episodes[episodes['department'] == department]
+                occupied = (group['start'] <= day) & ~(group['end'] <= day)
+                self.assertEqual(value, occupied.sum(), (day, department))
+
+    def test_length_of_stay(self):
+        stays = length_of_stay(load_episodes(), date(2025, 1, 1), date(2025, 1, 31))
+        self.assertEqual(sorted(stays['los'].tolist()), [2, 4])
+        summary = {row['department']: row for row in los_summary(stays)}
+        self.assertEqual((summary[TOTAL_LABEL]['episodes'], summary[TOTAL_LABEL]['mean']), (2, 3.0))
+        self.assertEqual(summary[TOTAL_LABEL]['p50'], 3.0)
+        self.assertEqual(los_distribution(stays)[0], ('до 7', 2))
+        self.assertEqual(los_summary(stays.iloc[0:0]), [])
+
+    def test_report_and_csv(self):
+        report = occupancy_report(date(2025, 1, 1), date(2025, 1, 6))
+        total = {row['department']: row for row in report['census_summary']}[TOTAL_LABEL]
+        self.assertEqual((total['max'], total['current'], total['bed_days']), (3, 2, 13))
+
+        self.client.force_login(make_user('analyst', role='ANALYST'))
+        url = reverse('patients:occupancy')
+        response = self.client.get(url, {'date_from': '2025-01-01', 'date_to': '2025-01-06', 'format': 'csv'})
+        lines = response.content.decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], f'Дата,{NO_DEPARTMENT},Неврология,Психиатрия')
+        self.assertEqual(lines[3], '03.01.2025,0,1,2')
+        # Некорректный период заменяется периодом по умолчанию
+        response = self.client.get(url, {'date_from': '2025-02-01', 'date_to': '2025-01-01'})
+        self.assertEqual(response.context['date_to'], timezone.localdate())
+
+
+class ActiveOnTests(TestCase):
+    """Эпизоды госпитализации на дату"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        own = make_patient(0, attending_physician=cls.doctor)
+        other = make_patient(1)
+        cls.closed = Hospitalization.objects.create(
+            patient=own, admission_date=date(2025, 1, 10), discharge_date=date(2025, 1, 20),
+            department='Психиатрия', diagnosis='Д',
+        )
+        cls.open = Hospitalization.objects.create(
+            patient=other, admission_date=date(2025, 1, 15), department='Психиатрия', diagnosis='Д',
+        )
+        cls.neurology = Hospitalization.objects.create(
+            patient=other, admission_date=date(2024, 12, 1), discharge_date=date(2024, 12, 31),
+            department='Неврология', diagnosis='Д',
+        )
+
+    def active(self, day, department=None):
+        return set(Hospitalization.objects.active_on(day, department))
+
+    def test_boundary_days(self):
+        self.assertEqual(self.active(date(2025, 1, 9)), set())
+        # Дни поступления и выписки включаются
+        self.assertEqual(self.active(date(2025, 1, 10)), {self.closed})
+        self.assertEqual(self.active(date(2025, 1, 20)), {self.closed, self.open})
+        self.assertEqual(self.active(date(2025, 1, 21)), {self.open})
+        self.assertEqual(self.active(date(2030, 1, 1)), {self.open})
+        self.assertEqual(self.active(date(2024, 12, 31)), {self.neurology})
+
+    def test_department_filter(self):
+        self.assertEqual(self.active(date(2024, 12, 15), 'Психиатрия'), set())
+        self.assertEqual(self.active(date(2024, 12, 15), 'Неврология'), {self.neurology})
+        self.assertEqual(self.active(date(2025, 1, 16), 'Психиатрия'), {self.closed, self.open})
+
+    def test_census_view_is_limited_to_visible_patients(self):
+        url = reverse('patients:department_census')
+        self.client.force_login(make_user('nurse', role='NURSE'))
+        response = self.client.get(url, {'date': '2025-01-16', 'department': 'Психиатрия'})
+        self.assertEqual(list(response.context['department_counts']), [{'department': 'Психиатрия', 'count': 2}])
+        self.assertEqual(len(response.context['episodes']), 2)
+
+        self.client.force_login(self.doctor)
+        response = self.client.get(url, {'date': '2025-01-16', 'department': 'Психиатрия'})
+        self.assertEqual([episode.pk for episode in response.context['episodes']], [self.closed.pk])
+        response = self.client.get(url, {'date': '16.01.2025'})
+        self.assertEqual(response.context['day'], timezone.localdate())
+
+    def test_department_picker_shows_only_visible_departments(self):
+        url = reverse('patients:department_census')
+        self.client.force_login(self.doctor)
+        self.assertEqual(list(self.client.get(url).context['departments']), ['Психиатрия'])
+        self.client.force_login(make_user('analyst', role='ANALYST'))
+        self.assertEqual(list(self.client.get(url).context['departments']), ['Неврология', 'Психиатрия'])
+
+
+class ReadmissionTests(TestCase):
+    """Повторные госпитализации: LAG по эпизодам пациента"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = make_patient(0)
+        cls.other = make_patient(1)
+
+    def add_episode(self, admitted, discharged=None, patient=None, department='Психиатрия'):
+        # Пересчет запускается сигналом после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            return Hospitalization.objects.create(
+                patient=patient or self.patient, admission_date=admitted, discharge_date=discharged,
+                diagnosis='Диагноз', department=department,
+            )
+
+    def flags(self, patient=None):
+        return list(
+            Hospitalization.objects.filter(patient=patient or self.patient)
+            .order_by('admission_date', 'pk').values_list('days_since_discharge', 'is_readmission')
+        )
+
+    def test_gap_and_window(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        self.add_episode(date(2025, 1, 20), date(2025, 2, 1))
+        # В день выписки - перевод, не повторная госпитализация
+        self.add_episode(date(2025, 2, 1), date(2025, 2, 5))
+        self.add_episode(date(2025, 4, 1))
+        self.assertEqual(self.flags(), [(None, False), (10, True), (0, False), (55, False)])
+
+    def test_episodes_of_other_patients_do_not_mix(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        self.add_episode(date(2025, 1, 15), patient=self.other)
+        self.assertEqual(self.flags(self.other), [(None, False)])
+
+    def test_inserted_and_deleted_episode_recompute_neighbours(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        last = self.add_episode(date(2025, 3, 1))
+        self.assertEqual(self.flags(), [(None, False), (50, False)])
+        middle = self.add_episode(date(2025, 2, 1), date(2025, 2, 20))
+        self.assertEqual(self.flags(), [(None, False), (22, True), (9, True)])
+        with self.captureOnCommitCallbacks(execute=True):
+            middle.delete()
+        last.refresh_from_db()
+        self.assertEqual((last.days_since_discharge, last.is_readmission), (50, False))
+
+    def test_refresh_updates_only_changed_rows_and_window(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        self.add_episode(date(2025, 2, 24))
+        self.assertEqual(refresh_readmissions(), 0)
+        self.assertEqual(refresh_readmissions(window_days=60), 1)
+        self.assertEqual(self.flags(), [(None, False), (45, True)])
+
+    def test_rates_by_department(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        self.add_episode(date(2025, 1, 20), department='Неврология')
+        rows = {row['department']: row for row in readmission_rates('department')}
+        self.assertEqual((rows['Неврология']['episodes'], rows['Неврология']['readmissions']), (1, 1))
+        self.assertEqual(rows['Неврология']['rate'], 100.0)
+        self.assertEqual(rows['Психиатрия']['readmissions'], 0)
+        # Другое окно считается по days_since_discharge
+        rows = {row['department']: row for row in readmission_rates('department', window_days=5)}
+        self.assertEqual(rows['Неврология']['readmissions'], 0)
+
+    def test_python_fallback_matches_sql(self):
+        self.add_episode(date(2025, 1, 1), date(2025, 1, 10))
+        self.add_episode(date(2025, 1, 20), date(2025, 2, 1))
+        self.add_episode(date(2025, 2, 1))
+        self.add_episode(date(2025, 1, 5), patient=self.other)
+        expected = self.flags() + self.flags(self.other)
+        Hospitalization.objects.update(days_since_discharge=None, is_readmission=False)
+        # Сохранение эпизода на СУБД без UPDATE ... FROM не должно падать в сигнале
+        with mock.patch.object(connection, 'vendor', 'other'):
+            self.assertEqual(refresh_readmissions(), 2)
+            self.add_episode(date(2025, 6, 1), patient=self.other)
+        self.assertEqual(self.flags() + self.flags(self.other)[:1], expected)
+        self.assertEqual(self.flags(self.other)[1], (None, False))
+
+
+class CaseloadTests(TestCase):
+    """Счетчики нагрузки врачей меняются вместе с пациентом"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.colleague = make_user('colleague')
+
+    def counts(self, physician):
+        caseload = get_caseload(physician.pk)
+        return {field: caseload[field] for field in [*CASELOAD_FIELDS, 'recent_discharges']}
+
+    def expected(self, physician):
+        patients = Patient.objects.filter(attending_physician=physician)
+        since = timezone.now() - timedelta(days=30)
+        counts = {'total': patients.count(), 'recent_discharges': patients.filter(discharge_date__gte=since).count()}
+        for status, field in [('HOSPITALIZED', 'hospitalized'), ('DISCHARGED', 'discharged'),
+                              ('TRANSFERRED', 'transferred'), ('DIED', 'died')]:
+            counts[field] = patients.filter(status=status).count()
+        return counts
+
+    def assertCountersMatch(self):
+        for physician in (self.doctor, self.colleague):
+            self.assertEqual(self.counts(physician), self.expected(physician), physician.username)
+
+    def test_create_discharge_transfer_and_delete(self):
+        first = make_patient(0, attending_physician=self.doctor)
+        make_patient(1, attending_physician=self.doctor)
+        make_patient(2)
+        self.assertEqual(self.counts(self.doctor)['total'], 2)
+        self.assertCountersMatch()
+
+        first.status = 'DISCHARGED'
+        first.discharge_date = timezone.now()
+        first.save()
+        self.assertEqual(self.counts(self.doctor)['recent_discharges'], 1)
+        self.assertCountersMatch()
+
+        first.attending_physician = self.colleague
+        first.save()
+        self.assertEqual(self.counts(self.colleague)['discharged'], 1)
+        self.assertCountersMatch()
+
+        first.delete()
+        self.assertCountersMatch()
+        self.assertEqual(self.counts(self.colleague)['total'], 0)
+
+    def test_deferred_instance_moves_its_contribution(self):
+        make_patient(0, attending_physician=self.doctor)
+        patient = Patient.objects.only('last_name').get()
+        patient.attending_physician = self.colleague
+        patient.status = 'DIED'
+        patient.save()
+        self.assertCountersMatch()
+        Patient.objects.only('last_name').get().delete()
+        self.assertCountersMatch()
+
+    def test_unchanged_save_does_not_touch_counters(self):
+        patient = make_patient(0, attending_physician=self.doctor)
+        patient = Patient.objects.get(pk=patient.pk)
+        patient.notes = 'Без изменений счетчиков'
+        with self.assertNumQueries(3):
+            # SAVEPOINT, UPDATE пациента, RELEASE SAVEPOINT - без UPDATE счетчиков
+            patient.save()
+        self.assertCountersMatch()
+
+    def test_reconcile_fixes_drift(self):
+        make_patient(0, attending_physician=self.doctor)
+        make_patient(1, attending_physician=self.doctor, status='DISCHARGED', discharge_date=timezone.now())
+        self.assertEqual(reconcile_caseloads(), 0)
+
+        # Изменения в обход save() счетчики не видят
+        Patient.objects.update(attending_physician=self.colleague)
+        self.assertNotEqual(self.counts(self.colleague), self.expected(self.colleague))
+        self.assertEqual(reconcile_caseloads(), 4)
+        self.assertCountersMatch()
+        self.assertEqual(reconcile_caseloads(), 0)
+
+
+class DiagnosisLinkTests(TestCase):
+    """Коды МКБ-10 как ссылки на справочник диагнозов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = make_user('doctor')
+        cls.f20 = Diagnosis.objects.create(code='F20.0', name='Параноидная шизофрения')
+        cls.f32 = Diagnosis.objects.create(code='F32', name='Депрессивный эпизод')
+
+    def test_normalize_code(self):
+        self.assertEqual(normalize_mkb_code(' f20,0 '), 'F20.0')
+        self.assertEqual(normalize_mkb_code('F42.'), 'F42')
+        self.assertEqual(normalize_mkb_code(None), '')
+
+    def test_save_links_normalized_code_and_keeps_text(self):
+        patient = make_patient(0, admission_mkb_code=' f20,0 ', discharge_mkb_code='X99')
+        self.assertEqual(patient.admission_mkb_id, self.f20.pk)
+        self.assertIsNone(patient.discharge_mkb_id)
+        self.assertEqual(Patient.objects.get(pk=patient.pk).admission_mkb_code, ' f20,0 ')
+
+        patient.admission_mkb_code = 'F32'
+        patient.save(update_fields=['admission_mkb_code'])
+        self.assertEqual(Patient.objects.get(pk=patient.pk).admission_mkb_id, self.f32.pk)
+
+        stay = Hospitalization.objects.create(
+            patient=patient, admission_date=date(2025, 3, 1), diagnosis='Диагноз',
+            mkb_code='f32', department='Отделение 1',
+        )
+        self.assertEqual(stay.mkb_id, self.f32.pk)
+
+    def test_link_command_resolves_existing_rows(self):
+        patient = make_patient(0)
+        make_patient(1)
+        # Коды, записанные в обход save(), и код, которого нет в справочнике
+        Patient.objects.filter(pk=patient.pk).update(admission_mkb_code='f20,0', discharge_mkb_code='Z00')
+        results = link_mkb_codes()
+        self.assertEqual(results['admission'], (1, 0))
+        self.assertEqual(results['discharge'], (0, 1))
+        self.assertEqual(Patient.objects.get(pk=patient.pk).admission_mkb_id, self.f20.pk)
+        # Повторный запуск без relink не трогает связанные записи
+        self.assertEqual(link_mkb_codes()['admission'], (0, 0))
+        self.assertEqual(link_mkb_codes(relink=True)['admission'], (1, 0))
+
+    def test_frequency_by_linked_diagnosis(self):
+        for number, code in enumerate(['F20.0', 'F20.0', 'F20.0', 'F32', 'X99', '']):
+            make_patient(number, admission_mkb_code=code)
+        rows, unlinked = diagnosis_frequency('admission')
+        self.assertEqual(
+            [(row['code'], row['name'], row['count'], row['share']) for row in rows],
+            [('F20.0', 'Параноидная шизофрения', 3, 75.0), ('F32', 'Депрессивный эпизод', 1, 25.0)],
+        )
+        self.assertEqual(unlinked, 1)
+        rows, unlinked = diagnosis_frequency('admission', limit=1)
+        self.assertEqual([(row['code'], row['share']) for row in rows], [('F20.0', 75.0)])
+
+    def test_view_counts_visible_patients(self):
+        make_patient(0, admission_mkb_code='F20.0', attending_physician=self.doctor)
+        make_patient(1, admission_mkb_code='F32')
+        self.client.force_login(self.doctor)
+        response = self.client.get(reverse('patients:diagnosis_frequency'), {
+            'date_from': '2025-01-01', 'date_to': '2025-12-31',
+        })
+        self.assertEqual([row['code'] for row in response.context['rows']], ['F20.0'])
+
+
+class DiagnosisTreeTests(TestCase):
+    """Справочник МКБ-10 как вложенные множества"""
+
+    CODES = ['A00', 'A00.1', 'F20', 'F20.0', 'F20.01', 'F32', 'F32.1', 'U07.1', 'Z00']
+
+    @classmethod
+    def setUpTestData(cls):
+        Diagnosis.objects.all().delete()
+        for code in cls.CODES:
+            Diagnosis.objects.create(code=code, name=f'Диагноз {code}')
+        Diagnosis.objects.rebuild_tree()
+        cls.admin = make_user('admin', role='ADMIN')
+
+    def node(self, code):
+        return Diagnosis.objects.get(code=code)
+
+    def test_groups_are_built_from_codes(self):
+        self.assertEqual(
+            list(Diagnosis.objects.groups().order_by('lft').values_list('code', 'level')),
+            [('I', 'CHAPTER'), ('V', 'CHAPTER'), ('F20-F29', 'BLOCK'), ('F30-F39', 'BLOCK'),
+             ('XXI', 'CHAPTER'), ('XXII', 'CHAPTER')],
+        )
+        self.assertEqual(self.node('F20.01').parent, self.node('F20.0'))
+        self.assertEqual(self.node('F20').parent, self.node('F20-F29'))
+        # В классе без описанных блоков рубрика подчинена классу
+        self.assertEqual(self.node('A00').parent, self.node('I'))
+
+    def test_bounds_nest_children_inside_parents(self):
+        nodes = list(Diagnosis.objects.all())
+        self.assertEqual(sorted(bound for node in nodes for bound in (node.lft, node.rgt)),
+                         list(range(1, 2 * len(nodes) + 1)))
+        for node in nodes:
+            size = Diagnosis.objects.subtree(node).count()
+            self.assertEqual(node.rgt - node.lft + 1, 2 * size, node.code)
+            if node.parent_id:
+                parent = node.parent
+                self.assertTrue(parent.lft < node.lft < node.rgt < parent.rgt, node.code)
+
+    def test_subtree_and_ancestors(self):
+        self.assertEqual(
+            sorted(Diagnosis.objects.subtree(self.node('F20-F29')).values_list('code', flat=True)),
+            ['F20', 'F20-F29', 'F20.0', 'F20.01'],
+        )
+        self.assertEqual(
+            list(Diagnosis.objects.ancestors(self.node('F20.01')).values_list('code', flat=True)),
+            ['V', 'F20-F29', 'F20', 'F20.0', 'F20.01'],
+        )
+
+    def test_rebuild_is_idempotent_and_places_new_codes(self):
+        before = list(Diagnosis.objects.order_by('pk').values_list('code', 'parent_id', 'lft', 'rgt'))
+        Diagnosis.objects.rebuild_tree()
+        self.assertEqual(list(Diagnosis.objects.order_by('pk').values_list('code', 'parent_id', 'lft', 'rgt')),
+                         before)
+
+        Diagnosis.objects.create(code='F25', name='Шизоаффективные расстройства')
+        self.assertIsNone(self.node('F25').lft)
+        Diagnosis.objects.rebuild_tree()
+        f25 = self.node('F25')
+        self.assertEqual(f25.parent, self.node('F20-F29'))
+        self.assertIn(f25, Diagnosis.objects.subtree(self.node('V')))
+
+    def test_frequency_by_node(self):
+        make_patient(0, admission_mkb_code='F20.0')
+        make_patient(1, admission_mkb_code='F20.01')
+        make_patient(2, admission_mkb_code='F32')
+        make_patient(3, admission_mkb_code='X99')
+        rows, unlinked = diagnosis_frequency('admission', node=self.node('F20-F29'))
+        self.assertEqual([(row['code'], row['count']) for row in rows], [('F20.0', 1), ('F20.01', 1)])
+        self.assertEqual(unlinked, 1)
+        counts = {row['code']: row['count'] for row in group_counts('admission')}
+        self.assertEqual(counts, {'V': 3, 'F20-F29': 2, 'F30-F39': 1})
+
+    def test_report_ignores_node_outside_tree(self):
+        Diagnosis.objects.create(code='F99.9', name='Код без места в дереве')
+        self.client.force_login(self.admin)
+        url = reverse('patients:diagnosis_frequency')
+        response = self.client.get(url, {'node': 'F99.9'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['node'])
+        response = self.client.get(url, {'node': 'F20-F29'})
+        self.assertEqual(response.context['node'].code, 'F20-F29')
+
+
+class DiagnosisIndexTests(TestCase):
+    """Индекс автодополнения диагнозов в памяти процесса"""
+
+    ROWS = [
+        ('F20', 'Шизофрения', ''),
+        ('F20.0', 'Параноидная шизофрения', ''),
+        ('F20.1', 'Гебефренная шизофрения', ''),
+        ('F32', 'Депрессивный эпизод', ''),
+        ('F60.0', 'Параноидное расстройство личности', ''),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        Diagnosis.objects.all().delete()
+        for code, name, description in cls.ROWS:
+            Diagnosis.objects.create(code=code, name=name, description=description)
+        cls.doctor = make_user('doctor')
+
+    def setUp(self):
+        cache.clear()
+        diagnosis_index._index = None
+
+    def codes(self, query, limit=10):
+        return [result['code'] for result in search_diagnoses(query, limit)]
+
+    def test_code_and_word_prefix(self):
+        self.assertEqual(self.codes('f20'), ['F20', 'F20.0', 'F20.1'])
+        self.assertEqual(self.codes('F20', limit=2), ['F20', 'F20.0'])
+        self.assertEqual(self.codes('параноид'), ['F20.0', 'F60.0'])
+        self.assertEqual(self.codes('параноидное личности'), ['F60.0'])
+        self.assertEqual(self.codes('xyzzy'), [])
+        result = search_diagnoses('F32')[0]
+        self.assertEqual((result['id'], result['text']), ('F32', 'F32 - Депрессивный эпизод'))
+
+    def test_index_is_built_once_and_rebuilt_after_change(self):
+        self.codes('F20')
+        # Только сверка версии по первичному ключу
+        with self.assertNumQueries(1):
+            self.codes('шизофрения')
+        with self.captureOnCommitCallbacks(execute=True):
+            Diagnosis.objects.create(code='F25', name='Шизоаффективное расстройство')
+        self.assertEqual(self.codes('шизоаффективное'), ['F25'])
+
+    def test_words_of_one_diagnosis_counted_once(self):
+        index = DiagnosisIndex(1, [('A01', 'Тест тестовый тест', '')])
+        self.assertEqual([result['code'] for result in index.search('тест')], ['A01'])
+
+    def test_api_answers_304_for_same_version(self):
+        self.client.force_login(self.doctor)
+        url = reverse('patients:api_diagnoses')
+        response = self.client.get(url, {'q': 'параноид'})
+        self.assertEqual([result['code'] for result in response.json()['results']], ['F20.0', 'F60.0'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, {'q': 'параноид'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Diagnosis.objects.filter(code='F32').delete()
+        self.assertEqual(self.client.get(url, {'q': 'параноид'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_version_is_shared_through_database(self):
+        version = get_version()
+        # Кэш у каждого процесса свой - версия от него не зависит
+        cache.clear()
+        self.assertEqual(get_version(), version)
+        index = diagnosis_index.get_index()
+
+        # Справочник изменил другой процесс: здесь только новая версия в БД
+        Diagnosis.objects.bulk_create([Diagnosis(code='F25', name='Шизоаффективное расстройство')])
+        DiagnosisVersion.objects.update(version=F('version') + 1)
+        self.assertEqual(get_version(), version + 1)
+        self.assertIsNot(diagnosis_index.get_index(), index)
+        self.assertEqual(self.codes('шизоаффективное'), ['F25'])
+
+
+class MkbLoaderTests(TestCase):
+    """Потоковая загрузка справочника МКБ-10"""
+
+    def setUp(self):
+        Diagnosis.objects.all().delete()
+
+    def test_json_is_read_across_chunks(self):
+        text = '[{"code": "F20", "name": "Шизофрения"},\n {"code": "F32", "name": "Депрессивный эпизод"}]'
+        items = list(iter_json(io.StringIO(text), chunk_size=7))
+        self.assertEqual([item['code'] for item in items], ['F20', 'F32'])
+        lines = '{"code": "F20", "name": "Шизофрения"}\n{"code": "F32", "name": "Эпизод"}\n'
+        self.assertEqual(len(list(iter_json(io.StringIO(lines), chunk_size=5))), 2)
+        with self.assertRaises(ValueError):
+            list(iter_json(io.StringIO('[{"code": "F20", '), chunk_size=5))
+
+    def test_csv_and_xml(self):
+        text = 'Код МКБ;Наименование;Актуальность\nF20.0;Параноидная шизофрения;1\nF20.9;Старый код;0\n'
+        self.assertEqual(list(read_classifier(io.StringIO(text), 'csv')),
+                         [('F20.0', 'Параноидная шизофрения', None), None])
+        xml = ('<?xml version="1.0" encoding="utf-8"?><root>'
+               '<entry MKB_CODE="F32"><MKB_NAME>Депрессивный эпизод</MKB_NAME></entry></root>')
+        self.assertEqual(list(read_classifier(io.BytesIO(xml.encode()), 'xml')),
+                         [('F32', 'Депрессивный эпизод', None)])
+
+    def test_entries(self):
+        self.assertEqual(parse_entry({'model': 'patients.diagnosis', 'fields': {'code': 'f20,0', 'name': 'Шизофрения'}}),
+                         ('F20.0', 'Шизофрения', None))
+        self.assertEqual(parse_entry({'code': 'A17.0+', 'name': 'Менингит', 'description': ''}),
+                         ('A17.0', 'Менингит', ''))
+        self.assertIsNone(parse_entry({'model': 'users.user', 'fields': {'code': 'F20', 'name': 'x'}}))
+        self.assertIsNone(parse_entry({'code': 'F20-F29', 'name': 'Блок'}))
+        self.assertIsNone(parse_entry({'code': 'F20'}))
+
+    def test_reload_writes_only_changes(self):
+        entries = [('F20', 'Шизофрения', 'Описание'), ('F32', 'Депрессивный эпизод', ''), None]
+        self.assertEqual(load_diagnoses(entries, batch_size=1),
+                         {'created': 2, 'updated': 0, 'unchanged': 0, 'skipped': 1})
+        # Коды встали в дерево классов и блоков
+        self.assertEqual(Diagnosis.objects.get(code='F20').parent.code, 'F20-F29')
+
+        entries = [('F20', 'Шизофрения', None), ('F32', 'Депрессивный эпизод (уточн.)', '')]
+        with self.assertNumQueries(4):
+            counts = load_diagnoses(entries)
+        self.assertEqual(counts, {'created': 0, 'updated': 1, 'unchanged': 1, 'skipped': 0})
+        # Без колонки описания загруженное описание сохраняется
+        self.assertEqual(Diagnosis.objects.get(code='F20').description, 'Описание')
+        self.assertEqual(Diagnosis.objects.get(code='F32').name, 'Депрессивный эпизод (уточн.)')
+
+    def test_load_file_by_extension(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'mkb.jsonl')
+            with open(path, 'w', encoding='utf-8') as stream:
+                stream.write('{"code": "F20", "name": "Шизофрения"}\n')
+            self.assertEqual(load_file(path)['created'], 1)
+            with self.assertRaises(ValueError):
+                load_file(os.path.join(directory, 'mkb.txt'))
+        self.assertTrue(Diagnosis.objects.filter(code='F20', content_hash__gt='').exists())
+
+
+class DiagnosisBundleTests(TestCase):
+    """Пакет справочника для поиска в браузере"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Diagnosis.objects.all().delete()
+        for code, name, description in DiagnosisSearchTests.ROWS:
+            Diagnosis.objects.create(code=code, name=name, description=description)
+        cls.doctor = make_user('doctor')
+
+    def setUp(self):
+        cache.clear()
+        diagnosis_index._index = None
+        bump_version()
+        self.client.force_login(self.doctor)
+
+    def test_bundle_address_is_content_hash(self):
+        url = bundle_url()
+        self.assertRegex(url, r'/[0-9a-f]{12}\.json$')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get(url)
+        self.assertEqual(response.json()[0], ['F10.2', 'Синдром зависимости, вызванный употреблением алкоголя'])
+
+        # Другой процесс (свой индекс) и новая версия без изменения содержимого дают тот же адрес
+        diagnosis_index._index = None
+        bump_version()
+        self.assertEqual(bundle_url(), url)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # После изменения справочника старый адрес ведет на новый пакет
+        with self.captureOnCommitCallbacks(execute=True):
+            Diagnosis.objects.create(code='F99', name='Психическое расстройство')
+        self.assertNotEqual(bundle_url(), url)
+        response = self.client.get(url)
+        self.assertRedirects(response, bundle_url(), fetch_redirect_response=False)
+        self.assertIn(['F99', 'Психическое расстройство'], self.client.get(bundle_url()).json())
+
+    def test_form_reads_bundle_address_from_database(self):
+        url = bundle_url()
+        self.assertEqual(DiagnosisVersion.objects.get().bundle_digest, url.rsplit('/', 1)[1][:-len('.json')])
+        diagnosis_index._index = None
+        # Хэш пакета текущей версии уже в БД - одним запросом, индекс не строится
+        with self.assertNumQueries(1):
+            widget = PatientForm().fields['admission_mkb_code'].widget
+        self.assertEqual(widget.attrs['data-autocomplete-bundle'], url)
+        self.assertIsNone(diagnosis_index._index)
+
+
+class DiagnosisSearchTests(TestCase):
+    """Автодополнение диагнозов: опечатки, раскладка и похожие буквы"""
+
+    ROWS = [
+        ('F20', 'Шизофрения', ''),
+        ('F20.0', 'Параноидная шизофрения', ''),
+        ('F20.1', 'Гебефренная шизофрения', ''),
+        ('F20.4', 'Постшизофреническая депрессия', ''),
+        ('F32', 'Депрессивный эпизод', ''),
+        ('F10.2', 'Синдром зависимости, вызванный употреблением алкоголя', ''),
+        ('F60.0', 'Параноидное расстройство личности', ''),
+        ('F60.3', 'Эмоционально неустойчивое расстройство', 'Импульсивность и неустойчивость настроения'),
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index = DiagnosisIndex(1, cls.ROWS)
+
+    def codes(self, query, limit=10):
+        return [result['code'] for result in self.index.search(query, limit)]
+
+    def test_code_and_word_prefix(self):
+        self.assertEqual(self.codes('F20'), ['F20', 'F20.0', 'F20.1', 'F20.4'])
+        self.assertEqual(self.codes('f20,0'), ['F20.0'])
+        self.assertEqual(self.codes('параноид'), ['F20.0', 'F60.0'])
+        self.assertEqual(self.codes('xyzzy'), [])
+
+    def test_typos(self):
+        self.assertEqual(self.codes('шизафрения')[:3], ['F20', 'F20.0', 'F20.1'])
+        self.assertEqual(self.codes('растройство личности'), ['F60.0'])
+        self.assertIn('F10.2', self.codes('зависимасти'))
+
+    def test_wrong_keyboard_layout(self):
+        self.assertEqual(query_variants('ibpjahtybz'), ['ibpjahtybz', 'шизофрения'])
+        self.assertEqual(query_variants('шизо'), ['шизо'])
+        self.assertEqual(self.codes('ibpjahtybz')[:3], ['F20', 'F20.0', 'F20.1'])
+        # Раскладка и опечатка сразу: ";" вместо "p" дает "ж" вместо "з"
+        self.assertEqual(self.codes('ib;jahtybz')[:3], ['F20', 'F20.0', 'F20.1'])
+
+    def test_lookalike_letters_in_codes(self):
+        self.assertEqual(fold_mkb_code('Ф20.0'), 'F20.0')
+        self.assertEqual(fold_mkb_code('F2О'), 'F20')
+        # Русская раскладка: "а" на клавише F, "ю" - на точке
+        self.assertIn('F20.1', query_codes('а20ю1'))
+        self.assertEqual(self.codes('Ф20.1'), ['F20.1'])
+        self.assertEqual(self.codes('а20ю1'), ['F20.1'])
+        self.assertEqual(self.codes('F2О')[:2], ['F20', 'F20.0'])
+
+    def test_mixed_script_word(self):
+        # Латинская "o" внутри русского слова
+        self.assertEqual(self.codes('шизoфрения')[:3], ['F20', 'F20.0', 'F20.1'])
+
+    def test_exact_matches_rank_before_fuzzy(self):
+        # "депрессия" есть в наименовании F20.4; "Депрессивный" у F32 - только похожее слово
+        self.assertEqual(self.codes('депрессия'), ['F20.4', 'F32'])
+        self.assertEqual(self.codes('депрессия', limit=1), ['F20.4'])
+
+    def test_name_match_ranks_before_description_match(self):
+        self.assertEqual(self.codes('неустойчивасть'), ['F60.3'])
+        index = DiagnosisIndex(1, [
+            ('A01', 'Другое', 'Неустойчивость'),
+            ('A02', 'Неустойчивость', ''),
+        ])
+        self.assertEqual([result['code'] for result in index.search('неустойчивасть')], ['A02', 'A01'])
+
+
+class DiagnosisApiTests(TestCase):
+    """API автодополнения и пакет справочника для браузера"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Diagnosis.objects.all().delete()
+        for code, name, description in DiagnosisSearchTests.ROWS:
+            Diagnosis.objects.create(code=code, name=name, description=description)
+        Diagnosis.objects.rebuild_tree()
+        cls.doctor = make_user('doctor')
+
+    def setUp(self):
+        cache.clear()
+        diagnosis_index._index = None
+        bump_version()
+        self.client.force_login(self.doctor)
+
+    def test_api_search_with_etag(self):
+        response = self.client.get(reverse('patients:api_diagnoses'), {'q': 'ib;jahtybz'})
+        self.assertEqual([result['code'] for result in response.json()['results']][:3], ['F20', 'F20.0', 'F20.1'])
+        response = self.client.get(
+            reverse('patients:api_diagnoses'), {'q': 'ib;jahtybz'}, HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, 304)
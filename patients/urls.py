@@ -8,7 +8,17 @@ from .views_class_based import (
     PatientDeleteView,
     PatientDischargeView,
     PatientExportView,
+    PatientStatisticsView,
+    OccupancyView,
+    DepartmentCensusView,
+    ReadmissionReportView,
+    DiagnosisFrequencyView,
+    RollupPivotView,
+    ExportJobDetailView,
+    ExportJobStatusView,
+    ExportJobDownloadView,
     ApiDiagnosesView,
+    ApiDiagnosisBundleView,
 )
 
 app_name = 'patients'
@@ -23,11 +33,23 @@ urlpatterns = [
     path('patients/<int:pk>/delete/', PatientDeleteView.as_view(), name='patient_delete'),
     path('patients/<int:pk>/discharge/', PatientDischargeView.as_view(), name='patient_discharge'),
     
+    # Статистика
+    path('statistics/', PatientStatisticsView.as_view(), name='statistics'),
+    path('statistics/occupancy/', OccupancyView.as_view(), name='occupancy'),
+    path('statistics/census/', DepartmentCensusView.as_view(), name='department_census'),
+    path('statistics/readmissions/', ReadmissionReportView.as_view(), name='readmissions'),
+    path('statistics/diagnoses/', DiagnosisFrequencyView.as_view(), name='diagnosis_frequency'),
+    
     # Экспорт
     path('patients/export/', PatientExportView.as_view(), name='patient_export'),
+    path('patients/export/jobs/<uuid:pk>/', ExportJobDetailView.as_view(), name='export_job_detail'),
+    path('patients/export/jobs/<uuid:pk>/download/', ExportJobDownloadView.as_view(), name='export_job_download'),
     
     # API
     path('api/diagnoses/', ApiDiagnosesView.as_view(), name='api_diagnoses'),
+    path('api/diagnoses/bundle/<slug:digest>.json', ApiDiagnosisBundleView.as_view(), name='api_diagnosis_bundle'),
+    path('api/export-jobs/<uuid:pk>/', ExportJobStatusView.as_view(), name='api_export_job'),
+    path('api/rollups/daily/', RollupPivotView.as_view(), name='api_rollup_pivot'),
     
 
 ]
\ No newline at end of file
@@ -1,22 +1,36 @@
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, FormView, TemplateView, View
 from django.views.generic.edit import FormMixin
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.contrib import messages
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.db.models import Q, Count
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.paginator import Paginator
 from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.db import models
+from django.conf import settings
 import json
-import csv
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
 
 from users.mixins import RoleRequiredMixin, ObjectPermissionMixin
-from .models import Patient, Diagnosis, Hospitalization
-from .forms import PatientForm, PatientSearchForm, PatientExportForm
+from .models import Patient, Diagnosis, Hospitalization, ExportJob
+from .forms import PatientForm, PatientSearchForm, PatientSelectionForm, PatientExportForm
+from .pagination import KeysetPaginator, InvalidCursor
+from .stats import (
+    MONTH_NAMES, get_dashboard_data, get_doctor_caseload, get_doctor_stats, get_period_statistics, get_scope,
+    get_status_counts, scope_queryset,
+)
+from .export import export_rows, stream_csv, stream_xlsx
+from .jobs import enqueue_export
+from .occupancy import DAILY_CENSUS_MAX_DAYS, daily_census, default_period, load_episodes, occupancy_report
+from .readmissions import readmission_rates
+from .diagnosis_index import diagnoses_etag, get_index, search_diagnoses
+from .diagnoses import DIAGNOSIS_KIND_CHOICES, DIAGNOSIS_KINDS, diagnosis_frequency, group_counts
+from .rollups import PIVOT_FILTERS, pivot
 
 
 class DashboardView(RoleRequiredMixin, TemplateView):
@@ -27,65 +41,23 @@ class DashboardView(RoleRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Основная статистика
-        context['total_patients'] = Patient.objects.count()
-        context['hospitalized'] = Patient.objects.filter(status='HOSPITALIZED').count()
-        context['discharged'] = Patient.objects.filter(status='DISCHARGED').count()
-        
-        # Статистика за последние 30 дней
-        thirty_days_ago = timezone.now() - timezone.timedelta(days=30)
-        context['recent_admissions'] = Patient.objects.filter(
-            admission_date__gte=thirty_days_ago
-        ).count()
-        
-        context['recent_discharges'] = Patient.objects.filter(
-            discharge_date__gte=thirty_days_ago
-        ).count()
-        
-        # Распределение по полу
-        context['gender_stats'] = Patient.objects.values('gender').annotate(
-            count=Count('id')
-        )
-        
-        # Распределение по возрасту
-        today = timezone.now().date()
-        context['age_groups'] = {
-            'До 18 лет': Patient.objects.filter(
-                birth_date__gte=today.replace(year=today.year - 18)
-            ).count(),
-            '18-30 лет': Patient.objects.filter(
-                birth_date__lt=today.replace(year=today.year - 18),
-                birth_date__gte=today.replace(year=today.year - 30)
-            ).count(),
-            '31-50 лет': Patient.objects.filter(
-                birth_date__lt=today.replace(year=today.year - 30),
-                birth_date__gte=today.replace(year=today.year - 50)
-            ).count(),
-            '51-70 лет': Patient.objects.filter(
-                birth_date__lt=today.replace(year=today.year - 50),
-                birth_date__gte=today.replace(year=today.year - 70)
-            ).count(),
-            'Старше 70 лет': Patient.objects.filter(
-                birth_date__lt=today.replace(year=today.year - 70)
-            ).count(),
-        }
-        
-        # Последние поступления
-        context['recent_patients'] = Patient.objects.select_related(
-            'attending_physician'
-        ).order_by('-admission_date')[:10]
+        # Счетчики, распределения и последние поступления (кэш по области видимости)
+        data = get_dashboard_data(self.request.user)
+        context['total_patients'] = data['total']
+        context['hospitalized'] = data['hospitalized']
+        context['discharged'] = data['discharged']
+        context['recent_admissions'] = data['recent_admissions']
+        context['recent_discharges'] = data['recent_discharges']
+        context['gender_stats'] = data['gender_stats']
+        context['age_groups'] = data['age_groups']
+        context['recent_patients'] = data['recent_patients']
         
         # Статистика по врачам (только для администраторов и аналитиков)
         if self.request.user.is_administrator or self.request.user.is_analyst:
-            context['doctor_stats'] = Patient.objects.filter(
-                attending_physician__isnull=False
-            ).values(
-                'attending_physician__last_name',
-                'attending_physician__first_name'
-            ).annotate(
-                patient_count=Count('id'),
-                hospitalized_count=Count('id', filter=Q(status='HOSPITALIZED'))
-            ).order_by('-patient_count')[:5]
+            context['doctor_stats'] = get_doctor_stats()
+        # Счетчики своих пациентов для врача
+        if self.request.user.is_doctor:
+            context['my_caseload'] = get_doctor_caseload(self.request.user)
         
         # Права доступа
         context['can_export'] = (
@@ -110,92 +82,98 @@ class PatientListView(RoleRequiredMixin, ListView):
     context_object_name = 'patients_with_perms'
     paginate_by = 25
     allowed_roles = ['ADMIN', 'DOCTOR', 'NURSE', 'REGISTRAR', 'ANALYST']
+    # Сортировки, для которых используется keyset-пагинация (курсоры вместо OFFSET)
+    keyset_orderings = ['-admission_date', 'admission_date', 'last_name', '-last_name', 'birth_date', 'case_number']
     
     def get_queryset(self):
         # Базовый queryset с учетом прав доступа
-        if self.request.user.is_administrator or self.request.user.has_perm('patients.view_all_patients'):
-            queryset = Patient.objects.all()
-        elif self.request.user.is_doctor:
-            queryset = Patient.objects.filter(attending_physician=self.request.user)
-        else:
-            queryset = Patient.objects.all()
+        queryset = Patient.objects.visible_to(self.request.user)
         
-        queryset = queryset.select_related('attending_physician')
+        # Права на редактирование/удаление/выписку вычисляются в том же запросе
+        queryset = queryset.select_related('attending_physician').with_permissions(self.request.user)
         
         # Применяем фильтры из формы поиска
+        query = None
         self.search_form = PatientSearchForm(self.request.GET or None)
         if self.search_form.is_valid():
             query = self.search_form.cleaned_data.get('query')
-            status = self.search_form.cleaned_data.get('status')
-            gender = self.search_form.cleaned_data.get('gender')
-            date_from = self.search_form.cleaned_data.get('date_from')
-            date_to = self.search_form.cleaned_data.get('date_to')
-            
-            if query:
-                queryset = queryset.filter(
-                    Q(last_name__icontains=query) |
-                    Q(first_name__icontains=query) |
-                    Q(middle_name__icontains=query) |
-                    Q(case_number__icontains=query) |
-                    Q(passport_series__icontains=query) |
-                    Q(passport_number__icontains=query) |
-                    Q(inn__icontains=query) |
-                    Q(phone__icontains=query) |
-                    Q(address__icontains=query)
-                )
-            if status:
-                queryset = queryset.filter(status=status)
-            if gender:
-                queryset = queryset.filter(gender=gender)
-            if date_from:
-                queryset = queryset.filter(admission_date__date__gte=date_from)
-            if date_to:
-                queryset = queryset.filter(admission_date__date__lte=date_to)
-        
-        # Сортировка
+            queryset = self.search_form.filter_queryset(queryset)
+        
+        # Сортировка (при поиске без явной сортировки - по релевантности)
         sort_by = self.request.GET.get('sort', '-admission_date')
-        if sort_by in ['last_name', 'admission_date', 'birth_date', 'case_number']:
+        if query and 'sort' not in self.request.GET:
+            self.list_ordering = None
+            queryset = queryset.order_by('-search_rank', '-admission_date')
+        elif sort_by in ['last_name', 'admission_date', 'birth_date', 'case_number', '-last_name']:
+            self.list_ordering = sort_by
             queryset = queryset.order_by(sort_by)
-        elif sort_by == '-last_name':
-            queryset = queryset.order_by('-last_name')
         else:
+            self.list_ordering = '-admission_date'
             queryset = queryset.order_by('-admission_date')
         
         return queryset
     
+    def use_keyset_pagination(self):
+        # ?page=N оставляем для старых ссылок, сортировка по релевантности - только OFFSET
+        return 'page' not in self.request.GET and self.list_ordering in self.keyset_orderings
+    
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        
+        paginator = KeysetPaginator(queryset, self.list_ordering, page_size, count=self._known_total())
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            page = paginator.page()
+        return (paginator, page, page.object_list, page.has_other_pages())
+    
+    def _known_total(self):
+        """Размер списка из закэшированных счетчиков статусов, если фильтр позволяет"""
+        if not self.search_form.is_bound:
+            data = {}
+        elif self.search_form.is_valid():
+            data = self.search_form.cleaned_data
+        else:
+            return None
+        if data.get('query') or data.get('gender') or data.get('date_from') or data.get('date_to'):
+            return None
+        status_counts = get_status_counts(self.request.user)
+        if data.get('status'):
+            return status_counts.get(data['status'])
+        return sum(status_counts.values())
+    
+    def _query_with_cursor(self, cursor=None):
+        """Строка запроса текущих фильтров с другим курсором"""
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        params.pop('cursor', None)
+        if cursor:
+            params['cursor'] = cursor
+        return params.urlencode()
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
         # Статистика по статусам с учетом прав доступа
-        status_counts = {}
-        for status_code, status_name in Patient.STATUS_CHOICES:
-            if self.request.user.is_administrator or self.request.user.has_perm('patients.view_all_patients'):
-                status_counts[status_code] = Patient.objects.filter(status=status_code).count()
-            elif self.request.user.is_doctor:
-                status_counts[status_code] = Patient.objects.filter(
-                    status=status_code,
-                    attending_physician=self.request.user
-                ).count()
-            else:
-                status_counts[status_code] = Patient.objects.filter(status=status_code).count()
-        
-        # Для каждого пациента вычисляем права
-        patient_permissions = []
-        for patient in context['object_list']:
-            can_edit = patient.user_can_edit(self.request.user)
-            can_delete = patient.user_can_delete(self.request.user)
-            can_discharge = (patient.status == 'HOSPITALIZED' and can_edit)
-            patient_permissions.append({
-                'patient': patient,
-                'can_edit': can_edit,
-                'can_delete': can_delete,
-                'can_discharge': can_discharge,
+        status_counts = get_status_counts(self.request.user)
+        
+        paginator = context['paginator']
+        total_patients = paginator.count
+        keyset = isinstance(paginator, KeysetPaginator)
+        if keyset:
+            page = context['page_obj']
+            context.update({
+                'first_page_query': self._query_with_cursor(),
+                'next_page_query': self._query_with_cursor(page.next_cursor) if page.has_next() else '',
+                'previous_page_query': self._query_with_cursor(page.previous_cursor) if page.has_previous() else '',
             })
         
         context.update({
-            'patients_with_perms': patient_permissions,
             'form': self.search_form if hasattr(self, 'search_form') else PatientSearchForm(),
-            'total_patients': self.get_queryset().count(),
+            'total_patients': total_patients,
+            'count_is_estimated': getattr(paginator, 'count_is_estimated', False),
+            'keyset': keyset,
             'status_counts': status_counts,
             'sort_by': self.request.GET.get('sort', '-admission_date'),
             'can_create_patient': (
@@ -363,168 +341,85 @@ class PatientExportView(RoleRequiredMixin, FormView):
     def get_initial(self):
         initial = super().get_initial()
         
-        # Определяем доступный queryset пациентов
-        patients_queryset = self._get_patients_queryset()
-        
+        # Фильтры можно передать из списка пациентов через GET
+        initial.update({
+            name: value
+            for name, value in self.request.GET.items()
+            if name in PatientSelectionForm.base_fields
+        })
         initial.update({
-            'patients': patients_queryset,
             'include_fields': ['basic', 'documents', 'hospitalization'],
             'export_format': 'xlsx',
         })
         return initial
     
-    def get_form_kwargs(self):
-        kwargs = super().get_form_kwargs()
-        
-        # Передаем queryset для поля patients
-        if 'data' not in kwargs:
-            kwargs['initial'] = self.get_initial()
-        
-        # Обновляем queryset для поля patients
-        form = PatientExportForm(**kwargs)
-        form.fields['patients'].queryset = self._get_patients_queryset()
-        
-        return kwargs
-    
     def _get_patients_queryset(self):
         """Получаем queryset пациентов с учетом прав доступа"""
-        if self.request.user.is_administrator or self.request.user.has_perm('patients.view_all_patients'):
-            return Patient.objects.all()
-        elif self.request.user.is_doctor:
-            return Patient.objects.filter(attending_physician=self.request.user)
-        else:
-            return Patient.objects.all()
+        return Patient.objects.visible_to(self.request.user)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         patients_queryset = self._get_patients_queryset()
         context['total_patients'] = patients_queryset.count()
+        
+        # Сколько пациентов попадает под фильтры, пришедшие из списка
+        selection = PatientSelectionForm(self.request.GET or None)
+        if self.request.method == 'GET' and selection.is_valid():
+            context['selected_patients'] = selection.filter_queryset(patients_queryset).count()
+            context['selected_ids'] = len(selection.cleaned_data['ids'])
+        
+        context['export_jobs'] = ExportJob.objects.filter(user=self.request.user)[:5]
         return context
     
     def form_valid(self, form):
-        patients = form.cleaned_data['patients']
         export_format = form.cleaned_data['export_format']
         include_fields = form.cleaned_data.get('include_fields', [])
         
         # Проверка: пользователь может экспортировать только тех пациентов, которых может просматривать
-        for patient in patients:
-            if not patient.user_can_view(self.request.user):
-                messages.error(self.request, 'Вы можете экспортировать только доступных вам пациентов')
-                return self.form_invalid(form)
+        accessible = self._get_patients_queryset()
+        ids = form.cleaned_data['ids']
+        if ids and Patient.objects.filter(pk__in=ids).exclude(pk__in=accessible.values('pk')).exists():
+            messages.error(self.request, 'Вы можете экспортировать только доступных вам пациентов')
+            return self.form_invalid(form)
+        
+        # Выборка строится по фильтрам одним запросом на сервере
+        patients = form.filter_queryset(accessible)
+        total = patients.count()
+        if not total:
+            messages.warning(self.request, 'Нет пациентов, подходящих под условия отбора')
+            return self.form_invalid(form)
+        
+        # Большие выгрузки собираются в фоне, чтобы не занимать воркер на все время экспорта
+        if total > settings.EXPORT_SYNC_MAX_ROWS:
+            job = enqueue_export(self.request.user, form.filter_spec, export_format, include_fields, total)
+            messages.info(self.request, 'Экспорт поставлен в очередь. Файл можно будет скачать на этой странице.')
+            return redirect('patients:export_job_detail', pk=job.pk)
+        
+        # CSV и XLSX отдаются потоком, без подготовки всех строк в памяти
+        if export_format == 'csv':
+            return self._export_csv(patients, include_fields)
+        elif export_format == 'xlsx':
+            return self._export_excel(patients, include_fields)
         
         # Подготовка данных для экспорта
         data = self._prepare_export_data(patients, include_fields)
         
-        if export_format == 'csv':
-            return self._export_csv(data)
-        elif export_format == 'xlsx':
-            return self._export_excel(data)
-        elif export_format == 'json':
+        if export_format == 'json':
             return self._export_json(data)
         
         return super().form_valid(form)
     
     def _prepare_export_data(self, patients, include_fields):
         """Подготовка данных для экспорта"""
-        data = []
-        
-        for patient in patients:
-            row = {}
-            
-            if 'basic' in include_fields:
-                row.update({
-                    'Номер истории болезни': patient.case_number,
-                    'Фамилия': patient.last_name,
-                    'Имя': patient.first_name,
-                    'Отчество': patient.middle_name or '',
-                    'Пол': patient.get_gender_display(),
-                    'Дата рождения': patient.birth_date.strftime('%d.%m.%Y') if patient.birth_date else '',
-                    'Возраст': patient.age,
-                    'Место рождения': patient.birth_place or '',
-                    'Гражданство': patient.citizenship or 'РФ',
-                    'Адрес': patient.address,
-                    'Телефон': patient.phone or '',
-                })
-            
-            if 'documents' in include_fields:
-                row.update({
-                    'Серия паспорта': patient.passport_series or '',
-                    'Номер паспорта': patient.passport_number or '',
-                    'Кем выдан': patient.passport_issued_by or '',
-                    'Дата выдачи': patient.passport_issue_date.strftime('%d.%m.%Y') if patient.passport_issue_date else '',
-                    'ИНН': patient.inn or '',
-                    'Страховой полис': patient.insurance_policy or '',
-                })
-            
-            if 'hospitalization' in include_fields:
-                row.update({
-                    'Дата поступления': patient.admission_date.strftime('%d.%m.%Y %H:%M') if patient.admission_date else '',
-                    'Откуда поступил': patient.admission_from or '',
-                    'Кем доставлен': patient.delivered_by or '',
-                    'Диагноз направившего учреждения': patient.referral_diagnosis or '',
-                    'Диагноз при поступлении': patient.admission_diagnosis,
-                    'Код МКБ при поступлении': patient.admission_mkb_code or '',
-                    'Лечащий врач': patient.attending_physician.get_full_name() if patient.attending_physician else '',
-                })
-            
-            if 'discharge' in include_fields:
-                row.update({
-                    'Дата выписки': patient.discharge_date.strftime('%d.%m.%Y %H:%M') if patient.discharge_date else '',
-                    'Диагноз при выписке': patient.discharge_diagnosis or '',
-                    'Код МКБ при выписке': patient.discharge_mkb_code or '',
-                    'Исход заболевания': patient.get_outcome_display() if patient.outcome else '',
-                    'Трудоспособность': patient.get_work_capacity_display() if patient.work_capacity else '',
-                    'Статус': patient.get_status_display(),
-                })
-            
-            if 'notes' in include_fields:
-                row.update({
-                    'Примечания': patient.notes or '',
-                    'Дата создания': patient.created_at.strftime('%d.%m.%Y %H:%M') if patient.created_at else '',
-                    'Создал': patient.created_by.get_full_name() if patient.created_by else '',
-                })
-            
-            data.append(row)
-        
-        return data
-    
-    def _export_csv(self, data):
-        """Экспорт в CSV"""
-        response = HttpResponse(content_type='text/csv; charset=utf-8-sig')
-        response['Content-Disposition'] = f'attachment; filename="patients_export_{timezone.now().strftime("%Y%m%d_%H%M%S")}.csv"'
-        
-        if data:
-            writer = csv.DictWriter(response, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
-        
-        return response
+        return export_rows(patients, include_fields)
     
-    def _export_excel(self, data):
-        """Экспорт в Excel"""
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = f'attachment; filename="patients_export_{timezone.now().strftime("%Y%m%d_%H%M%S")}.xlsx"'
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Пациенты"
-        
-        if data:
-            # Заголовки
-            headers = list(data[0].keys())
-            for col_num, header in enumerate(headers, 1):
-                col_letter = get_column_letter(col_num)
-                ws[f'{col_letter}1'] = header
-                ws.column_dimensions[col_letter].width = 20
-            
-            # Данные
-            for row_num, row_data in enumerate(data, 2):
-                for col_num, header in enumerate(headers, 1):
-                    col_letter = get_column_letter(col_num)
-                    ws[f'{col_letter}{row_num}'] = row_data.get(header, '')
-        
-        wb.save(response)
-        return response
+    def _export_csv(self, patients, include_fields):
+        """Экспорт в CSV (потоковый)"""
+        return stream_csv(patients, include_fields)
+    
+    def _export_excel(self, patients, include_fields):
+        """Экспорт в Excel (write-only, через временный файл)"""
+        return stream_xlsx(patients, include_fields)
     
     def _export_json(self, data):
         """Экспорт в JSON"""
@@ -536,31 +431,248 @@ class PatientExportView(RoleRequiredMixin, FormView):
         return response
 
 
+class ExportJobDetailView(LoginRequiredMixin, DetailView):
+    """Страница фоновой задачи экспорта с прогрессом"""
+    model = ExportJob
+    template_name = 'patients/export_job.html'
+    context_object_name = 'job'
+    
+    def get_queryset(self):
+        return ExportJob.objects.filter(user=self.request.user)
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['ttl_hours'] = settings.EXPORT_JOB_TTL_HOURS
+        return context
+
+
+class ExportJobStatusView(LoginRequiredMixin, View):
+    """API: состояние задачи экспорта для опроса со страницы"""
+    
+    def get(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user)
+        return JsonResponse({
+            'status': job.status,
+            'status_display': job.get_status_display(),
+            'processed': job.processed,
+            'total': job.total,
+            'progress': job.progress,
+            'error': job.error,
+            'download_url': reverse('patients:export_job_download', args=[job.pk]) if job.status == 'DONE' else None,
+        })
+
+
+class ExportJobDownloadView(LoginRequiredMixin, View):
+    """Скачивание готового файла экспорта"""
+    
+    def get(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, user=request.user, status='DONE')
+        if not job.file:
+            raise Http404('Файл экспорта удален')
+        return FileResponse(job.file.open('rb'), as_attachment=True, filename=job.filename)
+
+
+@method_decorator(condition(etag_func=diagnoses_etag), name='get')
 class ApiDiagnosesView(LoginRequiredMixin, View):
     """API для автодополнения диагнозов (классовое представление)"""
     
     def get(self, request):
-        query = request.GET.get('q', '')
-        
-        if query:
-            diagnoses = Diagnosis.objects.filter(
-                Q(code__icontains=query) | Q(name__icontains=query)
-            ).order_by('code')[:10]
+        query = request.GET.get('q', '').strip()
+        # Поиск по индексу в памяти процесса, без запроса к БД
+        results = search_diagnoses(query) if query else []
+        response = JsonResponse({'results': results})
+        # Браузер каждый раз сверяет ETag (версию справочника) и получает 304
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class ApiDiagnosisBundleView(LoginRequiredMixin, View):
+    """Пакет справочника МКБ-10 для автодополнения в браузере"""
+
+    def get(self, request, digest):
+        index = get_index()
+        if digest != index.bundle_digest:
+            # Страница открыта до изменения справочника - отдаем текущий пакет
+            return redirect('patients:api_diagnosis_bundle', digest=index.bundle_digest)
+        content, encoding = index.bundle(request.headers.get('Accept-Encoding', ''))
+        response = HttpResponse(content, content_type='application/json')
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ['Accept-Encoding'])
+        # Хэш содержимого в адресе: содержимое по нему не меняется
+        patch_cache_control(response, private=True, max_age=365 * 24 * 3600, immutable=True)
+        return response
+
+
+class OccupancyView(RoleRequiredMixin, TemplateView):
+    """Занятость коек и длительность госпитализации за период"""
+    template_name = 'patients/occupancy.html'
+    allowed_roles = ['ADMIN', 'ANALYST']
+    
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'csv':
+            date_from, date_to = self._get_period()
+            census = daily_census(load_episodes(date_from, date_to), date_from, date_to)
+            response = HttpResponse(
+                '\ufeff' + census.to_csv(index_label='Дата', date_format='%d.%m.%Y'),
+                content_type='text/csv; charset=utf-8',
+            )
+            response['Content-Disposition'] = (
+                f'attachment; filename="census_{date_from:%Y%m%d}_{date_to:%Y%m%d}.csv"'
+            )
+            return response
+        return super().get(request, *args, **kwargs)
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        date_from, date_to = self._get_period()
+        report = occupancy_report(date_from, date_to)
+        census = report['census']
+        if len(census.index) > DAILY_CENSUS_MAX_DAYS:
+            census = census.resample('MS').mean().round(1)
+            context['census_monthly'] = True
+        context['census_columns'] = list(census.columns)
+        context['census_rows'] = list(zip(census.index.date, census.to_numpy().tolist()))
+        context['census_summary'] = report['census_summary']
+        context['los_summary'] = report['los_summary']
+        context['los_distribution'] = report['los_distribution']
+        context['date_from'] = date_from
+        context['date_to'] = date_to
+        return context
+    
+    def _get_period(self):
+        """Период из GET (по умолчанию последние 90 дней)"""
+        default_from, default_to = default_period()
+        try:
+            date_from = parse_date(self.request.GET.get('date_from', '')) or default_from
+            date_to = parse_date(self.request.GET.get('date_to', '')) or default_to
+        except ValueError:
+            return default_from, default_to
+        if date_from > date_to:
+            return default_from, default_to
+        return date_from, date_to
+
+
+class DepartmentCensusView(RoleRequiredMixin, TemplateView):
+    """Кто находился в отделении на дату"""
+    template_name = 'patients/department_census.html'
+    allowed_roles = ['ADMIN', 'DOCTOR', 'NURSE', 'ANALYST']
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        try:
+            day = parse_date(self.request.GET.get('date', '')) or timezone.localdate()
+        except ValueError:
+            day = timezone.localdate()
+        department = self.request.GET.get('department', '')
+        
+        # Отделения и эпизоды - только пациентов, доступных пользователю
+        visible = Hospitalization.objects.filter(patient__in=Patient.objects.visible_to(self.request.user))
+        active = visible.active_on(day)
+        context['departments'] = visible.order_by('department').values_list('department', flat=True).distinct()
+        context['department_counts'] = (
+            active.order_by('department').values('department').annotate(count=Count('id'))
+        )
+        if department:
+            context['episodes'] = active.filter(department=department).select_related(
+                'patient', 'attending_physician'
+            ).order_by('patient__last_name', 'patient__first_name')
+        context['day'] = day
+        context['department'] = department
+        return context
+
+
+class ReadmissionReportView(RoleRequiredMixin, TemplateView):
+    """Доля повторных госпитализаций по отделениям и врачам"""
+    template_name = 'patients/readmissions.html'
+    allowed_roles = ['ADMIN', 'ANALYST']
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        default_from, default_to = default_period(365)
+        try:
+            date_from = parse_date(self.request.GET.get('date_from', '')) or default_from
+            date_to = parse_date(self.request.GET.get('date_to', '')) or default_to
+        except ValueError:
+            date_from, date_to = default_from, default_to
+        # Другое окно считается на лету по days_since_discharge
+        try:
+            window_days = int(self.request.GET.get('window', ''))
+        except ValueError:
+            window_days = settings.READMISSION_WINDOW_DAYS
+        if not 1 <= window_days <= 365:
+            window_days = settings.READMISSION_WINDOW_DAYS
+        stored = None if window_days == settings.READMISSION_WINDOW_DAYS else window_days
+        
+        context['by_department'] = readmission_rates('department', date_from, date_to, stored)
+        context['by_physician'] = readmission_rates('physician', date_from, date_to, stored)
+        context['date_from'] = date_from
+        context['date_to'] = date_to
+        context['window_days'] = window_days
+        return context
+
+
+class DiagnosisFrequencyView(RoleRequiredMixin, TemplateView):
+    """Частота диагнозов МКБ-10 за период"""
+    template_name = 'patients/diagnosis_frequency.html'
+    allowed_roles = ['ADMIN', 'DOCTOR', 'ANALYST']
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        default_from, default_to = default_period(365)
+        try:
+            date_from = parse_date(self.request.GET.get('date_from', '')) or default_from
+            date_to = parse_date(self.request.GET.get('date_to', '')) or default_to
+        except ValueError:
+            date_from, date_to = default_from, default_to
+        kind = self.request.GET.get('kind', 'admission')
+        if kind not in DIAGNOSIS_KINDS:
+            kind = 'admission'
+        
+        visible = Patient.objects.visible_to(self.request.user)
+        if kind == 'hospitalization':
+            queryset = Hospitalization.objects.filter(patient__in=visible)
         else:
-            diagnoses = Diagnosis.objects.none()
-        
-        results = [
-            {
-                'id': d.code,
-                'text': f'{d.code} - {d.name}',
-                'code': d.code,
-                'name': d.name,
-                'description': d.description[:100] if d.description else '',
-            }
-            for d in diagnoses
-        ]
-        
-        return JsonResponse({'results': results})
+            queryset = visible
+        # Код, добавленный в обход загрузчика, еще не размещен в дереве - отчет без ограничения
+        node = Diagnosis.objects.filter(code=self.request.GET.get('node', ''), lft__isnull=False).first()
+        rows, unlinked = diagnosis_frequency(kind, date_from, date_to, queryset=queryset, node=node)
+        context['rows'] = rows
+        context['unlinked'] = unlinked
+        context['groups'] = group_counts(kind, date_from, date_to, queryset=queryset)
+        context['node'] = node
+        context['node_path'] = Diagnosis.objects.ancestors(node) if node else []
+        context['kinds'] = DIAGNOSIS_KIND_CHOICES
+        context['kind'] = kind
+        context['date_from'] = date_from
+        context['date_to'] = date_to
+        return context
+
+
+class RollupPivotView(RoleRequiredMixin, View):
+    """API: сводка по витрине DailyPatientRollup"""
+    allowed_roles = ['ADMIN', 'DOCTOR', 'ANALYST']
+    
+    def get(self, request):
+        dimensions = [name for name in request.GET.get('dimensions', '').split(',') if name]
+        filters = {name: request.GET[name] for name in PIVOT_FILTERS if request.GET.get(name)}
+        # Врач видит только своих пациентов
+        scope = get_scope(request.user)
+        if scope.startswith('doctor:'):
+            filters['attending_physician'] = request.user.pk
+        try:
+            date_from = parse_date(request.GET.get('date_from', ''))
+            date_to = parse_date(request.GET.get('date_to', ''))
+            rows = pivot(
+                dimensions,
+                date_from=date_from,
+                date_to=date_to,
+                filters=filters,
+                rollup=request.GET.get('rollup') == '1',
+            )
+        except ValueError as exc:
+            return JsonResponse({'error': str(exc)}, status=400)
+        return JsonResponse({'dimensions': dimensions, 'results': rows})
 
 
 class PatientStatisticsView(RoleRequiredMixin, TemplateView):
@@ -572,54 +684,46 @@ class PatientStatisticsView(RoleRequiredMixin, TemplateView):
         context = super().get_context_data(**kwargs)
         
         # Фильтры
-        year = self.request.GET.get('year', timezone.now().year)
-        month = self.request.GET.get('month')
-        
-        # Базовый queryset
-        queryset = Patient.objects.filter(
-            admission_date__year=year
-        )
-        
-        if month:
-            queryset = queryset.filter(admission_date__month=month)
+        year, month = self._get_period()
+        scope = get_scope(self.request.user)
+        stats = get_period_statistics(scope, year, month)
         
         # Общая статистика
-        context['total_patients'] = queryset.count()
-        context['hospitalized'] = queryset.filter(status='HOSPITALIZED').count()
-        context['discharged'] = queryset.filter(status='DISCHARGED').count()
-        context['transferred'] = queryset.filter(status='TRANSFERRED').count()
-        context['died'] = queryset.filter(status='DIED').count()
-        
-        # Статистика по месяцам
-        monthly_stats = []
-        for month_num in range(1, 13):
-            month_data = queryset.filter(admission_date__month=month_num)
-            monthly_stats.append({
-                'month': month_num,
-                'admissions': month_data.count(),
-                'discharges': month_data.filter(discharge_date__month=month_num).count(),
-            })
-        context['monthly_stats'] = monthly_stats
-        
-        # Статистика по диагнозам (топ-10)
-        context['top_diagnoses'] = Diagnosis.objects.annotate(
-            patient_count=Count('patient')
-        ).order_by('-patient_count')[:10]
-        
-        # Статистика по возрасту
-        age_stats = {
-            'До 18 лет': queryset.filter(age__lt=18).count(),
-            '18-30 лет': queryset.filter(age__range=(18, 30)).count(),
-            '31-50 лет': queryset.filter(age__range=(31, 50)).count(),
-            '51-70 лет': queryset.filter(age__range=(51, 70)).count(),
-            'Старше 70 лет': queryset.filter(age__gt=70).count(),
-        }
-        context['age_stats'] = age_stats
+        context['total_patients'] = stats['total']
+        context['hospitalized'] = stats['status_counts']['HOSPITALIZED']
+        context['discharged'] = stats['status_counts']['DISCHARGED']
+        context['transferred'] = stats['status_counts']['TRANSFERRED']
+        context['died'] = stats['status_counts']['DIED']
+        
+        # Поступления и выписки по месяцам, возраст, топ-10 диагнозов при поступлении
+        context['monthly_stats'] = stats['monthly_stats']
+        context['age_stats'] = stats['age_stats']
+        context['top_diagnoses'] = stats['top_diagnoses']
+        context['mkb_groups'] = stats['mkb_groups']
         
         # Годы для фильтра
-        context['years'] = Patient.objects.dates('admission_date', 'year')
+        context['years'] = scope_queryset(scope).dates('admission_date', 'year')
+        context['months'] = list(enumerate(MONTH_NAMES, 1))
+        context['year'] = year
+        context['month'] = month
         
         return context
+    
+    def _get_period(self):
+        """Год и месяц из GET; некорректные значения заменяются текущим годом / всем годом"""
+        try:
+            year = int(self.request.GET.get('year', ''))
+        except ValueError:
+            year = timezone.now().year
+        if not 1900 <= year <= 9999:
+            year = timezone.now().year
+        try:
+            month = int(self.request.GET.get('month', ''))
+        except ValueError:
+            month = None
+        if month is not None and not 1 <= month <= 12:
+            month = None
+        return year, month
 
 
 class HospitalizationCreateView(RoleRequiredMixin, CreateView):
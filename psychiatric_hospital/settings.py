@@ -89,6 +89,17 @@ DATABASES = {
     }
 }
 
+# Cache
+# Для нескольких воркеров gunicorn нужен общий кэш (например,
+# django.core.cache.backends.redis.RedisCache), иначе сброс статистики
+# сигналами будет виден только в процессе, где изменили данные.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='psychiatric-hospital'),
+    }
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -124,6 +135,16 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Фоновый экспорт: файлы хранятся вне MEDIA_ROOT и отдаются только владельцу
+EXPORT_ROOT = config('EXPORT_ROOT', default=str(BASE_DIR / 'exports'))
+EXPORT_JOB_WORKERS = config('EXPORT_JOB_WORKERS', default=2, cast=int)
+EXPORT_JOB_TTL_HOURS = config('EXPORT_JOB_TTL_HOURS', default=24, cast=int)
+# Выгрузки не больше этого числа строк отдаются сразу, без фоновой задачи
+EXPORT_SYNC_MAX_ROWS = config('EXPORT_SYNC_MAX_ROWS', default=1000, cast=int)
+
+# Поступление не позже этого числа дней после выписки считается повторной госпитализацией
+READMISSION_WINDOW_DAYS = config('READMISSION_WINDOW_DAYS', default=30, cast=int)
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -147,7 +168,4 @@ SESSION_SAVE_EVERY_REQUEST = True
 # Import-Export settings
 IMPORT_EXPORT_USE_TRANSACTIONS = True
 
-# File upload settings
-DATA_UPLOAD_MAX_NUMBER_FIELDS = 10000
-
 LOGOUT_REDIRECT_URL = '/'
\ No newline at end of file
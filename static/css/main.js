@@ -42,6 +42,7 @@ function initDiagnosisAutocomplete() {
     
     diagnosisInputs.forEach(input => {
         const url = input.getAttribute('data-autocomplete-url');
+        const bundleUrl = input.getAttribute('data-autocomplete-bundle');
         
         input.addEventListener('input', debounce(function(e) {
             const query = e.target.value.trim();
@@ -51,13 +52,26 @@ function initDiagnosisAutocomplete() {
                 return;
             }
             
-            fetch(`${url}?q=${encodeURIComponent(query)}`)
-                .then(response => response.json())
-                .then(data => {
-                    showDropdown(data.results, input);
+            // Поиск по пакету справочника в браузере; без пакета, при ошибке его загрузки
+            // или если точных совпадений нет - API (нечеткий поиск, исправление раскладки)
+            loadDiagnosisBundle(bundleUrl)
+                .then(bundle => {
+                    const results = bundle.search(query);
+                    if (!results.length) {
+                        throw new Error('Нет точных совпадений');
+                    }
+                    return results;
+                })
+                .catch(() => fetch(`${url}?q=${encodeURIComponent(query)}`)
+                    .then(response => response.json())
+                    .then(data => data.results))
+                .then(results => {
+                    if (input.value.trim() === query) {
+                        showDropdown(results, input);
+                    }
                 })
                 .catch(error => console.error('Ошибка автодополнения:', error));
-        }, 300));
+        }, bundleUrl ? 100 : 300));
     });
     
     function showDropdown(results, input) {
@@ -107,6 +121,82 @@ function initDiagnosisAutocomplete() {
     });
 }
 
+// Пакет справочника МКБ-10 (patients/diagnosis_index.py): загружается один раз на страницу,
+// повторно берется из кэша браузера - в адресе хэш содержимого справочника
+const diagnosisBundles = {};
+
+function loadDiagnosisBundle(url) {
+    if (!url) {
+        return Promise.reject(new Error('Нет адреса пакета справочника'));
+    }
+    if (!diagnosisBundles[url]) {
+        diagnosisBundles[url] = fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Пакет справочника недоступен: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(items => new DiagnosisBundle(items))
+            .catch(error => {
+                delete diagnosisBundles[url];
+                throw error;
+            });
+    }
+    return diagnosisBundles[url];
+}
+
+// Те же правила, что у DiagnosisIndex на сервере
+function normalizeMkbCode(code) {
+    return code.replace(/\s+/g, '').toUpperCase().replace(/,/g, '.').replace(/\.+$/, '');
+}
+
+function normalizeWords(text) {
+    return text.toLowerCase().replace(/ё/g, 'е').match(/[\p{L}\p{N}_]+/gu) || [];
+}
+
+class DiagnosisBundle {
+    constructor(items) {
+        // items - [[код, наименование], ...] в порядке нормализованных кодов
+        this.items = items;
+        this.codes = items.map(item => normalizeMkbCode(item[0]));
+        this.words = items.map(item => normalizeWords(item[1]));
+    }
+    
+    search(query, limit = 10) {
+        const found = [];
+        const seen = new Set();
+        const code = normalizeMkbCode(query);
+        if (code) {
+            // Бинарный поиск первого кода не меньше code
+            let low = 0;
+            let high = this.codes.length;
+            while (low < high) {
+                const middle = (low + high) >> 1;
+                if (this.codes[middle] < code) {
+                    low = middle + 1;
+                } else {
+                    high = middle;
+                }
+            }
+            for (let i = low; i < this.codes.length && found.length < limit && this.codes[i].startsWith(code); i++) {
+                found.push(i);
+                seen.add(i);
+            }
+        }
+        
+        const queryWords = normalizeWords(query);
+        if (queryWords.length) {
+            for (let i = 0; i < this.items.length && found.length < limit; i++) {
+                if (!seen.has(i) && queryWords.every(prefix => this.words[i].some(word => word.startsWith(prefix)))) {
+                    found.push(i);
+                }
+            }
+        }
+        return found.map(i => ({code: this.items[i][0], name: this.items[i][1]}));
+    }
+}
+
 // Debounce функция
 function debounce(func, wait) {
     let timeout;